@@ -17,45 +17,387 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
 import datetime
-from flask import Flask, render_template, jsonify, request, make_response
-import astar
+import gzip
+import hashlib
+import time
+import numpy as np
+from flask import Flask, render_template, jsonify, request, make_response, Response
+import metrics
 import utils, json
+from batch import batch_route as run_batch
+from ensemble import ensemble_eta, ensemble_route
+from replan import replan_routes
 from config import Config
+from ingest import ensure_forecast
+from jobs import job_queue, DONE, FAILED, CANCELLED
+from landmask import CoastlineMissing
+from route_cache import route_cache, snap_route
+from routers import ROUTERS
+from warmup import warmup
+from wind import get_ensemble_field, get_wind_field
 
 app = Flask(__name__)
+if Config.warmup:
+    # Each gunicorn worker loads what routing needs in the background while it starts serving pages
+    warmup.start()
+
+
+def departure_hours(wind_field, value=None):
+    '''
+    Departure in hours after the start of the forecast, the one given with the request or leaving now when None.
+    Leaving now is rounded to Config.departure_step hours so requests a few minutes apart share cached routes.
+    '''
+    if value is not None:
+        return float(value)
+    return round(wind_field.departure_hours() / Config.departure_step) * Config.departure_step
+
+
+def no_forecast():
+    '''503 for requests that need a forecast while the first one is still being downloaded or converted'''
+    res = make_response(jsonify({'error': 'No forecast yet'}), 503)
+    res.headers['Retry-After'] = Config.warmup_retry
+    return res
+
+
+@app.errorhandler(CoastlineMissing)
+def no_coastline(error):
+    '''A json error rather than an HTML 500 for requests that need the land mask while the coastline is missing'''
+    return make_response(jsonify({'error': str(error)}), 500)
+
 
 @app.route('/', methods=['GET'])
 def index():
-    # Load converted json file for display on leaflet with windbarb plugin
-    file = open(Config.json_dir + utils.get_jsons()[0], 'r')
-    return render_template('index.html', data=json.load(file), extents=Config.extents, timeout=Config.timeout)
+    # Picks up new gribs in the background, the wind barbs are fetched from /wind for the area in view
+    ensure_forecast()
+    return render_template('index.html', extents=Config.extents, timeout=Config.job_timeout,
+                           algorithm=Config.algorithm)
+
+
+@app.route('/wind', methods=['GET'])
+def wind():
+    '''
+    Quantized wind grid for the area in view, served as gzip compressed json with an ETag.
+    Speeds are in steps of Config.wind_speed_step knots and directions in whole degrees, both as flat row major arrays.
+    Query parameters are bbox=south,west,north,east, zoom and hours after the start of the forecast, now by default.
+    '''
+    try:
+        wind_field = get_wind_field()
+    except FileNotFoundError:
+        return no_forecast()
+    max_extents, min_extents = Config.extents
+    try:
+        south, west, north, east = [float(value) for value in request.args['bbox'].split(',')]
+    except (KeyError, ValueError):
+        south, west, north, east = min_extents['lat'], min_extents['lng'], max_extents['lat'], max_extents['lng']
+    zoom = request.args.get('zoom', Config.wind_detail_zoom, type=int)
+    hours = departure_hours(wind_field, request.args.get('hours', type=float))
+    # Thin out the barbs when zoomed out so there are about the same number on screen
+    stride = max(1, 2 ** (Config.wind_detail_zoom - zoom))
+
+    etag = hashlib.sha1(json.dumps([wind_field.key, [round(value, 2) for value in (south, west, north, east)],
+                                    stride, hours]).encode()).hexdigest()
+    if etag in request.if_none_match:
+        res = make_response('', 304)
+        res.set_etag(etag)
+        return res
+
+    lats, lngs, speed, degree = wind_field.grid(south, west, north, east, stride, hours)
+    payload = {'lats': [round(lat, 4) for lat in lats.tolist()],
+               'lngs': [round(lng, 4) for lng in lngs.tolist()],
+               'speed_step': Config.wind_speed_step,
+               'speed': np.rint(speed / Config.wind_speed_step).astype(int).ravel().tolist(),
+               'degree': (np.rint(degree).astype(int) % 360).ravel().tolist()}
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    res = make_response(body, 200)
+    res.mimetype = 'application/json'
+    if 'gzip' in request.accept_encodings:
+        res.set_data(gzip.compress(body))
+        res.headers['Content-Encoding'] = 'gzip'
+        res.vary.add('Accept-Encoding')
+    res.set_etag(etag)
+    # Always check the ETag again, a new forecast changes it
+    res.headers['Cache-Control'] = 'no-cache'
+    return res
 
 
 @app.route('/process_user_route', methods=['GET', 'POST'])
 def process():
-    routes = request.get_json()
-    route_time = utils.get_route_time(routes=routes)
-    string_time = '{} days {} hours {} minutes'.format(route_time.days, route_time.seconds // 3600,
-                                                       (route_time.seconds // 60) % 60)
-    res = make_response(jsonify({'route_time': string_time}), 200)
+    # Every drawn route is timed in one pass, the last one is the route being edited
+    routes = [route for route in request.get_json() if len(route) > 1]
+    if len(routes) == 0:
+        return make_response(jsonify({'error': 'A route needs at least two points'}), 400)
+    # Sub-segment length in wind grid cells, 0 times each leg with the wind at its start
+    resolution = request.args.get('resolution', Config.route_resolution, type=float)
+    try:
+        wind_field = get_wind_field()
+    except FileNotFoundError:
+        return no_forecast()
+    departure = departure_hours(wind_field, request.args.get('departure', type=float))
+    route_hours = utils.evaluate_routes(routes, departure=departure, wind_field=wind_field, resolution=resolution)
+    route_times = [format_route_time(datetime.timedelta(hours=float(hours))) for hours in route_hours]
+    res = make_response(jsonify({'route_time': route_times[-1], 'route_times': route_times}), 200)
     return res
 
 
+# A* search grid settings and heuristic weight a request may override, see astar_optimal_route
+GRID_PARAMETERS = {'max_hours': float, 'min_hours': float, 'min_zoom': int, 'max_zoom': int, 'weight': float}
+
+
+def grid_options(algorithm):
+    '''
+    Search grid overrides from the query string.
+    :return: Dict of the overrides and an error message, None when they are valid
+    '''
+    if algorithm != 'astar':
+        return {}, None
+    options = {name: request.args.get(name, type=kind) for name, kind in GRID_PARAMETERS.items()}
+    options = {name: value for name, value in options.items() if value is not None}
+    hours = options.get('min_hours', Config.astar_min_hours), options.get('max_hours', Config.astar_max_hours)
+    zooms = options.get('min_zoom', Config.astar_min_zoom), options.get('max_zoom', Config.astar_max_zoom)
+    if not 0 < hours[0] <= hours[1]:
+        return options, 'Time steps need 0 < min_hours <= max_hours'
+    if not 0 <= zooms[0] <= zooms[1] <= 24:
+        return options, 'Grid zooms need 0 <= min_zoom <= max_zoom <= 24'
+    if options.get('weight', Config.astar_heuristic_weight) < 1:
+        return options, 'The heuristic weight needs weight >= 1'
+    return options, None
+
+
+def debug_requested():
+    '''Whether the request asked for the search profile with ?debug=1'''
+    return request.args.get('debug', 0, type=int) == 1
+
+
+def format_route_time(route_time):
+    if isinstance(route_time, datetime.timedelta):
+        return '{} days {} hours {} minutes'.format(route_time.days, route_time.seconds // 3600,
+                                                    (route_time.seconds // 60) % 60)
+    return 'Not Found'
+
+
 @app.route('/calculate_optimal_route', methods=['GET', 'POST'])
 def router():
+    algorithm = request.args.get('algorithm', Config.algorithm)
+    if algorithm not in ROUTERS:
+        return make_response(jsonify({'error': 'Unknown algorithm {}'.format(algorithm)}), 400)
+    options, error = grid_options(algorithm)
+    if error is not None:
+        return make_response(jsonify({'error': error}), 400)
     routes = request.get_json()
     start = routes[-1][0]
     finish = routes[-1][-1]
-    optimal_route, route_time = astar.astar_optimal_route(start, finish)
-    if isinstance(route_time, datetime.timedelta):
-        route_time = '{} days {} hours {} minutes'.format(route_time.days, route_time.seconds // 3600,
-                                                          (route_time.seconds // 60) % 60)
+    try:
+        wind_field = get_wind_field()
+    except FileNotFoundError:
+        return no_forecast()
+    forecast = wind_field.key
+    departure = departure_hours(wind_field, request.args.get('departure', type=float))
+    key = route_cache.key(forecast, algorithm, start, finish, departure=departure, options=options)
+    cached = route_cache.get(forecast, key)
+    profile = None
+    if cached is not None:
+        optimal_route, route_time, stats = snap_route(cached, start, finish, departure=departure,
+                                                       wind_field=wind_field)
     else:
-        route_time = 'Not Found'
-    res = make_response(jsonify({'route': optimal_route, 'route_time': route_time}), 200)
+        stats = {}
+        profile = metrics.Profile()
+        optimal_route, route_time = ROUTERS[algorithm](start, finish, departure=departure, stats=stats,
+                                                       profile=profile, wind_field=wind_field, **options)
+        profile = profile.as_dict()
+        metrics.registry.record(algorithm, profile)
+        if isinstance(route_time, datetime.timedelta):
+            route_cache.put(forecast, key, (optimal_route, route_time, stats))
+    body = {'route': optimal_route, 'route_time': format_route_time(route_time), 'stats': stats}
+    if debug_requested():
+        # None when the route came from the cache
+        body['profile'] = profile
+    res = make_response(jsonify(body), 200)
+    return res
+
+
+@app.route('/batch_route', methods=['POST'])
+def batch():
+    '''
+    Routes every combination of departure time, boat and pair of endpoints and ranks them by arrival.
+    Takes json {'endpoints': [[start, finish], ...], 'departures': [hours, ...], 'polars': [name, ...]}
+    with polars named as in Config.polar_diagrams, all of them when left out. Departures are hours after the start
+    of the forecast, leaving now when left out.
+    '''
+    body = request.get_json()
+    algorithm = body.get('algorithm', Config.algorithm)
+    if algorithm not in ROUTERS:
+        return make_response(jsonify({'error': 'Unknown algorithm {}'.format(algorithm)}), 400)
+    names = body.get('polars', list(Config.polar_diagrams))
+    unknown = [name for name in names if name not in Config.polar_diagrams]
+    if unknown:
+        return make_response(jsonify({'error': 'Unknown polars {}'.format(', '.join(unknown))}), 400)
+    try:
+        wind_field = get_wind_field()
+    except FileNotFoundError:
+        return no_forecast()
+    departures = body.get('departures') or [departure_hours(wind_field)]
+    rows = run_batch(endpoints=body['endpoints'], departures=departures,
+                     polars={name: Config.polar_diagrams[name] for name in names}, algorithm=algorithm,
+                     debug=debug_requested(), wind_field=wind_field)
+    for row in rows:
+        row['route_time'] = format_route_time(row['route_time'])
+    return make_response(jsonify({'results': rows}), 200)
+
+
+@app.route('/replan', methods=['POST'])
+def replan():
+    '''
+    Re-plans the routes of tracked boats on the active forecast, reusing the legs where the wind has not changed.
+    Takes json {'boats': [{'route': [...], 'forecast': name, 'departure': hours, 'polar': name}, ...]} where forecast
+    is the 'forecast' in the stats of the search that planned the route. Boats without a departure leave now.
+    '''
+    boats = request.get_json()['boats']
+    unknown = [boat['polar'] for boat in boats if 'polar' in boat and boat['polar'] not in Config.polar_diagrams]
+    if unknown:
+        return make_response(jsonify({'error': 'Unknown polars {}'.format(', '.join(unknown))}), 400)
+    # Boats without a departure leave now
+    try:
+        wind_field = get_wind_field()
+    except FileNotFoundError:
+        return no_forecast()
+    departure = departure_hours(wind_field)
+    boats = [dict(boat, departure=boat.get('departure', departure)) for boat in boats]
+    rows = replan_routes(boats, debug=debug_requested(), wind_field=wind_field)
+    for row in rows:
+        row['route_time'] = format_route_time(row['route_time'])
+    return make_response(jsonify({'results': rows}), 200)
+
+
+@app.route('/ensemble_route', methods=['POST'])
+def ensemble():
+    '''
+    ETA distributions across the members of the ensemble forecast. Takes json {'routes': [route, ...]} to time fixed
+    routes, or {'start', 'finish'} to route every member and pick the route with the lowest Config.ensemble_percentile
+    arrival. Optional 'departure', 'polar' and 'algorithm', with 'routes' also compared when routing. The departure
+    is in hours after the start of the ensemble forecast, leaving now when left out.
+    '''
+    body = request.get_json()
+    algorithm = body.get('algorithm', Config.algorithm)
+    if algorithm not in ROUTERS:
+        return make_response(jsonify({'error': 'Unknown algorithm {}'.format(algorithm)}), 400)
+    polar = body.get('polar')
+    if polar is not None and polar not in Config.polar_diagrams:
+        return make_response(jsonify({'error': 'Unknown polars {}'.format(polar)}), 400)
+    polar_path = Config.polar_diagrams[polar] if polar is not None else Config.polar_diagram
+    try:
+        ensemble_field = get_ensemble_field()
+        departure = departure_hours(ensemble_field, body.get('departure'))
+        if 'start' in body:
+            result = ensemble_route(body['start'], body['finish'], departure=departure, algorithm=algorithm,
+                                    polar_path=polar_path, routes=body.get('routes', []),
+                                    debug=debug_requested(), ensemble=ensemble_field)
+        else:
+            result = {'etas': ensemble_eta(body['routes'], departure=departure, polar_path=polar_path,
+                                           ensemble=ensemble_field)}
+    except FileNotFoundError:
+        return make_response(jsonify({'error': 'There is no ensemble forecast yet'}), 503)
+    return make_response(jsonify(result), 200)
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    '''
+    Readiness check, 200 once the forecast, polars and land mask are loaded and 503 until then. 500 when the
+    warm-up failed on the configuration, such as a missing coastline, and will never be ready.
+    '''
+    if warmup.ready():
+        return make_response(jsonify(warmup.status()), 200)
+    if warmup.misconfigured:
+        # Never ready until the configuration is fixed and the app restarted
+        return make_response(jsonify(warmup.status()), 500)
+    # Tries again after a failed warm-up, a forecast may have arrived since
+    warmup.start()
+    res = make_response(jsonify(warmup.status()), 503)
+    res.headers['Retry-After'] = Config.warmup_retry
     return res
 
 
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return make_response(jsonify(route_cache.stats()), 200)
+
+
+@app.route('/metrics', methods=['GET'])
+def search_metrics():
+    '''Search counters and timers of every route searched by this process, in the Prometheus text format'''
+    return Response(metrics.registry.prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    '''Queues an optimal route search for the last route drawn and returns its job id straight away'''
+    algorithm = request.args.get('algorithm', Config.algorithm)
+    if algorithm not in ROUTERS:
+        return make_response(jsonify({'error': 'Unknown algorithm {}'.format(algorithm)}), 400)
+    options, error = grid_options(algorithm)
+    if error is not None:
+        return make_response(jsonify({'error': error}), 400)
+    routes = request.get_json()
+    start = routes[-1][0]
+    finish = routes[-1][-1]
+    try:
+        wind_field = get_wind_field()
+    except FileNotFoundError:
+        return no_forecast()
+    departure = departure_hours(wind_field, request.args.get('departure', type=float))
+    job_id = job_queue.submit(algorithm, start, finish, forecast=wind_field.key, departure=departure, options=options)
+    return make_response(jsonify({'job_id': job_id}), 202)
+
+
+def job_response(job):
+    # Route times are only formatted for display once the job is done
+    if 'route_time' in job:
+        job['route_time'] = format_route_time(job['route_time'])
+    return job
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id, debug=debug_requested())
+    if job is None:
+        return make_response(jsonify({'error': 'Unknown job'}), 404)
+    return make_response(jsonify(job_response(job)), 200)
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    if not job_queue.cancel(job_id):
+        return make_response(jsonify({'error': 'Unknown job'}), 404)
+    return make_response(jsonify({'job_id': job_id, 'status': CANCELLED}), 200)
+
+
+@app.route('/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id):
+    '''
+    Server sent events with the job progress until it finishes. Each stream closes after Config.job_stream_seconds
+    and the browser reconnects, so a long search never holds a worker thread throughout.
+    '''
+    if job_queue.get(job_id) is None:
+        return make_response(jsonify({'error': 'Unknown job'}), 404)
+
+    def events():
+        # EventSource reconnects a second after the stream closes
+        yield 'retry: 1000\n\n'
+        closes = time.time() + Config.job_stream_seconds
+        while True:
+            job = job_queue.get(job_id)
+            if job is None:
+                # Forgotten while streaming
+                yield 'data: {}\n\n'.format(json.dumps({'job_id': job_id, 'error': 'Unknown job'}))
+                break
+            yield 'data: {}\n\n'.format(json.dumps(job_response(job)))
+            if job['status'] in (DONE, FAILED, CANCELLED) or time.time() > closes:
+                break
+            time.sleep(Config.job_stream_interval)
+
+    return Response(events(), mimetype='text/event-stream')
+
+
 if __name__ == '__main__':
     app.run()
 
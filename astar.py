@@ -16,12 +16,17 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 import heapq
+import os
 import time
-import mercantile
 import numpy as np
+import geodesy
+import metrics
 import utils
 from config import Config
-from utils import get_most_recent_netcdf, get_boat_speed, calculate_true_wind_angle
+from landmask import get_land_mask
+from polar import get_polar
+from utils import get_boat_speed, calculate_true_wind_angle
+from wind import get_wind_field
 
 class PriorityQueue:
     '''
@@ -46,126 +51,482 @@ class PriorityQueue:
     def pop(self):
         return heapq.heappop(self.heap)
 
-class Node:
-    def __init__(self, lat, lng, time=0, parent=None, heading=0, distance_to_finish=0, cost=0):
-        self.lat = lat
-        self.lng = lng
-        # This creates a semi unique identifier. Same as the index for slippy maps
-        # https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
-        self.grid_location = mercantile.tile(self.lat, self.lng, zoom=10) # 14 shows good resolution, 12 clips
-        self.time = time
-        self.cost = cost
-        self.parent = parent
-        self.heading = heading
-        self.distance_to_finish = distance_to_finish
-
-def astar_optimal_route(start, finish, max_steps=10000):
+# Every heading the boat may steer from a node, whole degrees
+HEADINGS = np.arange(0, 360)
+
+# Zoom of the slippy map tiles used as the explored grid cells. 14 shows good resolution, 12 clips
+GRID_ZOOM = 10
+
+
+def grid_keys(lats, lngs, zoom=GRID_ZOOM):
+    '''
+    Integer keys of the grid cells holding each location. The cells are the tiles of slippy maps
+    https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames calculated for whole arrays at once.
+    '''
+    tiles = 2 ** zoom
+    lat_radians = np.radians(np.clip(lats, -85.0511, 85.0511))
+    x = np.floor((np.asarray(lngs) + 180) / 360 * tiles).astype(np.int64)
+    y = np.floor((1 - np.arcsinh(np.tan(lat_radians)) / np.pi) / 2 * tiles).astype(np.int64)
+    return np.clip(x, 0, tiles - 1) * tiles + np.clip(y, 0, tiles - 1)
+
+
+def cell_keys(lats, lngs, zoom):
+    '''Grid cell keys that also hold the zoom, so cells of different sizes never share a key'''
+    zoom = np.asarray(zoom, dtype=np.int64)
+    return (zoom << 48) | grid_keys(lats, lngs, zoom)
+
+
+def cell_zoom(lat, cell_size, min_zoom, max_zoom):
+    '''Zoom of the slippy map tiles closest to cell_size nautical miles wide at a latitude'''
+    # A zoom 0 tile is 360 degrees of longitude, 60 nautical miles each on the equator
+    width = 360 * 60 * np.cos(np.radians(lat))
+    return int(np.clip(np.rint(np.log2(width / max(cell_size, 1e-6))), min_zoom, max_zoom))
+
+
+def wind_gradient(lat, speeds, degrees, wind_field):
+    '''
+    Knots the wind vector changes per nautical mile.
+    :param speeds: Wind speeds at a point, one wind grid cell north of it and one east of it
+    :param degrees: Wind directions at the same three points
+    '''
+    radians = np.radians(degrees)
+    u, v = -speeds * np.sin(radians), -speeds * np.cos(radians)
+    north = np.hypot(u[1] - u[0], v[1] - v[0]) / (abs(wind_field.lat_step) * 60)
+    east = np.hypot(u[2] - u[0], v[2] - v[0]) / (abs(wind_field.lng_step) * 60 * max(np.cos(np.radians(lat)), 0.01))
+    return float(np.hypot(north, east))
+
+
+def step_hours(distance_to_finish, boat_speed, wind_speed, gradient, max_hours, min_hours):
+    '''
+    Hours to sail from a node. Long steps in steady wind far from the finish, shorter ones where the wind changes by
+    more than Config.astar_max_wind_change of its speed over a step, and on the final approach so that about
+    Config.astar_approach_steps are left to the finish.
+    :param distance_to_finish: Nautical miles to the finish
+    :param boat_speed: Fastest boat speed at the node in knots
+    :param wind_speed: Wind speed at the node in knots
+    :param gradient: Knots the wind changes per nautical mile, see wind_gradient
+    '''
+    hours = min(max_hours, distance_to_finish / boat_speed / Config.astar_approach_steps)
+    # Never divide by less than a knot of wind, calms would always get the shortest steps
+    change = gradient * boat_speed * hours / max(wind_speed, 1)
+    if change > Config.astar_max_wind_change:
+        hours *= Config.astar_max_wind_change / change
+    return max(hours, min_hours)
+
+
+class NodeStore:
+    '''
+    Search nodes held in preallocated numpy columns, a node is just its integer row.
+    The columns double in size when they fill up.
+    '''
+    COLUMNS = {'lat': np.float64,
+               'lng': np.float64,
+               'time': np.float64,
+               'cost': np.float64,
+               'parent': np.int64,
+               'heading': np.int16,
+               # Grid cell of the node, see cell_keys
+               'key': np.int64,
+               'zoom': np.int8,
+               'distance_to_finish': np.float64,
+               # Bearing from the node to the finish, used for the vmg of its children
+               'finish_bearing': np.float64}
+
+    def __init__(self, capacity=4096):
+        self.size = 0
+        for name, dtype in self.COLUMNS.items():
+            setattr(self, name, np.empty(capacity, dtype=dtype))
+
+    def __len__(self):
+        return self.size
+
+    def add(self, **columns):
+        '''
+        Appends nodes given as equal length arrays for every column.
+        :return: The indices of the new nodes
+        '''
+        count = len(columns['lat'])
+        if self.size + count > len(self.lat):
+            capacity = max(2 * len(self.lat), self.size + count)
+            for name in self.COLUMNS:
+                column = getattr(self, name)
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                setattr(self, name, grown)
+        indices = np.arange(self.size, self.size + count)
+        for name, values in columns.items():
+            getattr(self, name)[indices] = values
+        self.size += count
+        return indices
+
+    def route(self, index):
+        '''Follows the parents back to the start and returns the route from the start to the node'''
+        route = []
+        while index >= 0:
+            route.append({'lat': float(self.lat[index]), 'lng': float(self.lng[index])})
+            index = self.parent[index]
+        # Reverse to make sure this route has the same start and finish as the users drawn route
+        return route[::-1]
+
+
+def expand_node(lat, lng, finish_bearing, finish, wind_speed, wind_degree, polar, hours_of_travel, headings=HEADINGS,
+                land_mask=None, profile=metrics.DISABLED):
+    '''
+    Calculates every child of a node for the whole heading fan at once.
+    Headings with a negative vmg are dropped before any geodesic calculation.
+    :param lat: Latitude of the node being expanded
+    :param lng: Longitude of the node being expanded
+    :param finish_bearing: Bearing from the node to the finish
+    :param finish: {'lat', 'lng'} of the finish
+    :param wind_speed: The wind speed at the node
+    :param wind_degree: The wind direction at the node
+    :param polar: The boat Polar
+    :param hours_of_travel: Hours sailed on each heading
+    :param headings: Array of headings to evaluate
+    :param land_mask: Optional LandMask, children whose leg crosses land or a no go zone are dropped
+    :param profile: metrics.Profile timing the polar, geodesic and land mask calls
+    :return: Arrays of heading, vmg, lat, lng, bearing to finish and distance to finish for each child
+    '''
+    true_wind_angle = calculate_true_wind_angle(headings, wind_degree)
+    with profile.timer('polar'):
+        speed = np.maximum(get_boat_speed(true_wind_angle, wind_speed, polar=polar), Config.motoring_speed)
+    # http://lagoon-inside.com/en/faster-thanks-to-the-vmg-concept/
+    vmg = speed * np.cos(np.radians(finish_bearing - headings))
+    # By restricting to only positive vmg of speed ratios we are headed at least towards the desitnation
+    positive = vmg > 0
+    headings, speed, vmg = headings[positive], speed[positive], vmg[positive]
+    if len(headings) == 0:
+        empty = np.empty(0)
+        return headings, vmg, empty, empty, empty, empty
+    # Polars are in nautical miles. fwd takes meters.
+    # TODO Fix edge case where distance overshoots
+    distance = speed * hours_of_travel * 1852
+    with profile.timer('geodesic'):
+        lngs, lats, _ = geodesy.fwd(lons=lng, lats=lat, az=headings, dist=distance)
+    if land_mask is not None and not land_mask.empty:
+        with profile.timer('land_mask'):
+            clear = ~land_mask.crosses(lat, lng, lats, lngs)
+        headings, vmg, lats, lngs = headings[clear], vmg[clear], lats[clear], lngs[clear]
+    with profile.timer('geodesic'):
+        finish_bearings, _, dist_finish = geodesy.inv(lons1=lngs, lats1=lats, lons2=finish['lng'], lats2=finish['lat'])
+    return headings, vmg, lats, lngs, finish_bearings, dist_finish
+
+
+# Fastest possible boat speed for each (forecast, polar) pair, see max_boat_speed
+_max_boat_speeds = {}
+
+
+def max_boat_speed(wind_field, polar):
+    '''
+    Fastest the boat can sail anywhere in the forecast. Dividing a distance by it gives a time that
+    is never more than the real sailing time, which makes it an admissible A* heuristic.
+    Calculated once for each forecast and polar.
+    '''
+    key = (wind_field.key, polar.path)
+    if key not in _max_boat_speeds:
+        _max_boat_speeds[key] = max(polar.max_speed(float(np.max(wind_field.speed))), Config.motoring_speed)
+    return _max_boat_speeds[key]
+
+
+def first_in_cell(keys):
+    '''Indices of the first of each group of keys that share a grid cell, in their original order'''
+    _, first = np.unique(keys, return_index=True)
+    return np.sort(first)
+
+
+def straight_to_finish(nodes, index, finish, departure, polar, wind_field, stats):
+    '''
+    The route to a node finished with a straight line to the finish, what an anytime search returns when it runs out
+    of time or nodes. The straight line is not checked for land.
+    :return: The route and the route time, the stats are flagged approximate
+    '''
+    route = nodes.route(index) + [{'lat': finish['lat'], 'lng': finish['lng']}]
+    stats.update(approximate=True, nodes_created=len(nodes),
+                 remaining_distance=float(nodes.distance_to_finish[index] / 1852))
+    return route, utils.time_found_route(route, departure, polar, wind_field, stats)
+
+
+def previous_route(seed, departure, polar, wind_field, stats):
+    '''The previous route of a warm started search that found nothing faster, timed in the new forecast'''
+    stats.update(previous_route=True, route_hours=seed.upper_bound)
+    return seed.route, utils.time_found_route(seed.route, departure, polar, wind_field, stats)
+
+
+def astar_optimal_route(start, finish, max_steps=10000, departure=0, mode=Config.astar_mode, stats=None,
+                        timeout=Config.timeout, progress=None, polar_path=Config.polar_diagram,
+                        max_hours=Config.astar_max_hours, min_hours=Config.astar_min_hours,
+                        min_zoom=Config.astar_min_zoom, max_zoom=Config.astar_max_zoom, profile=None,
+                        anytime=Config.anytime, seed=None, wind_field=None, weight=Config.astar_heuristic_weight):
+    '''
+    Searches for the optimal route, timing each leg with the wind sampled along it like utils.evaluate_routes.
+    In 'astar' mode nodes are ordered by elapsed hours plus the remaining distance sailed at the fastest
+    possible boat speed, so the first route to reach the finish is the fastest one.
+    In 'greedy' mode nodes are ordered by vmg over remaining distance and the search stops in the finish grid cell.
+    Each node picks its own time step and grid cell size, see step_hours and cell_zoom, so the grid is coarse
+    mid ocean and fine on the approach to the finish.
+    :param start: {'lat', 'lng'} of the start
+    :param finish: {'lat', 'lng'} of the finish
+    :param max_steps: Maximum number of nodes expanded
+    :param departure: Hours after the start of the forecast the boat leaves
+    :param mode: 'astar' or 'greedy'
+    :param stats: Optional dict filled with the nodes expanded and the optimality gap of the route. The lower bound
+                  and the gap are of searched_hours, see utils.time_found_route.
+    :param timeout: Seconds before the search gives up
+    :param progress: Optional callable given the nodes expanded and the best distance to the finish so far
+                     every Config.progress_interval expansions. Returning False cancels the search.
+    :param polar_path: Polar diagram of the boat
+    :param max_hours: Longest time step
+    :param min_hours: Shortest time step
+    :param min_zoom: Zoom of the largest grid cells
+    :param max_zoom: Zoom of the smallest grid cells
+    :param profile: Optional metrics.Profile filled with counters, section timers and frontier sizes
+    :param anytime: Out of time or nodes, return the route to the node with the earliest estimated arrival and a
+                    straight line to the finish, flagged approximate in the stats
+    :param seed: Optional replan.WarmStart of a previous route. Its unchanged opening legs are kept, its time bounds
+                 the search and nodes near it are expanded first. Returned when nothing faster is found.
+    :param wind_field: The WindField to route on, defaults to the active forecast
+    :param weight: Weight on the heuristic in 'astar' mode, 1 finds the fastest route and larger weights search
+                   faster for a route no more than weight times slower
+    :return: The route and the route time
+    '''
+    if mode not in ('astar', 'greedy'):
+        raise ValueError('Unknown search mode {}'.format(mode))
+    if stats is None:
+        stats = {}
+    if profile is None:
+        profile = metrics.DISABLED
+    profile.start_phase('setup')
     # These are latlon tuples for display purposes only, they show the explored areas
     if Config.debug:
         leaflet_points = set()
     # This gives a way to end the search, nice for debugging
     step = 0
-    hours_of_travel = 12
     # This holds the wind degree and speed
-    wind_data = get_most_recent_netcdf()
+    if wind_field is None:
+        wind_field = get_wind_field()
 
-    finish_bearing, x, total_distance_to_finish = Config.globe.inv(lats1=start['lat'],
-                                                      lons1=start['lng'],
-                                                      lats2=finish['lat'],
-                                                      lons2=finish['lng'])
+    finish_bearing, x, total_distance_to_finish = geodesy.inv(lats1=start['lat'],
+                                                              lons1=start['lng'],
+                                                              lats2=finish['lat'],
+                                                              lons2=finish['lng'])
 
-    start_node = Node(lat=start['lat'], lng=start['lng'], distance_to_finish=total_distance_to_finish)
-    finish_node = Node(lat=finish['lat'], lng=finish['lng'])
+    nodes = NodeStore()
+    start_key = cell_keys(start['lat'], start['lng'], max_zoom).item()
+    start_index = nodes.add(lat=[start['lat']], lng=[start['lng']], time=[0], cost=[0], parent=[-1], heading=[0],
+                            key=[start_key], zoom=[max_zoom], distance_to_finish=[total_distance_to_finish],
+                            finish_bearing=[finish_bearing])[0]
 
+    # Heap entries are (cost, node index) and explored maps grid cell keys to node indices
     frontier = PriorityQueue()
-    frontier.push((0, start_node))
-    explored = {start_node.grid_location: start_node}
+    explored = {start_key: int(start_index)}
+
+    polar = get_polar(polar_path)
+    land_mask = get_land_mask()
+    # Knots converted to meters per hour for the heuristic
+    max_speed = max_boat_speed(wind_field, polar) * 1852
+    stats.update(mode=mode, nodes_expanded=0, max_boat_speed=max_speed / 1852,
+                 forecast=os.path.basename(wind_field.path))
+
+    # The search starts from the last of the legs kept from a previous route
+    first_node = int(start_index)
+    if seed is not None:
+        profile.count('reused_nodes', seed.reuse)
+        for point, hours in zip(seed.route[1:seed.reuse + 1], seed.hours[1:seed.reuse + 1]):
+            bearing, _, distance = geodesy.inv(point['lng'], point['lat'], finish['lng'], finish['lat'])
+            key = cell_keys(point['lat'], point['lng'], max_zoom).item()
+            first_node = int(nodes.add(lat=[point['lat']], lng=[point['lng']], time=[hours],
+                                       cost=[hours + weight * distance / max_speed],
+                                       parent=[first_node], heading=[0], key=[key], zoom=[max_zoom],
+                                       distance_to_finish=[distance], finish_bearing=[bearing])[0])
+            explored[key] = first_node
+    frontier.push((float(nodes.cost[first_node]), first_node))
 
-    # Create the boat polar diagram for get_boat_speed_numpy function
-    polar_diagram = np.genfromtxt(Config.polar_diagram, delimiter=';')
-    # replace the nans with - inf
-    polar_diagram = np.nan_to_num(polar_diagram, nan=-np.inf)
-    # sort according to the first column, wind angle
-    polar_diagram = polar_diagram[np.argsort(polar_diagram[:, 0])]
+    def finished(index):
+        '''Records the search statistics and returns the route ending at index'''
+        route = nodes.route(index)
+        route_hours = nodes.time[index]
+        # No route still on the frontier can be faster than its elapsed hours plus the heuristic
+        waiting = np.array([entry[1] for entry in frontier.heap], dtype=np.int64)
+        bounds = nodes.time[waiting] + nodes.distance_to_finish[waiting] / max_speed
+        lower_bound = min(route_hours, bounds.min()) if len(bounds) else route_hours
+        stats.update(nodes_created=len(nodes), route_hours=float(route_hours), lower_bound_hours=float(lower_bound),
+                     optimality_gap=float((route_hours - lower_bound) / route_hours) if route_hours > 0 else 0.)
+        return route
+
+    # Elapsed hours of the fastest finish node pushed so far, an upper bound on the route time
+    best_finish_time = seed.upper_bound if seed is not None else np.inf
+    best_distance_to_finish = nodes.distance_to_finish[first_node]
+    # Node with the earliest arrival sailing straight from it to the finish, for anytime searches
+    best_estimate = np.inf
+    best_estimate_index = first_node
 
     start_time = time.time()
+    profile.start_phase('search')
     while not frontier.empty() and step < max_steps:
-        current = frontier.pop()
-        current_node = current[-1]
-        wind_speed = wind_data.sel(latitude=current_node.lat,
-                                   longitude=current_node.lng,
-                                   method='nearest')['speed'].values.item()
-
-        wind_degree = wind_data.sel(latitude=current_node.lat,
-                                    longitude=current_node.lng,
-                                    method='nearest')['degree'].values.item()
+        _, current = frontier.pop()
+        lat, lng, current_time = nodes.lat[current], nodes.lng[current], nodes.time[current]
+        current_key = int(nodes.key[current])
+        # A faster node has since claimed this cell, its own entry is on the frontier.
+        # Finish nodes never claim a cell so they are always kept.
+        if nodes.distance_to_finish[current] != 0 and explored.get(current_key, current) != current:
+            profile.count('stale_pops')
+            continue
+        # The wind at the node, and one wind grid cell north and east of it for the gradient
+        with profile.timer('wind'):
+            wind_speeds, wind_degrees = wind_field.sample(np.array([lat, lat + wind_field.lat_step, lat]),
+                                                          np.array([lng, lng, lng + wind_field.lng_step]),
+                                                          departure + current_time)
+        wind_speed, wind_degree = wind_speeds[0], wind_degrees[0]
         # Timed Out Exit
-        if time.time() > start_time + Config.timeout:
+        if time.time() > start_time + timeout:
+            profile.outcome = metrics.TIMEOUT
             if Config.debug:
                 print('No route found')
                 return list(leaflet_points), 'Not Found'
+            elif seed is not None:
+                return previous_route(seed, departure, polar, wind_field, stats)
+            elif anytime:
+                return straight_to_finish(nodes, best_estimate_index, finish, departure, polar, wind_field, stats)
             else:
                 print('No route found')
                 return [start], 'Error: Not Found'
 
         # Check if the finish has been reached.
-        elif current_node.grid_location == finish_node.grid_location:
+        elif (mode == 'astar' and nodes.distance_to_finish[current] == 0) or \
+                (mode == 'greedy' and current_key == cell_keys(finish['lat'], finish['lng'], nodes.zoom[current]).item()):
             # This is the optimal route
-            route = []
-            # Traverse the nodes and rebuild the path
-            current = current_node
-            while current != None:
-                route.append({'lat': current.lat, 'lng':current.lng})
-                current = current.parent
-
-            # Reverse to make sure this route has the same start and finish as the users drawn route
-            route = route[::-1]
-            route_time = utils.get_route_time(routes=[route])
+            profile.start_phase('route_time')
+            profile.outcome = metrics.FOUND
+            route = finished(current)
+            route_time = utils.time_found_route(route, departure, polar, wind_field, stats)
             if Config.debug:
                 print('Route:', route)
                 print('Optimal Path Time', route_time)
                 return list(leaflet_points), route_time
             return route, route_time
 
-        for heading in[deg for deg in range(0, 361, 1)]:
-            # Get the new location for traveling at speed. Polars are in nautical miles. fwd takes meters.
-            true_wind_angle = calculate_true_wind_angle(heading, wind_degree)
-            speed = max(get_boat_speed(true_wind_angle, wind_speed, polar_diagram=polar_diagram), Config.motoring_speed)
-            # TODO Fix edge case where distance overshoots
-            distance = speed * hours_of_travel * 1852
-            # http://lagoon-inside.com/en/faster-thanks-to-the-vmg-concept/
-            vmg = speed * np.cos(np.radians(finish_bearing - heading))
-            # By restricting to only positive vmg of speed ratios we are headed at least towards the desitnation
-            if vmg > 0:
-                lng, lat, _ = Config.globe.fwd(lons=current_node.lng,
-                                                          lats=current_node.lat,
-                                                          az=heading,
-                                                          dist=distance)
-                finish_bearing, x, dist_finish = Config.globe.inv(lats1=lat,
-                                                                   lons1=lng,
-                                                                   lats2=finish_node.lat,
-                                                                   lons2=finish_node.lng)
-                node = Node(lat=lat,
-                            lng=lng,
-                            time=current_node.time + hours_of_travel,
-                            # larger negative take priority
-                            cost=-vmg / dist_finish,
-                            parent=current_node,
-                            heading=heading,
-                            distance_to_finish=dist_finish
-                            )
-
-                if node.grid_location not in explored:
-                    explored[node.grid_location] = node
-                    frontier.push((node.cost, id(node), node))
-                    if Config.debug:
-                        leaflet_points.add((node.lat, node.lng))
-                elif explored[node.grid_location].time > node.time:
-                    explored[node.grid_location] = node
-                    frontier.push((node.cost, id(node), node))
-        step += 1
+        stats['nodes_expanded'] += 1
+        profile.count('expansions')
+        profile.sample_frontier(stats['nodes_expanded'], len(frontier.heap))
+        if progress is not None and stats['nodes_expanded'] % Config.progress_interval == 0:
+            if progress({'nodes_expanded': stats['nodes_expanded'],
+                         'best_distance_to_finish': best_distance_to_finish / 1852}) is False:
+                profile.outcome = metrics.CANCELLED
+                return [start], 'Cancelled'
+        # Steps and cells shrink where the wind changes quickly and on the approach to the finish
+        with profile.timer('polar'):
+            boat_speed = max(polar.max_speed(wind_speed), Config.motoring_speed)
+        hours_of_travel = step_hours(nodes.distance_to_finish[current] / 1852, boat_speed, wind_speed,
+                                     wind_gradient(lat, wind_speeds, wind_degrees, wind_field), max_hours, min_hours)
+        zoom = cell_zoom(lat, boat_speed * hours_of_travel * Config.astar_cell_fraction, min_zoom, max_zoom)
+        finishing = False
+        if mode == 'astar' or anytime:
+            # Arrival sailing straight to the finish in the wind at the node
+            true_wind_angle = calculate_true_wind_angle(nodes.finish_bearing[current], wind_degree)
+            with profile.timer('polar'):
+                speed = max(get_boat_speed(true_wind_angle, wind_speed, polar=polar), Config.motoring_speed) * 1852
+            finish_time = current_time + nodes.distance_to_finish[current] / speed
+            # Sail straight to the finish when it is within one step
+            reachable = mode == 'astar' and finish_time <= current_time + hours_of_travel and \
+                finish_time < best_finish_time
+            estimate = anytime and finish_time < best_estimate
+            clear = (reachable or estimate) and \
+                not land_mask.crosses(lat, lng, finish['lat'], finish['lng'], include_end=False)[0]
+            if clear and estimate:
+                best_estimate, best_estimate_index = finish_time, int(current)
+            finishing = clear and reachable
+
+        headings, vmg, lats, lngs, finish_bearings, dist_finish = expand_node(lat, lng, nodes.finish_bearing[current],
+                                                                              finish, wind_speed, wind_degree, polar,
+                                                                              hours_of_travel, land_mask=land_mask,
+                                                                              profile=profile)
+        profile.count('children', len(headings))
+        # Children are picked sailing the wind at the node
+        child_time = current_time + hours_of_travel
+        keys = cell_keys(lats, lngs, zoom)
+        if mode == 'astar':
+            penalty = np.zeros(len(keys))
+            if seed is not None:
+                # Children that leave the corridor of the previous route wait behind the ones along it
+                penalty[~np.isin(cell_keys(lats, lngs, seed.corridor_zoom), seed.corridor)] = seed.corridor_penalty
+            # Elapsed hours plus the hours to the finish at the fastest possible speed
+            costs = child_time + weight * dist_finish / max_speed + penalty
+            # Children that cannot beat the fastest finish found so far are never needed
+            costs[child_time + dist_finish / max_speed >= best_finish_time] = np.inf
+            # The child closest to the finish competes for each cell and replaces a node with a larger cost
+            order = np.argsort(costs, kind='stable')
+            first = order[first_in_cell(keys[order])]
+            accepted = np.array([i for i, key in zip(first.tolist(), keys[first].tolist())
+                                 if costs[i] < np.inf and (key not in explored or nodes.cost[explored[key]] > costs[i])],
+                                dtype=int)
+        else:
+            # larger negative take priority
+            costs = -vmg / dist_finish
+            # Only the first child landing in a cell can claim it
+            first = first_in_cell(keys)
+            accepted = np.array([i for i, key in zip(first.tolist(), keys[first].tolist())
+                                 if key not in explored or nodes.time[explored[key]] > child_time], dtype=int)
 
-    return [list(leaflet_points)], 'Frontier Empty or Steps exceeded'
+        # The picked legs, and the one straight to the finish, are timed again the way the returned route is with
+        # the wind sampled along them, so a leg that sails into a front passing during the step costs what it will
+        # on the route
+        ends = lats[accepted], lngs[accepted]
+        if finishing:
+            ends = np.append(ends[0], finish['lat']), np.append(ends[1], finish['lng'])
+        with profile.timer('legs'):
+            child_time = current_time + utils.time_legs(lat, lng, *ends, departure + current_time, polar, wind_field)
+        if finishing:
+            finish_time, child_time = child_time[-1], child_time[:-1]
+        if finishing and finish_time < best_finish_time:
+            best_finish_time = finish_time
+            profile.count('finish_pushes')
+            index = nodes.add(lat=[finish['lat']], lng=[finish['lng']], time=[finish_time], cost=[finish_time],
+                              parent=[current], heading=[0], key=[-1], zoom=[max_zoom], distance_to_finish=[0],
+                              finish_bearing=[0])[0]
+            frontier.push((float(finish_time), int(index)))
+        # A retimed child may no longer beat the node in its cell or the fastest finish
+        if mode == 'astar':
+            costs = child_time + weight * dist_finish[accepted] / max_speed + penalty[accepted]
+            costs[child_time + dist_finish[accepted] / max_speed >= best_finish_time] = np.inf
+            keep = [cost < np.inf and (key not in explored or nodes.cost[explored[key]] > cost)
+                    for key, cost in zip(keys[accepted].tolist(), costs.tolist())]
+        else:
+            costs = costs[accepted]
+            keep = [key not in explored or nodes.time[explored[key]] > hours
+                    for key, hours in zip(keys[accepted].tolist(), child_time.tolist())]
+        keep = np.array(keep, dtype=bool)
+        accepted, costs, child_time = accepted[keep], costs[keep], child_time[keep]
+        if len(accepted) == 0:
+            step += 1
+            continue
+        best_distance_to_finish = min(best_distance_to_finish, dist_finish[accepted].min())
+        indices = nodes.add(lat=lats[accepted],
+                            lng=lngs[accepted],
+                            time=child_time,
+                            cost=costs,
+                            parent=np.full(len(accepted), current),
+                            heading=headings[accepted],
+                            key=keys[accepted],
+                            zoom=np.full(len(accepted), zoom),
+                            distance_to_finish=dist_finish[accepted],
+                            finish_bearing=finish_bearings[accepted])
+        for key, index, cost in zip(keys[accepted].tolist(), indices.tolist(), costs.tolist()):
+            if key not in explored:
+                if Config.debug:
+                    leaflet_points.add((nodes.lat[index], nodes.lng[index]))
+            else:
+                # A cheaper node replaces the one that claimed the cell
+                profile.count('repushes')
+            explored[key] = index
+            frontier.push((cost, index))
+        profile.count('pushes', len(accepted))
+        step += 1
 
-# TODO Fix discrepancy between user drawn time and optimal route
-# TODO fix heuristic
+    profile.outcome = metrics.NOT_FOUND
+    if Config.debug:
+        return list(leaflet_points), 'Frontier Empty or Steps exceeded'
+    if seed is not None:
+        return previous_route(seed, departure, polar, wind_field, stats)
+    if anytime:
+        return straight_to_finish(nodes, best_estimate_index, finish, departure, polar, wind_field, stats)
+    return [start], 'Frontier Empty or Steps exceeded'
@@ -0,0 +1,125 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import datetime
+import itertools
+import metrics
+from config import Config
+from route_cache import route_cache, snap_route
+from wind import get_wind_field, load_forecast
+
+
+def _warm_worker(forecast):
+    # Map the forecast and build the land mask once per pool process rather than in its first task.
+    # The forecast arrays are memory mapped sidecars so every process shares the same pages.
+    from landmask import CoastlineMissing, get_land_mask
+    # A forecast replaced and cleaned up since the batch was checked, or a missing coastline, fails each task
+    # instead of breaking the pool
+    with contextlib.suppress(FileNotFoundError):
+        load_forecast(*forecast)
+    with contextlib.suppress(CoastlineMissing):
+        get_land_mask()
+
+
+def route_task(algorithm, start, finish, departure, polar_path, timeout, forecast):
+    '''
+    Runs one search of the batch inside a pool process. Only the small request is pickled, never the wind.
+    :param forecast: Key of the WindField to route on, the one the batch was checked and cached against
+    :return: The route, the route time and the search stats, with the search profile under 'profile'
+    '''
+    from routers import ROUTERS
+    stats = {}
+    profile = metrics.Profile()
+    route, route_time = ROUTERS[algorithm](start, finish, departure=departure, stats=stats, timeout=timeout,
+                                           polar_path=polar_path, profile=profile,
+                                           wind_field=load_forecast(*forecast))
+    stats['profile'] = profile.as_dict()
+    return route, route_time, stats
+
+
+def batch_route(endpoints, departures=(0,), polars=None, algorithm=Config.algorithm, workers=Config.batch_workers,
+                timeout=Config.timeout, cache=route_cache, debug=False, wind_field=None):
+    '''
+    Routes every combination of endpoints, departure times and polars across a process pool.
+    :param endpoints: List of (start, finish) pairs of {'lat', 'lng'}
+    :param departures: Hours after the start of the forecast to leave at
+    :param polars: Dict of polar name to polar file, defaults to Config.polar_diagrams
+    :param algorithm: 'astar' or 'isochrone'
+    :param workers: Pool processes, each runs one search at a time
+    :param timeout: Seconds each search may run
+    :param debug: Include the profile of each search that was run
+    :param wind_field: The WindField to route on, defaults to the active forecast. Every search of the batch uses
+                       it, even when a newer forecast lands while they run.
+    :return: One row per combination ranked by arrival time within each pair of endpoints, routes not found last
+    '''
+    if polars is None:
+        polars = Config.polar_diagrams
+    if wind_field is None:
+        wind_field = get_wind_field()
+    forecast = wind_field.key
+    tasks = list(itertools.product(range(len(endpoints)), departures, polars.items()))
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_warm_worker, initargs=(forecast,)) as pool:
+        futures = {}
+        for task in tasks:
+            endpoint, departure, (polar_name, polar_path) = task
+            start, finish = endpoints[endpoint]
+            key = cache.key(forecast, algorithm, start, finish, departure=departure, polar_path=polar_path)
+            cached = cache.get(forecast, key)
+            if cached is not None:
+                results[task] = snap_route(cached, start, finish, departure=departure, polar_path=polar_path,
+                                           wind_field=wind_field)
+            else:
+                futures[task] = (key, pool.submit(route_task, algorithm, start, finish, departure, polar_path, timeout,
+                                                  forecast))
+        profiles = {}
+        for task, (key, future) in futures.items():
+            results[task] = future.result()
+            # Recorded here, the pool processes have their own registries
+            profiles[task] = results[task][2].pop('profile')
+            metrics.registry.record(algorithm, profiles[task])
+            if isinstance(results[task][1], datetime.timedelta):
+                cache.put(forecast, key, results[task])
+
+    rows = []
+    for task in tasks:
+        endpoint, departure, (polar_name, _) = task
+        route, route_time, stats = results[task]
+        found = isinstance(route_time, datetime.timedelta)
+        route_hours = route_time.total_seconds() / 3600 if found else None
+        rows.append({'endpoint': endpoint,
+                     'start': endpoints[endpoint][0],
+                     'finish': endpoints[endpoint][1],
+                     'departure': departure,
+                     'polar': polar_name,
+                     'route_hours': route_hours,
+                     'arrival_hours': departure + route_hours if found else None,
+                     'route_time': route_time,
+                     'route': route,
+                     'cached': stats.get('cached', False),
+                     # The search ran out of time and finished with a straight line
+                     'approximate': stats.get('approximate', False)})
+        if debug:
+            rows[-1]['profile'] = profiles.get(task)
+    # Earliest arrival first for each pair of endpoints
+    rows.sort(key=lambda row: (row['endpoint'], row['arrival_hours'] is None, row['arrival_hours'] or 0))
+    for endpoint, group in itertools.groupby(rows, key=lambda row: row['endpoint']):
+        for rank, row in enumerate(group, start=1):
+            row['rank'] = rank
+    return rows
@@ -0,0 +1,438 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Routing benchmarks on synthetic forecasts and a synthetic polar.
+
+    python benchmark.py --save baseline.json     # record a baseline
+    python benchmark.py --check baseline.json    # exits 1 when anything regressed against it
+
+Every run also validates the fast geodesy against pyproj and the grib downloader against a local stand-in for the
+NOMADS server, and exits 1 when either fails.
+'''
+
+import argparse
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+import xarray
+from config import Config
+
+# Benchmarks route on open water so the results never depend on a local coastline file
+Config.coastline_file = None
+Config.no_go_zones = []
+
+import download
+import geodesy
+import utils
+import wind
+from polar import get_polar
+from routers import ROUTERS
+
+# Start and finish pairs inside Config.extents
+PAIRS = {'sf_hawaii': ({'lat': 37.7, 'lng': -122.8}, {'lat': 20.0, 'lng': -155.05}),
+         'hawaii_seattle': ({'lat': 20.0, 'lng': -155.05}, {'lat': 48.5, 'lng': -125.10}),
+         'cabo_hawaii': ({'lat': 22.8, 'lng': -109.9}, {'lat': 20.0, 'lng': -155.05})}
+
+FORECAST_HOURS = range(0, 241, 6)
+
+
+def uniform_wind(lats, lngs, hour):
+    '''A steady 15 knot north westerly everywhere'''
+    return np.full(lats.shape, 15 * np.sin(np.radians(135))), np.full(lats.shape, 15 * np.cos(np.radians(135)))
+
+
+def rotating_wind(lats, lngs, hour):
+    '''A high pressure gyre drifting east, light in the middle and 18 knots at the edges'''
+    centre_lat, centre_lng = 35 + 3 * np.sin(hour / 40), -140 + hour / 12
+    dy = lats - centre_lat
+    dx = (lngs - centre_lng) * np.cos(np.radians(35))
+    radius = np.hypot(dx, dy) + 1e-6
+    speed = 4 + 14 * np.tanh(radius / 8)
+    return speed * dy / radius, -speed * dx / radius
+
+
+def frontal_wind(lats, lngs, hour):
+    '''A cold front moving east, 18 knot south westerlies ahead of it and 25 knot north westerlies behind'''
+    front = -165 + hour * 0.15 + (lats - 35) * 0.3
+    behind = 0.5 * (1 - np.tanh((lngs - front) / 1.5))
+    u = 18 * np.sin(np.radians(45)) * (1 - behind) + 25 * np.sin(np.radians(135)) * behind
+    v = 18 * np.cos(np.radians(45)) * (1 - behind) + 25 * np.cos(np.radians(135)) * behind
+    return u, v
+
+
+SCENARIOS = {'uniform': uniform_wind, 'rotating': rotating_wind, 'frontal': frontal_wind}
+
+
+def write_forecast(directory, wind_function, run='20300101.1p00'):
+    '''
+    Writes one netcdf per forecast hour on a 1 degree grid covering the extents, like the ingested gribs,
+    and stacks them into a forecast cube.
+    :param wind_function: Takes latitude and longitude grids and the forecast hour, returns u and v in knots
+    :param run: Start of the netcdf names, the date and grid or the date and ensemble member
+    :return: Path of the forecast cube
+    '''
+    max_extents, min_extents = Config.extents
+    lats = np.arange(np.ceil(max_extents['lat']) + 1, np.floor(min_extents['lat']) - 2, -1.0)
+    lngs = np.arange(np.floor(min_extents['lng']) - 1, np.ceil(max_extents['lng']) + 2, 1.0)
+    lng_grid, lat_grid = np.meshgrid(lngs, lats)
+    for hour in FORECAST_HOURS:
+        u, v = wind_function(lat_grid, lng_grid, hour)
+        ds = xarray.Dataset({'u10': (('latitude', 'longitude'), u), 'v10': (('latitude', 'longitude'), v)},
+                            coords={'latitude': lats, 'longitude': lngs, 'time': np.datetime64('2030-01-01'),
+                                    'step': np.timedelta64(hour, 'h')})
+        ds = ds.assign(speed=np.hypot(ds['u10'], ds['v10']))
+        ds = ds.assign(degree=wind.wind_degree(ds['u10'], ds['v10']))
+        ds.to_netcdf(os.path.join(directory, '{}.{:03d}.nc'.format(run, hour)))
+    return utils.create_forecast_cube(directory + os.sep)
+
+
+def write_ensemble(directory, wind_function, members=10, seed=0):
+    '''
+    Writes an ensemble of the forecast where each member but the control is shifted east or west by up to a few
+    degrees over the ten days, and stacks the members into an ensemble cube.
+    :return: Path of the ensemble cube
+    '''
+    shifts = np.concatenate([[0.], np.random.default_rng(seed).normal(0, 3, members - 1)])
+    for member, shift in enumerate(shifts):
+        name = 'gec00' if member == 0 else 'gep{:02d}'.format(member)
+        write_forecast(directory, lambda lats, lngs, hour, shift=shift: wind_function(lats, lngs + shift * hour / 240,
+                                                                                      hour),
+                       run='20300101{}{}'.format(wind.ENSEMBLE_TAG, name))
+    return utils.create_ensemble_cube(directory + os.sep)
+
+
+def write_polar(path):
+    '''
+    A smooth made up polar in the same format as the boat polars. Barely moving when pinching inside 35 degrees
+    of the wind so no route time runs away, fastest on a beam reach, and up to 14 knots of boat speed.
+    '''
+    angles = np.arange(0, 181)
+    wind_speeds = np.arange(0, 41)
+    shape = np.where(angles < 35, 0.1 * angles / 35, np.sin(np.radians(np.minimum(angles, 110) * 90 / 110)))
+    shape = shape * (1 - 0.25 * np.clip((angles - 110) / 70, 0, 1))
+    table = shape[:, np.newaxis] * np.minimum(0.8 * wind_speeds, 14)[np.newaxis, :]
+    with open(path, 'w') as outfile:
+        outfile.write(';'.join(['twa/tws'] + [str(speed) for speed in wind_speeds]) + '\n')
+        for angle, row in zip(angles, table):
+            outfile.write(';'.join([str(angle)] + ['{:.3f}'.format(speed) for speed in row]) + '\n')
+    return path
+
+
+def random_routes(count, seed=0):
+    '''Seeded routes of 2 to 20 legs heading roughly east across the extents'''
+    random = np.random.default_rng(seed)
+    routes = []
+    for _ in range(count):
+        lat, lng = random.uniform(25, 45), random.uniform(-160, -130)
+        route = [{'lat': lat, 'lng': lng}]
+        for _ in range(random.integers(2, 21)):
+            lat = float(np.clip(lat + random.uniform(-2, 2), 20, 50))
+            lng = float(lng + random.uniform(0, 3))
+            route.append({'lat': lat, 'lng': lng})
+        routes.append(route)
+    return routes
+
+
+def geodesy_samples(count, seed=0):
+    '''Seeded starts, whole degree headings and distances up to 400 km, and second points inside the extents'''
+    random = np.random.default_rng(seed)
+    max_extents, min_extents = Config.extents
+    lats, lngs = [random.uniform(min_extents[axis], max_extents[axis], (2, count)) for axis in ('lat', 'lng')]
+    return lngs[0], lats[0], random.integers(0, 360, count), random.uniform(0, 400e3, count), lngs[1], lats[1]
+
+
+def validate_geodesy(count=100000):
+    '''
+    Compares the fast geodesy with pyproj.
+    :return: Dict of the worst fwd position error as a fraction of the distance, the worst inv distance error as a
+             fraction of the distance and the worst azimuth errors in degrees, and a list of the bounds they exceed
+    '''
+    lngs, lats, headings, distances, lngs2, lats2 = geodesy_samples(count)
+    fast_lngs, fast_lats, fast_back = geodesy.fwd(lngs, lats, headings, distances, accuracy='fast')
+    exact_lngs, exact_lats, exact_back = geodesy.fwd(lngs, lats, headings, distances, accuracy='exact')
+    _, _, misses = Config.globe.inv(fast_lngs, fast_lats, exact_lngs, exact_lats)
+    fast = geodesy.inv(lngs, lats, lngs2, lats2, accuracy='fast')
+    exact = geodesy.inv(lngs, lats, lngs2, lats2, accuracy='exact')
+
+    def azimuth_error(a, b):
+        return float(np.abs((a - b + 180) % 360 - 180).max())
+
+    errors = {'fwd_position': float((misses / np.maximum(distances, 1)).max()),
+              'fwd_azimuth': azimuth_error(fast_back, exact_back),
+              'inv_distance': float((np.abs(fast[2] - exact[2]) / np.maximum(exact[2], 1)).max()),
+              'inv_azimuth': max(azimuth_error(fast[0], exact[0]), azimuth_error(fast[1], exact[1]))}
+    bounds = {'fwd_position': geodesy.FWD_TOLERANCE, 'fwd_azimuth': geodesy.AZIMUTH_TOLERANCE,
+              'inv_distance': geodesy.INV_TOLERANCE, 'inv_azimuth': geodesy.AZIMUTH_TOLERANCE}
+    failures = ['geodesy {} error {:.3g} is over its bound {:.3g}'.format(name, errors[name], bounds[name])
+                for name in errors if errors[name] > bounds[name]]
+    return errors, failures
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serves the server's files from memory with byte ranges the way NOMADS does. Names in the server's failures
+    answer 503 once, and names in its whole_files ignore the range and send the whole file.
+    '''
+
+    def do_GET(self):
+        name = self.path.lstrip('/')
+        byte_range = self.headers.get('Range')
+        self.server.requests.append((name, byte_range))
+        data = self.server.files.get(name)
+        if data is None:
+            self.send_error(404)
+            return
+        if name in self.server.failures:
+            self.server.failures.discard(name)
+            self.send_error(503)
+            return
+        start = int(byte_range.split('=')[1].rstrip('-')) if byte_range else 0
+        if byte_range is None or name in self.server.whole_files:
+            self.send_response(200)
+            start = 0
+        elif start >= len(data):
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        else:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+def validate_downloads(directory):
+    '''
+    Downloads from a local stand-in server. Covers resuming a .part file with a range request, a .part file that
+    is already complete (416), a server that ignores the range (200) and a failed request that is retried.
+    :return: List of the checks that failed
+    '''
+    random = np.random.default_rng(0)
+    files = {name: random.bytes(300000) for name in ('resume', 'complete', 'whole', 'retry')}
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.files, server.requests, server.failures, server.whole_files = files, [], {'retry'}, {'whole'}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    out = os.path.join(directory, 'downloads')
+    os.makedirs(out)
+    parts = {'resume': files['resume'][:100000], 'complete': files['complete'], 'whole': files['whole'][:100000]}
+    for name, data in parts.items():
+        with open(os.path.join(out, name + download.PART_SUFFIX), 'wb') as outfile:
+            outfile.write(data)
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    try:
+        downloader = download.Downloader(workers=2, interval=0, retries=1, timeout=10)
+        done, errors = downloader.download_all([(url + name, os.path.join(out, name)) for name in files])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    failures = ['download of {} failed: {}'.format(os.path.basename(path), error) for path, error in errors.items()]
+    for name, data in files.items():
+        path = os.path.join(out, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as infile:
+                if infile.read() != data:
+                    failures.append('download of {} does not match what was served'.format(name))
+        if os.path.exists(path + download.PART_SUFFIX):
+            failures.append('download of {} left its {} file behind'.format(name, download.PART_SUFFIX))
+    if ('resume', 'bytes=100000-') not in server.requests:
+        failures.append('download of resume did not ask for the rest of its {} file'.format(download.PART_SUFFIX))
+    if [name for name, _ in server.requests].count('retry') != 2:
+        failures.append('download of retry was not retried once after its 503')
+    return failures
+
+
+def measure(function, repeat):
+    '''
+    Best wall time of repeat calls, then one more call under tracemalloc for the peak memory.
+    :return: Seconds, peak megabytes and the result of the last call
+    '''
+    seconds = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    result = function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / 2 ** 20, result
+
+
+def run_benchmarks(directory, repeat=1, only=None):
+    '''
+    Runs every benchmark whose name contains only.
+    :return: Dict of benchmark name to seconds, peak_mb, nodes, result and the unit of the result
+    '''
+    polar_path = write_polar(os.path.join(directory, 'synthetic_polar.txt'))
+    results = {}
+
+    def record(name, function, nodes=None, eta=None, unit='h'):
+        # eta reduces the result to the number compared with the baseline, hours for route times
+        if only is not None and only not in name:
+            return
+        seconds, peak_mb, result = measure(function, repeat)
+        results[name] = {'seconds': seconds, 'peak_mb': peak_mb, 'nodes': nodes(result) if nodes else None,
+                         'result': eta(result) if eta else None, 'unit': unit}
+        print('{:<40} {:>8.3f}s {:>8.1f}MB {:>8} nodes {:>9} {}'.format(
+            name, seconds, peak_mb, str(results[name]['nodes']),
+            'none' if results[name]['result'] is None else '{:.2f}'.format(results[name]['result']), unit), flush=True)
+
+    def route_hours(result):
+        route_time = result[1]
+        return route_time.total_seconds() / 3600 if hasattr(route_time, 'total_seconds') else None
+
+    twa, tws = np.random.default_rng(0).uniform(0, 180, 10 ** 6), np.random.default_rng(1).uniform(0, 40, 10 ** 6)
+    record('boat_speed', lambda: utils.get_boat_speed(twa, tws, polar=get_polar(polar_path)),
+           eta=lambda speeds: float(np.mean(speeds)), unit='kn')
+
+    samples = geodesy_samples(10 ** 5)
+    for accuracy in ('fast', 'exact'):
+        record('geodesy_fwd/{}'.format(accuracy), lambda accuracy=accuracy: geodesy.fwd(*samples[:4], accuracy=accuracy),
+               eta=lambda result: float(np.mean(result[1])), unit='deg')
+        record('geodesy_inv/{}'.format(accuracy), lambda accuracy=accuracy: geodesy.inv(*samples[:2], *samples[4:],
+                                                                                         accuracy=accuracy),
+               eta=lambda result: float(np.mean(result[2]) / 1852), unit='nm')
+
+    # Random routes often have a leg close to dead upwind, the medians of their times are compared rather than the means
+    routes = random_routes(200)
+    for scenario, wind_function in SCENARIOS.items():
+        scenario_dir = os.path.join(directory, scenario)
+        os.makedirs(scenario_dir)
+        write_forecast(scenario_dir, wind_function)
+        # Every router samples the active forecast through the module wide manager
+        wind.wind_fields = wind.WindFieldManager(scenario_dir)
+        polar = get_polar(polar_path)
+        for pair, (start, finish) in PAIRS.items():
+            for algorithm, router in ROUTERS.items():
+                stats = {}
+
+                def search(router=router, start=start, finish=finish, stats=stats):
+                    stats.clear()
+                    return router(start, finish, stats=stats, polar_path=polar_path)
+
+                record('{}/{}/{}'.format(algorithm, scenario, pair), search,
+                       nodes=lambda result, stats=stats: stats.get('nodes_expanded'), eta=route_hours)
+        record('get_route_time/{}'.format(scenario),
+               lambda: [utils.get_route_time([route], polar=polar) for route in routes[:50]],
+               eta=lambda times: float(np.median([route_time.total_seconds() / 3600 for route_time in times])))
+        record('evaluate_routes/{}'.format(scenario), lambda: utils.evaluate_routes(routes, polar=polar),
+               eta=lambda hours: float(np.median(hours)))
+
+    # Every route timed in every member at once, against timing each member on its own
+    ensemble_dir = os.path.join(directory, 'ensemble')
+    os.makedirs(ensemble_dir)
+    ensemble = wind.load_wind_field(write_ensemble(ensemble_dir, frontal_wind))
+    polar = get_polar(polar_path)
+    record('evaluate_ensemble/frontal', lambda: utils.evaluate_ensemble(routes, polar=polar, ensemble=ensemble),
+           eta=lambda hours: float(np.median(hours)))
+    record('evaluate_members/frontal',
+           lambda: [utils.evaluate_routes(routes, polar=polar, wind_field=ensemble.member_field(member))
+                    for member in range(len(ensemble))],
+           eta=lambda hours: float(np.median(hours)))
+    return results
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance, eta_tolerance):
+    '''
+    Compares results with a saved baseline. Benchmarks missing from either side are skipped.
+    :return: List of regression messages, empty when nothing regressed
+    '''
+    regressions = []
+    for name, base in baseline.items():
+        result = results.get(name)
+        if result is None:
+            continue
+        # Small absolute allowances keep the fastest benchmarks from failing on timer noise
+        if result['seconds'] > base['seconds'] * (1 + time_tolerance) + 0.01:
+            regressions.append('{} took {:.3f}s, baseline {:.3f}s'.format(name, result['seconds'], base['seconds']))
+        if result['peak_mb'] > base['peak_mb'] * (1 + memory_tolerance) + 0.5:
+            regressions.append('{} peaked at {:.1f}MB, baseline {:.1f}MB'.format(name, result['peak_mb'], base['peak_mb']))
+        if base['nodes'] is not None and result['nodes'] is not None and \
+                result['nodes'] > base['nodes'] * (1 + time_tolerance):
+            regressions.append('{} expanded {} nodes, baseline {}'.format(name, result['nodes'], base['nodes']))
+        if base['result'] is not None:
+            unit = base.get('unit', 'h')
+            if result['result'] is None:
+                regressions.append('{} found no route, baseline {:.2f} {}'.format(name, base['result'], unit))
+            elif abs(result['result'] - base['result']) > abs(base['result']) * eta_tolerance:
+                regressions.append('{} result {:.2f} {}, baseline {:.2f} {}'.format(name, result['result'], unit,
+                                                                                 base['result'], unit))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Routing benchmarks on synthetic forecasts.')
+    parser.add_argument('--save', help='Write the results as a baseline to this json file')
+    parser.add_argument('--check', help='Compare the results with this baseline and exit 1 on a regression')
+    parser.add_argument('--repeat', type=int, default=1, help='Timed runs of each benchmark, the best one counts')
+    parser.add_argument('--only', help='Only run benchmarks whose name contains this')
+    parser.add_argument('--time-tolerance', type=float, default=0.5,
+                        help='Fraction slower, or more nodes, than the baseline that still passes')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25,
+                        help='Fraction more peak memory than the baseline that still passes')
+    parser.add_argument('--eta-tolerance', type=float, default=0.01,
+                        help='Fraction a route time or result may differ from the baseline')
+    parser.add_argument('--keep', action='store_true', help='Keep the synthetic forecasts')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='weather-router-benchmark-')
+    try:
+        results = run_benchmarks(directory, repeat=args.repeat, only=args.only)
+        download_failures = validate_downloads(directory)
+    finally:
+        if args.keep:
+            print('Synthetic forecasts kept in', directory)
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    errors, failures = validate_geodesy()
+    print('Fast geodesy against pyproj: ' + ', '.join('{} {:.3g}'.format(name, error) for name, error in errors.items()))
+    print('Downloads from a local stand-in server: {}'.format('failed' if download_failures else 'ok'))
+    failures += download_failures
+    for failure in failures:
+        print('FAILED', failure)
+
+    if args.save:
+        with open(args.save, 'w') as outfile:
+            json.dump(results, outfile, indent=4, sort_keys=True)
+    if args.check:
+        with open(args.check, 'r') as infile:
+            baseline = json.load(infile)
+        regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance, args.eta_tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            return 1
+        print('No regressions against', args.check)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
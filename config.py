@@ -17,6 +17,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from pyproj import Geod
 import os
+import tempfile
 
 class Config(object):
     # Prints some useful debugging messages to Terminal
@@ -25,19 +26,150 @@ class Config(object):
 
     # Optimal route timeout
     timeout = 25
+    # Routes requested without a departure leave now, rounded to this many hours so requests a few minutes apart
+    # share cached routes and jobs
+    departure_step = 0.5
+    # Anytime searches. A search that runs out of time or steps returns the route to the point with the earliest
+    # estimated arrival, finished with a straight line to the finish and flagged approximate.
+    anytime = True
+
+    # Routing jobs. Pool processes, seconds each search may run, finished jobs remembered
+    # and the number of A* expansions between progress reports
+    job_workers = 2
+    job_timeout = 120
+    job_history = 100
+    progress_interval = 100
+    # Directory the jobs are kept in, shared by every web worker on the machine
+    job_dir = os.path.join(tempfile.gettempdir(), 'weather-router-jobs')
+    # Seconds between progress events on a job stream, and seconds before a stream closes and the browser
+    # reconnects so no thread is held for the whole search
+    job_stream_interval = 0.5
+    job_stream_seconds = 30
+
+    # Batch routing over departures, polars and endpoints. Pool processes, one search each at a time.
+    batch_workers = os.cpu_count()
+
+    # Search profiling. Expansions between samples of the frontier size and the upper bounds in seconds
+    # of the search duration histogram served on /metrics
+    metrics_frontier_interval = 100
+    metrics_buckets = (0.1, 0.5, 1, 2.5, 5, 10, 25, 60, 120)
+
+    # Re-planning routes on a new forecast. Knots the wind has to change by along a leg before it is searched again,
+    # hours of unchanged legs given back before the first change, and the slippy map zoom and spacing in nautical miles
+    # of the corridor of cells along the old route. Nodes outside the corridor wait this many more hours to be expanded.
+    replan_wind_change = 3
+    replan_margin_hours = 12
+    replan_corridor_zoom = 7
+    replan_corridor_step = 10
+    replan_corridor_penalty = 3
+
+    # Optimal route cache. Most routes kept in memory and the directory they are also saved to,
+    # None keeps them in memory only
+    route_cache_size = 256
+    route_cache_dir = None
+
+    # Default optimal route algorithm, 'astar' or 'isochrone'
+    algorithm = 'astar'
+
+    # A* node ordering. 'astar' finds the fastest route, 'greedy' heads for the finish by vmg
+    astar_mode = 'astar'
+    # A* search grid. Hours sailed from each node, shortened where the wind changes by more than
+    # astar_max_wind_change of its speed over a step and on the final approach so that about
+    # astar_approach_steps are left. Grid cells are slippy map tiles about astar_cell_fraction of a step wide,
+    # between the two zooms.
+    astar_max_hours = 12
+    astar_min_hours = 1
+    astar_approach_steps = 2
+    astar_max_wind_change = 1.0
+    astar_cell_fraction = 0.25
+    astar_min_zoom = 7
+    astar_max_zoom = 13
+    # Weight on the A* heuristic. 1 keeps the heuristic admissible so the fastest route is found. Larger weights
+    # trade time for speed, expanding far fewer nodes for a route no more than weight times slower, and can be
+    # asked for per request. The route stats report the actual gap.
+    astar_heuristic_weight = 1.0
 
     # This is the mapping extent NorthEast Corner, SouthWest Corner
     extents = { 'lat': 52.56928286558243, 'lng': -95.88867187500001 }, { 'lat': 17.26672782352052, 'lng': -177.09960937500003 }
 
+    # Forecast hours downloaded for each run, every 6 hours for 10 days
+    forecast_hours = range(0, 241, 6)
+
+    # How wind is sampled from the forecast grid, 'nearest' or 'bilinear'
+    wind_sampling = 'bilinear'
+
+    # Isochrone router. Hours per isochrone, width of the bearing sectors kept on each isochrone,
+    # spacing of the headings sailed from each point and the half angle of the cone towards the finish
+    isochrone_hours_of_travel = 3
+    isochrone_sector_size = 1
+    isochrone_heading_step = 5
+    isochrone_cone = 90
+
+    # Grib downloads. URL template filled in with date, deg, hour, cycle, left_lon, right_lon, top_lat and
+    # bottom_lat, point it at a local server to test. Concurrent connections, minimum seconds between
+    # requests across all of them, retries per file and seconds before a stalled connection gives up.
+    grib_url = 'https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_{deg}.pl?file=gfs.t{cycle}z.pgrb2.{deg}.f{hour:03d}' \
+               '&lev_10_m_above_ground=on&var_UGRD=on&var_VGRD=on&leftlon={left_lon}&rightlon={right_lon}' \
+               '&toplat={top_lat}&bottomlat={bottom_lat}&dir=%2Fgfs.{date}%2F{cycle}%2Fatmos'
+    download_workers = 3
+    download_interval = 0.5
+    download_retries = 3
+    download_timeout = 60
+
+    # GEFS ensemble members downloaded with each run, gec00 is the control and gep01 to gep30 the perturbed members.
+    # None routes on the deterministic forecast alone. The URL template also takes the member.
+    ensemble_members = None
+    ensemble_url = 'https://nomads.ncep.noaa.gov/cgi-bin/filter_gefs_atmos_0p50a.pl?file={member}.t{cycle}z.pgrb2a.0p50.' \
+                   'f{hour:03d}&lev_10_m_above_ground=on&var_UGRD=on&var_VGRD=on&subregion=&leftlon={left_lon}' \
+                   '&rightlon={right_lon}&toplat={top_lat}&bottomlat={bottom_lat}' \
+                   '&dir=%2Fgefs.{date}%2F{cycle}%2Fatmos%2Fpgrb2ap5'
+    # Ensemble routing. Percentile of the member arrival times the most robust route keeps lowest,
+    # and pool processes routing the members
+    ensemble_percentile = 90
+    ensemble_workers = os.cpu_count()
+
+    # Processes converting gribs to netcdf
+    ingest_workers = 4
+
+    # Warm up each web worker on a background thread as it starts, loading the polars, land mask and forecast
+    # before the first request needs them. Until the first forecast has been ingested the warm-up checks for it
+    # this many seconds apart, and /ready and the requests that need it answer 503 with it in Retry-After.
+    warmup = True
+    warmup_retry = 10
+
+    # Route timing. Long legs are split into sub-segments this many wind grid cells long, None times each
+    # leg with the wind at its start. Most sub-segments any one leg is split into, and the hours the
+    # sub-segment start times may still be moving by when the route time is accepted.
+    route_resolution = 0.5
+    route_max_subsegments = 64
+    route_time_tolerance = 0.01
+
+    # Wind barbs. Map zoom showing every forecast grid point, zoomed out views keep every 2nd, 4th... point,
+    # and the knots per step speeds are quantized to
+    wind_detail_zoom = 6
+    wind_speed_step = 0.5
+
+    # Land and no go zones. GeoJSON of land polygons rasterized onto a grid of this many degrees, see readme.md
+    # for where to get it. Routing fails while the file is missing, None routes without a coastline.
+    # No go zones are lists of {'lat', 'lng'} points.
+    coastline_file = './static/data/coastline/land.geojson'
+    landmask_resolution = 0.02
+    no_go_zones = []
+
     # Minimum boat speed. Simulates boat speed when there is no wind.
     motoring_speed = .0001
 
     # Directory References
     netcdf_dir = './static/data/netcdf/'
     grib_dir = './static/data/gribs/'
-    json_dir = './static/data/json/'
     proj_dir = os.path.dirname(os.path.abspath(__file__))
-    polar_diagram = './static/data/boat_polars/volvo65.txt'
+    polar_dir = './static/data/boat_polars/'
+    polar_diagram = polar_dir + 'volvo65.txt'
+    # Boat polars available for routing
+    polar_diagrams = {'volvo65': polar_dir + 'volvo65.txt', 'class40': polar_dir + 'class40.txt'}
 
     # Used for geodesic calculations such as distances and headings
-    globe = Geod(ellps='clrk66')  # Use Clarke 1866 ellipsoid.
\ No newline at end of file
+    globe = Geod(ellps='clrk66')  # Use Clarke 1866 ellipsoid.
+    # Geodesic calculations of the routers, 'fast' approximations of the ellipsoid good to a tenth of a percent
+    # over a time step, or 'exact' for pyproj on every node. Routes are always timed with pyproj.
+    geodesy = 'fast'
\ No newline at end of file
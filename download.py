@@ -0,0 +1,198 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from config import Config
+
+DEG = {.25: '0p25', .5: '0p50', 1: '1p00'}
+# Suffix of a file that is still downloading, only complete files are renamed to .grib2
+PART_SUFFIX = '.part'
+
+
+class DownloadError(Exception):
+    pass
+
+
+def grib_name(YYYYMMDD, degrees, forecast_hour):
+    return '{}.{}.{:03d}.grib2'.format(YYYYMMDD, DEG[degrees], forecast_hour)
+
+
+def ensemble_grib_name(YYYYMMDD, member, forecast_hour):
+    return '{}.gefs.{}.{:03d}.grib2'.format(YYYYMMDD, member, forecast_hour)
+
+
+def ensemble_grib_url(YYYYMMDD, member, forecast_hour, cycle='00', left_lon=0, right_lon=360, top_lat=90,
+                      bottom_lat=-90, url=Config.ensemble_url):
+    '''Fills in the Config.ensemble_url template for one member and forecast hour'''
+    return url.format(date=YYYYMMDD, member=member, hour=forecast_hour, cycle=cycle, left_lon=left_lon,
+                      right_lon=right_lon, top_lat=top_lat, bottom_lat=bottom_lat)
+
+
+def grib_url(YYYYMMDD, degrees, forecast_hour, cycle='00', left_lon=0, right_lon=360, top_lat=90, bottom_lat=-90,
+             url=Config.grib_url):
+    '''Fills in the Config.grib_url template for one forecast hour'''
+    return url.format(date=YYYYMMDD, deg=DEG[degrees], hour=forecast_hour, cycle=cycle, left_lon=left_lon,
+                      right_lon=right_lon, top_lat=top_lat, bottom_lat=bottom_lat)
+
+
+class Downloader:
+    '''
+    Streams files to disk over a small pool of connections sharing one session.
+    Interrupted downloads are kept as .part files and resumed with a byte range request.
+    Requests are spaced at least interval seconds apart across the whole pool so the server is not hammered.
+    '''
+
+    def __init__(self, workers=Config.download_workers, interval=Config.download_interval,
+                 retries=Config.download_retries, timeout=Config.download_timeout, session=None):
+        self.workers = workers
+        self.interval = interval
+        self.retries = retries
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_maxsize=workers))
+            session.mount('https://', HTTPAdapter(pool_maxsize=workers))
+            session.headers['User-Agent'] = 'weather-router'
+        self.session = session
+        self._next_request = 0.
+        self._lock = threading.Lock()
+
+    def _wait_turn(self):
+        # Reserve the next request slot and sleep until it comes round
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_request)
+            self._next_request = start + self.interval
+        time.sleep(start - now)
+
+    def _fetch(self, url, path):
+        part_path = path + PART_SUFFIX
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else {}
+        self._wait_turn()
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code == 416:
+                # Nothing left past the end of the part file, it is already complete
+                os.replace(part_path, path)
+                return
+            r.raise_for_status()
+            if r.status_code == 206:
+                expected = int(r.headers['Content-Range'].rsplit('/', 1)[1])
+                mode = 'ab'
+            else:
+                # The server ignored the range, start again from the beginning
+                expected = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+                offset = 0
+                mode = 'wb'
+            with open(part_path, mode) as outfile:
+                for block in r.iter_content(chunk_size=1 << 16):
+                    outfile.write(block)
+        size = os.path.getsize(part_path)
+        if expected is not None and size != expected:
+            raise DownloadError('{} is {} bytes, expected {}'.format(part_path, size, expected))
+        os.replace(part_path, path)
+
+    def download(self, url, path):
+        '''
+        Downloads url to path unless path already exists, retrying with backoff and resuming partial downloads.
+        :return: path
+        '''
+        if os.path.exists(path):
+            return path
+        for attempt in range(self.retries + 1):
+            try:
+                self._fetch(url, path)
+                return path
+            except (requests.RequestException, DownloadError) as e:
+                if attempt == self.retries:
+                    raise
+                print('Retrying {}: {}'.format(os.path.basename(path), e))
+                time.sleep(2 ** attempt)
+
+    def download_all(self, urls_paths):
+        '''
+        Downloads (url, path) pairs concurrently.
+        :return: Paths that downloaded and a dict of path to the error for those that did not
+        '''
+        done, failed = [], {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {path: pool.submit(self.download, url, path) for url, path in urls_paths}
+            for path, future in futures.items():
+                try:
+                    done.append(future.result())
+                except Exception as e:
+                    failed[path] = e
+        return done, failed
+
+
+def previous_run():
+    # Hacky way to make sure there is a forecast available
+    previous_day = datetime.now(timezone.utc).date() - timedelta(days=1)
+    return previous_day.strftime('%Y%m%d')
+
+
+def download_forecast(degrees=1, left_lon=0, right_lon=360, top_lat=90, bottom_lat=-90, YYYYMMDD='',
+                      forecast_hours=Config.forecast_hours, grib_dir=Config.grib_dir, downloader=None):
+    '''
+    Gets u-10 and v-10 wind grib data from NOAA. https://www.nco.ncep.noaa.gov/pmb/products/gfs/
+    :params: YYYYMMDD is the Year, Month and Day, defaults to yesterday so the whole run is available
+    :params: forecast_hours are the hours after the forecast conception to download
+    :return: Paths of the downloaded gribs
+    '''
+    if len(YYYYMMDD) == 0:
+        YYYYMMDD = previous_run()
+    if downloader is None:
+        downloader = Downloader()
+    # CC is the model cycle runtime (i.e. 00, 06, 12, 18) just using the first one as this doesn't really matter for simulation purposes
+    urls_paths = [(grib_url(YYYYMMDD, degrees, hour, left_lon=left_lon, right_lon=right_lon, top_lat=top_lat,
+                            bottom_lat=bottom_lat),
+                   os.path.join(grib_dir, grib_name(YYYYMMDD, degrees, hour))) for hour in forecast_hours]
+    done, failed = downloader.download_all(urls_paths)
+    for path, error in failed.items():
+        print('Could not download {}: {}'.format(os.path.basename(path), error))
+    return done
+
+
+def download_ensemble(members=Config.ensemble_members, left_lon=0, right_lon=360, top_lat=90, bottom_lat=-90,
+                      YYYYMMDD='', forecast_hours=Config.forecast_hours, grib_dir=Config.grib_dir, downloader=None):
+    '''
+    Gets u-10 and v-10 wind gribs of GEFS ensemble members from NOAA. https://www.nco.ncep.noaa.gov/pmb/products/gens/
+    :params: members are the member names, such as gec00 and gep01
+    :return: Paths of the downloaded gribs
+    '''
+    if len(YYYYMMDD) == 0:
+        YYYYMMDD = previous_run()
+    if downloader is None:
+        downloader = Downloader()
+    urls_paths = [(ensemble_grib_url(YYYYMMDD, member, hour, left_lon=left_lon, right_lon=right_lon, top_lat=top_lat,
+                                     bottom_lat=bottom_lat),
+                   os.path.join(grib_dir, ensemble_grib_name(YYYYMMDD, member, hour)))
+                  for member in members for hour in forecast_hours]
+    done, failed = downloader.download_all(urls_paths)
+    for path, error in failed.items():
+        print('Could not download {}: {}'.format(os.path.basename(path), error))
+    return done
+
+
+if __name__ == '__main__':
+    print('Downloaded {} gribs'.format(len(download_forecast())))
@@ -0,0 +1,144 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import datetime
+import numpy as np
+import metrics
+import utils
+from config import Config
+from polar import get_polar
+from wind import get_ensemble_field, load_forecast
+
+
+def _warm_worker(ensemble):
+    # Map the ensemble and build the land mask once per pool process, every member shares them
+    from landmask import CoastlineMissing, get_land_mask
+    # An ensemble replaced and cleaned up since the request was checked, or a missing coastline, fails each member
+    # instead of breaking the pool
+    with contextlib.suppress(FileNotFoundError):
+        load_forecast(*ensemble)
+    with contextlib.suppress(CoastlineMissing):
+        get_land_mask()
+
+
+def member_route_task(algorithm, start, finish, departure, polar_path, timeout, ensemble, member):
+    '''
+    Routes one ensemble member inside a pool process.
+    :param ensemble: Key of the EnsembleField, the one every member and the ETAs are timed in
+    :param member: Index of the member in the ensemble
+    :return: The route, the route time and the search stats, with the search profile under 'profile'
+    '''
+    from routers import ROUTERS
+    stats = {}
+    profile = metrics.Profile()
+    route, route_time = ROUTERS[algorithm](start, finish, departure=departure, stats=stats, timeout=timeout,
+                                           polar_path=polar_path, profile=profile,
+                                           wind_field=load_forecast(*ensemble).member_field(member))
+    stats['profile'] = profile.as_dict()
+    return route, route_time, stats
+
+
+def eta_summary(hours, percentile=Config.ensemble_percentile):
+    '''
+    Distribution of the hours a route takes across the members.
+    :param hours: Route hours in each member
+    :return: Dict of the mean, spread and percentiles, and the hours of every member
+    '''
+    hours = np.asarray(hours, dtype=float)
+    return {'mean': float(hours.mean()),
+            'std': float(hours.std()),
+            'min': float(hours.min()),
+            'p10': float(np.percentile(hours, 10)),
+            'median': float(np.median(hours)),
+            'p90': float(np.percentile(hours, 90)),
+            'max': float(hours.max()),
+            'percentile': float(np.percentile(hours, percentile)),
+            'members': hours.tolist()}
+
+
+def ensemble_eta(routes, departure=0, polar_path=Config.polar_diagram, ensemble=None,
+                 percentile=Config.ensemble_percentile):
+    '''
+    ETA distributions of fixed routes, every route timed in every member at once with evaluate_ensemble.
+    Legs are densified like the routes the searches return, see utils.time_found_route.
+    :param routes: List of routes, each a list of {'lat', 'lng'} points
+    :param ensemble: The EnsembleField, defaults to the latest ensemble
+    :return: One eta_summary per route
+    '''
+    if ensemble is None:
+        ensemble = get_ensemble_field()
+    hours = utils.evaluate_ensemble(routes, departure=departure, polar=get_polar(polar_path), ensemble=ensemble)
+    return [eta_summary(hours[:, i], percentile) for i in range(len(routes))]
+
+
+def ensemble_route(start, finish, departure=0, algorithm=Config.algorithm, polar_path=Config.polar_diagram,
+                   timeout=Config.timeout, workers=Config.ensemble_workers, routes=(), deterministic=True,
+                   percentile=Config.ensemble_percentile, debug=False, ensemble=None):
+    '''
+    Finds the route that holds up best across an ensemble. The optimal route of every member, and of the
+    deterministic forecast, is timed in every member and the candidate with the lowest percentile arrival wins.
+    The members are routed across a process pool sharing the memory mapped ensemble, the polar and the land mask.
+    :param start: {'lat', 'lng'} of the start
+    :param finish: {'lat', 'lng'} of the finish
+    :param departure: Hours after the start of the ensemble forecast the boat leaves
+    :param algorithm: 'astar' or 'isochrone'
+    :param timeout: Seconds each search may run
+    :param workers: Pool processes, each routes one member at a time
+    :param routes: Other candidate routes to compare, such as the route the boat is already sailing
+    :param deterministic: Also route on the deterministic forecast
+    :param percentile: Percentile of the member arrival times the robust route keeps lowest
+    :param debug: Include the profile of each member search
+    :param ensemble: The EnsembleField, defaults to the latest ensemble. Every member is routed on it, even when a
+                     newer ensemble lands while they run.
+    :return: Dict of the member names, the candidates with their ETA distributions and the index of the robust one
+    '''
+    if ensemble is None:
+        ensemble = get_ensemble_field()
+    candidates = [{'source': 'route', 'route': route} for route in routes]
+    if deterministic:
+        from routers import ROUTERS
+        stats = {}
+        try:
+            route, route_time = ROUTERS[algorithm](start, finish, departure=departure, stats=stats, timeout=timeout,
+                                                   polar_path=polar_path)
+        except FileNotFoundError:
+            # There is only an ensemble to route on
+            route_time = None
+        if isinstance(route_time, datetime.timedelta):
+            candidates.append({'source': 'deterministic', 'route': route, 'stats': stats})
+    with ProcessPoolExecutor(max_workers=workers, initializer=_warm_worker, initargs=(ensemble.key,)) as pool:
+        futures = [pool.submit(member_route_task, algorithm, start, finish, departure, polar_path, timeout,
+                               ensemble.key, member) for member in range(len(ensemble))]
+        for name, future in zip(ensemble.members, futures):
+            route, route_time, stats = future.result()
+            profile = stats.pop('profile')
+            metrics.registry.record('ensemble', profile)
+            if isinstance(route_time, datetime.timedelta):
+                candidates.append({'source': name, 'route': route, 'stats': stats})
+                if debug:
+                    candidates[-1]['profile'] = profile
+    if len(candidates) == 0:
+        return {'members': ensemble.members, 'candidates': [], 'robust': None}
+    etas = ensemble_eta([candidate['route'] for candidate in candidates], departure=departure, polar_path=polar_path,
+                        ensemble=ensemble, percentile=percentile)
+    for candidate, eta in zip(candidates, etas):
+        candidate['eta'] = eta
+    # Lowest percentile arrival, the mean breaks ties
+    robust = min(range(len(candidates)), key=lambda i: (etas[i]['percentile'], etas[i]['mean']))
+    return {'members': ensemble.members, 'candidates': candidates, 'robust': robust}
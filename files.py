@@ -0,0 +1,46 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import contextlib
+import os
+import tempfile
+
+
+def atomic_write(path, writer, mode='wb'):
+    '''
+    Writes a file to a temporary file next to path and renames it into place, so readers in other threads and
+    processes never see half of one. The temporary file is removed when writing fails.
+    :param path: The file to write
+    :param writer: Called with the temporary file opened in mode, or with its path when mode is None for writers
+                   such as xarray that open the file themselves
+    :param mode: Mode the temporary file is opened in
+    :return: path
+    '''
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        if mode is None:
+            os.close(handle)
+            writer(temp_path)
+        else:
+            with os.fdopen(handle, mode) as outfile:
+                writer(outfile)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+    return path
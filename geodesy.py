@@ -0,0 +1,132 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import numpy as np
+from config import Config
+
+# The ellipsoid of Config.globe, semi major axis in meters, flattening and eccentricity squared
+A = Config.globe.a
+F = Config.globe.f
+E2 = F * (2 - F)
+
+# Sine and cosine of every whole degree heading, the routers only ever steer whole degrees
+_HEADINGS = np.radians(np.arange(360))
+_SIN = np.sin(_HEADINGS)
+_COS = np.cos(_HEADINGS)
+
+# Worst errors of the fast calculations against pyproj inside the map extents, checked by benchmark.py.
+# Positions from fwd are within FWD_TOLERANCE of the distance sailed up to 400 km, distances from inv within
+# INV_TOLERANCE of the distance, and azimuths within AZIMUTH_TOLERANCE degrees, a fraction of the whole degree
+# headings the routers steer.
+FWD_TOLERANCE = 1e-3
+INV_TOLERANCE = 1e-4
+AZIMUTH_TOLERANCE = 0.2
+
+
+def _heading_trig(azimuths):
+    '''Sine and cosine of azimuths in degrees, looked up for whole degrees'''
+    azimuths = np.asarray(azimuths)
+    if azimuths.dtype.kind in 'iu':
+        index = azimuths % 360
+        return _SIN[index], _COS[index]
+    radians = np.radians(azimuths)
+    return np.sin(radians), np.cos(radians)
+
+
+def _radii(latitude):
+    '''Meridional and prime vertical radii of curvature in meters at latitudes in radians'''
+    w2 = 1 - E2 * np.sin(latitude) ** 2
+    w = np.sqrt(w2)
+    return A * (1 - E2) / (w2 * w), A / w
+
+
+def _wrap(degrees):
+    return (degrees + 180) % 360 - 180
+
+
+def fwd(lons, lats, az, dist, accuracy=None):
+    '''
+    Positions reached sailing a distance along a geodesic, like Geod.fwd and broadcast over the arguments.
+    The fast calculation steps across the local tangent plane with the latitude, radii of curvature and azimuth
+    taken half way along, found by two passes of the midpoint rule. Its error grows with the cube of the distance.
+    :param lons: Longitudes of the starts in degrees
+    :param lats: Latitudes of the starts in degrees
+    :param az: Azimuths in degrees, whole degrees given as integers are looked up rather than calculated
+    :param dist: Distances in meters
+    :param accuracy: 'fast' or 'exact' for pyproj, defaults to Config.geodesy
+    :return: Longitudes, latitudes and back azimuths of the ends
+    '''
+    if (accuracy or Config.geodesy) == 'exact':
+        lons, lats, az, dist = (np.array(value, dtype=float) for value in np.broadcast_arrays(lons, lats, az, dist))
+        return Config.globe.fwd(lons, lats, az, dist)
+    latitude = np.radians(lats)
+    dist = np.asarray(dist, dtype=float)
+    sin_az, cos_az = _heading_trig(az)
+    sin_mid, cos_mid = sin_az, cos_az
+    half_turn = 0.
+    for _ in range(2):
+        meridian, _ = _radii(latitude)
+        mid_latitude = latitude + dist * cos_mid / (2 * meridian)
+        meridian, normal = _radii(mid_latitude)
+        # Meridians converge, so a geodesic that heads east or west turns towards the equator as it goes
+        half_turn = dist * sin_mid * np.tan(mid_latitude) / (2 * normal)
+        sin_turn, cos_turn = np.sin(half_turn), np.cos(half_turn)
+        sin_mid, cos_mid = sin_az * cos_turn + cos_az * sin_turn, cos_az * cos_turn - sin_az * sin_turn
+    d_latitude = dist * cos_mid / meridian
+    mid_latitude = latitude + d_latitude / 2
+    d_longitude = dist * sin_mid / (normal * np.cos(mid_latitude))
+    back_azimuth = _wrap(np.asarray(az, dtype=float) + np.degrees(2 * half_turn) + 180)
+    return _wrap(lons + np.degrees(d_longitude)), np.degrees(latitude + d_latitude), back_azimuth
+
+
+def inv(lons1, lats1, lons2, lats2, accuracy=None):
+    '''
+    Azimuths and distances between points, like Geod.inv and broadcast over the arguments.
+    The fast calculation takes distances from Lambert's formula for the ellipsoid, good to tens of meters over
+    thousands of kilometers, and azimuths from the sphere of reduced latitudes.
+    :param accuracy: 'fast' or 'exact' for pyproj, defaults to Config.geodesy
+    :return: Forward azimuths from the first points, back azimuths from the second points and distances in meters
+    '''
+    if (accuracy or Config.geodesy) == 'exact':
+        arrays = (np.array(value, dtype=float) for value in np.broadcast_arrays(lons1, lats1, lons2, lats2))
+        return Config.globe.inv(*arrays)
+    latitude1, latitude2 = np.radians(lats1), np.radians(lats2)
+    d_longitude = np.radians(np.asarray(lons2) - lons1)
+
+    # Azimuths on the sphere of reduced latitudes
+    reduced1, reduced2 = np.arctan((1 - F) * np.tan(latitude1)), np.arctan((1 - F) * np.tan(latitude2))
+    sin1, cos1, sin2, cos2 = np.sin(reduced1), np.cos(reduced1), np.sin(reduced2), np.cos(reduced2)
+    sin_lng, cos_lng = np.sin(d_longitude), np.cos(d_longitude)
+    azimuth = np.degrees(np.arctan2(sin_lng * cos2, cos1 * sin2 - sin1 * cos2 * cos_lng))
+    back_azimuth = np.degrees(np.arctan2(-sin_lng * cos1, cos2 * sin1 - sin2 * cos1 * cos_lng))
+
+    # https://en.wikipedia.org/wiki/Geographical_distance#Lambert's_formula_for_long_lines in the form of Meeus
+    mean, half = (latitude1 + latitude2) / 2, (latitude1 - latitude2) / 2
+    sin_mean2, cos_mean2 = np.sin(mean) ** 2, np.cos(mean) ** 2
+    sin_half2, cos_half2 = np.sin(half) ** 2, np.cos(half) ** 2
+    sin_lng2 = np.sin(d_longitude / 2) ** 2
+    cos_lng2 = 1 - sin_lng2
+    s = sin_half2 * cos_lng2 + cos_mean2 * sin_lng2
+    c = cos_half2 * cos_lng2 + sin_mean2 * sin_lng2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        omega = np.arctan(np.sqrt(s / c))
+        r = np.sqrt(s * c) / omega
+        h1, h2 = (3 * r - 1) / (2 * c), (3 * r + 1) / (2 * s)
+        distance = 2 * omega * A * (1 + F * h1 * sin_mean2 * cos_half2 - F * h2 * cos_mean2 * sin_half2)
+    # Lambert's formula has no answer between a point and itself
+    distance = np.where(s > 0, distance, 0.)
+    return azimuth, back_azimuth, distance
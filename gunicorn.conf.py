@@ -0,0 +1,27 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# Read by gunicorn from the working directory it is started in, see the Procfile
+
+import subprocess
+import sys
+
+
+def when_ready(server):
+    # Downloads and ingests once for the whole dyno in its own process, the web workers only load what it converts.
+    # Ingestion a worker starts later for new gribs waits its turn on the IngestLock.
+    subprocess.Popen([sys.executable, '-c', 'import ingest; ingest.refresh()'])
@@ -0,0 +1,298 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import threading
+import time
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    # Windows locks files with msvcrt instead
+    fcntl = None
+    import msvcrt
+from config import Config
+from files import atomic_write
+from utils import create_ensemble_cube, create_forecast_cube, list_files, save_netcdf
+from wind import ENSEMBLE_TAG
+
+# Written next to the netcdfs, records the gribs they were converted from
+MANIFEST = 'manifest.json'
+# Locked next to the netcdfs while a process downloads or ingests
+LOCK = 'ingest.lock'
+
+
+class IngestLock:
+    '''
+    Lock file held while downloading or ingesting, so the web workers, the ingestion gunicorn starts and ingest.py
+    run by hand never write the manifest, the netcdfs or the cubes at the same time. The operating system releases
+    the lock when the process holding it dies, so a crashed ingestion never leaves it stuck.
+    '''
+
+    def __init__(self, netcdf_dir=Config.netcdf_dir):
+        self.path = os.path.join(netcdf_dir, LOCK)
+        self._file = None
+
+    def acquire(self, blocking=True):
+        '''
+        :param blocking: Wait for another process to finish, otherwise give up straight away
+        :return: True if the lock is now held
+        '''
+        self._file = open(self.path, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            else:
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+
+def file_hash(path):
+    '''sha1 of a file, read in blocks so a large grib is never held in memory'''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(netcdf_dir=Config.netcdf_dir):
+    path = os.path.join(netcdf_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as infile:
+        return json.load(infile)
+
+
+def save_manifest(manifest, netcdf_dir=Config.netcdf_dir):
+    atomic_write(os.path.join(netcdf_dir, MANIFEST), lambda outfile: json.dump(manifest, outfile, indent=4,
+                                                                               sort_keys=True), mode='w')
+
+
+def netcdf_name(grib_name):
+    return grib_name.replace('.grib2', '.nc')
+
+
+def pending_gribs(grib_dir=Config.grib_dir, netcdf_dir=Config.netcdf_dir, manifest=None):
+    '''
+    Gribs that are new or changed since they were last converted.
+    A grib whose mtime or size changed is only hashed, and only converted again when its contents differ.
+    :return: List of (grib name, manifest entry) to convert, the manifest is updated in place for touched files
+    '''
+    if manifest is None:
+        manifest = load_manifest(netcdf_dir)
+    pending = []
+    for name in list_files(grib_dir, '*.grib2'):
+        stat = os.stat(os.path.join(grib_dir, name))
+        entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+        previous = manifest.get(name)
+        converted = os.path.exists(os.path.join(netcdf_dir, netcdf_name(name)))
+        if converted and previous is not None and (previous['mtime'], previous['size']) == (entry['mtime'], entry['size']):
+            continue
+        entry['hash'] = file_hash(os.path.join(grib_dir, name))
+        if converted and previous is not None and previous['hash'] == entry['hash']:
+            # Touched but not changed
+            manifest[name] = entry
+            continue
+        pending.append((name, entry))
+    return pending
+
+
+def crop(ds, extents=Config.extents):
+    '''Crops a dataset to the map extents by slicing its sorted coordinates'''
+    max_extents, min_extents = extents
+    latitudes = ds['latitude'].values
+    # GFS latitudes run from north to south, the slice has to follow the same order
+    if latitudes[0] > latitudes[-1]:
+        latitude = slice(max_extents['lat'], min_extents['lat'])
+    else:
+        latitude = slice(min_extents['lat'], max_extents['lat'])
+    return ds.sel(latitude=latitude, longitude=slice(min_extents['lng'], max_extents['lng']))
+
+
+def convert_grib(grib_path, netcdf_path):
+    '''
+    Converts one grib to a cropped netcdf with wind speed and degree, compressed and chunked by variable.
+    The netcdf is written with save_netcdf so readers never see half of it.
+    :return: netcdf_path
+    '''
+    # Imported here, only the ingestion pool processes read gribs
+    import xarray
+    with xarray.open_dataset(grib_path, engine='cfgrib', indexpath='') as ds:
+        ds = ds[['u10', 'v10']]
+        # convert the 0-360 to -180 + 180, sorted for the slicing and the wind speed lookup later
+        ds = ds.assign_coords(longitude=(((ds.longitude + 180) % 360) - 180)).sortby('longitude')
+        ds = crop(ds).load()
+    u, v = ds['u10'], ds['v10']
+    ds = ds.assign(speed=np.hypot(u, v))
+    # https://www.eol.ucar.edu/content/wind-direction-quick-reference
+    ds = ds.assign(degree=(270 - np.degrees(np.arctan2(v, u))) % 360)
+    encoding = {name: {'zlib': True, 'complevel': 4, 'chunksizes': ds[name].shape} for name in ds.data_vars}
+    return save_netcdf(ds, netcdf_path, encoding=encoding)
+
+
+def ingest(grib_dir=Config.grib_dir, netcdf_dir=Config.netcdf_dir, workers=Config.ingest_workers, verbose=False,
+           wait=True):
+    '''
+    Converts the new and changed gribs in a process pool and rebuilds the forecast cube when any did.
+    Holds the IngestLock throughout, so only one process ingests at a time.
+    :param wait: Wait for another process that is already ingesting, otherwise leave the gribs to it
+    :return: Names of the gribs that were converted, None when they were left to another process
+    '''
+    lock = IngestLock(netcdf_dir)
+    if not lock.acquire(blocking=wait):
+        return None
+    try:
+        return _ingest(grib_dir, netcdf_dir, workers, verbose)
+    finally:
+        lock.release()
+
+
+def _ingest(grib_dir, netcdf_dir, workers, verbose=False):
+    manifest = load_manifest(netcdf_dir)
+    pending = pending_gribs(grib_dir, netcdf_dir, manifest)
+    converted = []
+    if len(pending) > 0:
+        start_time = time.time()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {name: pool.submit(convert_grib, os.path.join(grib_dir, name),
+                                         os.path.join(netcdf_dir, netcdf_name(name))) for name, _ in pending}
+            for name, entry in pending:
+                try:
+                    futures[name].result()
+                except Exception as e:
+                    # A bad grib is tried again on the next run, the rest still make it into the cube
+                    print('Could not convert {}: {}'.format(name, e))
+                    continue
+                manifest[name] = entry
+                converted.append(name)
+        if any(ENSEMBLE_TAG not in name for name in converted):
+            create_forecast_cube(netcdf_dir)
+        if any(ENSEMBLE_TAG in name for name in converted):
+            create_ensemble_cube(netcdf_dir)
+        if len(converted) > 0:
+            # Imported here, the route cache depends on the routers which depend on utils
+            from route_cache import route_cache
+            route_cache.clear()
+        if verbose:
+            print('Converted {} gribs in {:.1f}s'.format(len(converted), time.time() - start_time))
+    elif verbose:
+        print('There are no new gribs in the input directory.')
+    save_manifest(manifest, netcdf_dir)
+    return converted
+
+
+def refresh(grib_dir=Config.grib_dir, netcdf_dir=Config.netcdf_dir, wait=True):
+    '''
+    Downloads a forecast when there is nothing at all to route on, then ingests the new gribs. Holds the IngestLock
+    throughout, gunicorn runs this once as it starts, see gunicorn.conf.py.
+    :param wait: Wait for another process that is already ingesting, otherwise leave it to that process
+    :return: Names of the gribs that were converted, None when they were left to another process
+    '''
+    lock = IngestLock(netcdf_dir)
+    if not lock.acquire(blocking=wait):
+        return None
+    try:
+        if len(list_files(grib_dir, '*.grib2')) == 0 and len(list_files(netcdf_dir, '*.nc')) == 0:
+            # Imported here, requests is only needed on a cold start
+            from download import download_ensemble, download_forecast
+            download_forecast(degrees=1, grib_dir=grib_dir)
+            if Config.ensemble_members:
+                download_ensemble(grib_dir=grib_dir)
+        return _ingest(grib_dir, netcdf_dir, Config.ingest_workers)
+    finally:
+        lock.release()
+
+
+class Ingestor:
+    '''
+    Runs ingestion on a background thread so a web request never waits for a download or a conversion.
+    Only one process ingests at a time, see IngestLock.
+    '''
+
+    def __init__(self, grib_dir=Config.grib_dir, netcdf_dir=Config.netcdf_dir):
+        self.grib_dir = grib_dir
+        self.netcdf_dir = netcdf_dir
+        self.error = None
+        self.last_run = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        '''
+        Starts ingesting unless it is already running.
+        :return: True if a run was started
+        '''
+        with self._lock:
+            if self.running():
+                return False
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            return True
+
+    def wait(self, timeout=None):
+        '''Waits for the current run to finish, returns straight away when nothing is running'''
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        try:
+            # Another worker or process that is already ingesting picks up everything this run would have
+            refresh(self.grib_dir, self.netcdf_dir, wait=False)
+            self.error = None
+        except Exception as e:
+            self.error = str(e)
+            print('Ingestion failed:', e)
+        self.last_run = time.time()
+
+
+ingestor = Ingestor()
+
+
+def ensure_forecast():
+    '''
+    Kicks off background ingestion of any new gribs, never waits for it.
+    :return: True if a forecast is already available to route on
+    '''
+    ingestor.start()
+    return len(list_files(Config.netcdf_dir, '*.nc')) > 0
+
+
+if __name__ == '__main__':
+    ingest(verbose=True)
@@ -15,173 +15,231 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-from shapely.geometry import Point, Polygon
-from scipy.ndimage.filters import gaussian_filter
-import heapq
-import datetime
-import numpy as np
 import os
-import glob
-import xarray
-import pandas as pd
+import time
+import numpy as np
+import geodesy
+import metrics
+import utils
 from config import Config
-from utils import get_boat_speed, calculate_true_wind_angle
+from landmask import get_land_mask
+from polar import get_polar
+from utils import calculate_true_wind_angle
+from wind import get_wind_field
 
-#This file is not currently being used
 
-class PriorityQueue:
+def expand_front(lats, lngs, hours, polar, wind_field, headings, hours_of_travel, land_mask=None,
+                 profile=metrics.DISABLED):
     '''
-    Wrapper for heapq
+    Calculates every position reachable from every point on the front in one time step.
+    :param lats: Latitudes of the front
+    :param lngs: Longitudes of the front
+    :param hours: Hours since the start of the forecast at the front
+    :param polar: The boat Polar
+    :param wind_field: The WindField to sample
+    :param headings: Array of headings sailed from each point
+    :param hours_of_travel: Hours sailed on each heading
+    :param land_mask: Optional LandMask, children whose leg crosses land or a no go zone are dropped
+    :param profile: metrics.Profile timing the wind, polar, geodesic and land mask calls
+    :return: Arrays of latitude, longitude and parent index into the front for every child
     '''
-
-    def __init__(self):
-        self.heap = []
-
-    def empty(self) -> bool:
-        # try to get lowest cost
-        try:
-            x = self.heap[0]
-            return False
-        # if there is no lowest cost element the priority queue is empty
-        except IndexError:
-            return True
-
-    def push(self, x):
-        heapq.heappush(self.heap, x)
-
-    def pop(self):
-        return heapq.heappop(self.heap)
-
-class isochrone_Node:
-    def __init__(self, lat, lng, time, parent, heading, dist_start, dist_finish, true_wind_angle, start_heading, dist_traveled):
-        self.lat = lat
-        self.lng = lng
-        self.dist_start = dist_start
-        self.dist_finish = dist_finish
-        self.dist_traveled = dist_traveled
-        self.time = datetime.timedelta(seconds=time).seconds
-        self.parent = parent
-        self.heading = heading
-        self.true_wind_angle = true_wind_angle
-        self.start_heading = int(start_heading)
-
-def isochrone_optimal_route(start, finish, max_steps=2):
-    os.chdir(Config.netcdf_dir)
-    all_netcdfs = [file for file in glob.glob('*.nc')]
-    os.chdir(Config.proj_dir)
-    ds = xarray.open_dataset(Config.netcdf_dir + all_netcdfs[0])
-
-    start_node = isochrone_Node(lat=start['lat'], lng=start['lng'], time=0, parent=None, heading=None, dist_start=0, dist_finish=0, true_wind_angle=0, start_heading=0, dist_traveled=0)
-    finish_node = isochrone_Node(lat=finish['lat'], lng=finish['lng'], time=0, parent=None, heading=None, dist_start=0, dist_finish=0, true_wind_angle=0, start_heading=0, dist_traveled=0)
-    isochrones_nodes = [[start_node]]
-    isochrones_lat_lng = []
-
-    # Hours of travel for each step
-    hours_of_travel = 3
-
-    # Calculate all the potential positions the boat could be in one time step
+    with profile.timer('wind'):
+        wind_speed, wind_degree = wind_field.sample(lats, lngs, hours)
+    # Rows are points on the front, columns are headings
+    true_wind_angle = calculate_true_wind_angle(headings[np.newaxis, :], np.atleast_1d(wind_degree)[:, np.newaxis])
+    with profile.timer('polar'):
+        speed = np.maximum(polar.speed(true_wind_angle, np.atleast_1d(wind_speed)[:, np.newaxis]),
+                           Config.motoring_speed)
+    # Polars are in nautical miles. fwd takes meters.
+    distance = speed * hours_of_travel * 1852
+    parents = np.repeat(np.arange(len(lats)), len(headings))
+    with profile.timer('geodesic'):
+        child_lngs, child_lats, _ = geodesy.fwd(lons=lngs[parents],
+                                                lats=lats[parents],
+                                                az=np.tile(headings, len(lats)),
+                                                dist=distance.ravel())
+    if land_mask is not None and not land_mask.empty:
+        with profile.timer('land_mask'):
+            clear = ~land_mask.crosses(lats[parents], lngs[parents], child_lats, child_lngs)
+        child_lats, child_lngs, parents = child_lats[clear], child_lngs[clear], parents[clear]
+    return child_lats, child_lngs, parents
+
+
+def outer_envelope(bearings, distances, sector_size, envelope):
+    '''
+    Keeps the point furthest from the start in each bearing sector, dropping any that are not
+    further out than the previous isochrone in the same sector.
+    :param bearings: Bearing from the start to each point
+    :param distances: Distance from the start to each point
+    :param sector_size: Width of each sector in degrees
+    :param envelope: Furthest distance reached so far in each sector, updated in place
+    :return: Indices of the points that are kept, ordered by sector
+    '''
+    sectors = ((bearings % 360) // sector_size).astype(int) % len(envelope)
+    # Sort by sector and then by distance descending so the first of each sector is the furthest
+    order = np.lexsort((-distances, sectors))
+    sorted_sectors = sectors[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_sectors[1:] != sorted_sectors[:-1]
+    keep = order[first]
+    keep = keep[distances[keep] > envelope[sectors[keep]]]
+    envelope[sectors[keep]] = distances[keep]
+    return keep
+
+
+def isochrone_optimal_route(start, finish, max_steps=500, departure=0, stats=None, timeout=Config.timeout,
+                            progress=None, polar_path=Config.polar_diagram, profile=None, anytime=Config.anytime,
+                            wind_field=None):
+    '''
+    Grows isochrones, the furthest positions reachable after each time step, until one encloses the finish.
+    Work per step is bounded by the number of bearing sectors rather than growing with the search.
+    :param start: {'lat', 'lng'} of the start
+    :param finish: {'lat', 'lng'} of the finish
+    :param max_steps: Maximum number of isochrones
+    :param departure: Hours after the start of the forecast the boat leaves
+    :param stats: Optional dict filled with the number of isochrone points expanded and the route hours
+    :param timeout: Seconds before the search gives up
+    :param progress: Optional callable given the points expanded and the best distance to the finish so far
+                     after every isochrone. Returning False cancels the search.
+    :param polar_path: Polar diagram of the boat
+    :param profile: Optional metrics.Profile filled with counters, section timers and isochrone sizes
+    :param anytime: Out of time or isochrones, return the route through the point of the last isochrone that
+                    reaches the finish soonest in a straight line, flagged approximate in the stats
+    :param wind_field: The WindField to route on, defaults to the active forecast
+    :return: The route and the route time
+    '''
+    if stats is None:
+        stats = {}
+    if profile is None:
+        profile = metrics.DISABLED
+    profile.start_phase('setup')
+    if wind_field is None:
+        wind_field = get_wind_field()
+    stats.update(nodes_expanded=0, forecast=os.path.basename(wind_field.path))
+    polar = get_polar(polar_path)
+    land_mask = get_land_mask()
+    hours_of_travel = Config.isochrone_hours_of_travel
+    sector_size = Config.isochrone_sector_size
+    headings = np.arange(0, 360, Config.isochrone_heading_step)
+    finish_bearing, _, _ = geodesy.inv(lons1=start['lng'], lats1=start['lat'],
+                                       lons2=finish['lng'], lats2=finish['lat'])
+
+    # Each isochrone is kept as arrays of latitude, longitude and the index of the parent in the previous one
+    lats, lngs = np.array([start['lat']]), np.array([start['lng']])
+    isochrones = [(lats, lngs, np.array([-1]))]
+    envelope = np.zeros(int(np.ceil(360 / sector_size)))
+
+    start_time = time.time()
+    profile.start_phase('search')
     for step in range(max_steps):
-        next_isochrone = {}
-        print('STEP:', step)
-
-        for parent_node in isochrones_nodes[-1]:
-            wind_speed = ds.sel(latitude=parent_node.lat, longitude=parent_node.lng, method='nearest')['speed'].values.item()
-            wind_degree = ds.sel(latitude=parent_node.lat, longitude=parent_node.lng, method='nearest')['degree'].values.item()
-
-            if step == 0:
-                for heading in [deg for deg in range(0, 361, 1)]:
-                    true_wind_angle = calculate_true_wind_angle(heading, wind_degree)
-                    speed = max(get_boat_speed(true_wind_angle, wind_speed), Config.motoring_speed)
-                    distance = speed * 1852 * hours_of_travel
-                    # Get the new location for traveling at speed for 1 hour. Polars are in nautical miles. fwd takes meters.
-                    lng, lat, back_azimuth = Config.globe.fwd(lons=parent_node.lng, lats=parent_node.lat, az=heading, dist=distance)
-                    azimuth1, azimuth2, dist_finish = Config.globe.inv(lats1=finish_node.lat, lons1=finish_node.lng, lats2=lat, lons2=lng)
-                    azimuth1, azimuth2, dist_start = Config.globe.inv(lats1=start_node.lat, lons1=start_node.lng, lats2=lat, lons2=lng)
-                    node = isochrone_Node(lat=lat, lng=lng, time=0, parent=start_node, heading=heading, dist_start=dist_start, dist_finish=dist_finish, true_wind_angle=true_wind_angle, start_heading=azimuth2, dist_traveled=distance)
-                    next_isochrone[heading] = node
-
-            else:
-                child_points = PriorityQueue()
-
-                for heading in [parent_node.heading + deg for deg in range(-90, 91, 1)]:
-                    true_wind_angle = calculate_true_wind_angle(heading, wind_degree)
-                    speed = max(get_boat_speed(true_wind_angle, wind_speed), Config.motoring_speed)
-                    distance = speed * 1852 * hours_of_travel
-                    # Get the new location for traveling at speed for 1 hour. Polars are in nautical miles. fwd takes meters.
-                    lng, lat, back_azimuth = Config.globe.fwd(lons=parent_node.lng, lats=parent_node.lat, az=heading, dist=distance)
-                    azimuth1, azimuth2, dist_finish = Config.globe.inv(lats1=finish_node.lat, lons1=finish_node.lng, lats2=lat, lons2=lng)
-                    azimuth1, azimuth2, dist_start = Config.globe.inv(lats1=start_node.lat, lons1=start_node.lng, lats2=lat, lons2=lng)
-                    node = isochrone_Node(lat=lat, lng=lng, time=0, parent=start_node, heading=heading, dist_start=dist_start, dist_finish=dist_finish, true_wind_angle=true_wind_angle, start_heading=azimuth2, dist_traveled=distance)
-                    # Take the node that goes furthest outward from the parent node
-                    child_points.push((-np.tan(heading - parent_node.heading), node))
-                chosen_node = child_points.pop()[-1]
-
-                # Do not keep any headings with an angle less than 24 degree, We may however use their opposing tack at -90
-                if chosen_node.heading + chosen_node.true_wind_angle >= 20:
-                    next_isochrone[chosen_node.start_heading] = chosen_node
-
-                # if the true wind angle is less than 45 we should consider tacking. We should then keep both points.
-                if chosen_node.true_wind_angle <= 90:
-                    for tack in [-90, 90]:
-                        true_wind_angle = calculate_true_wind_angle(chosen_node.heading + tack, wind_degree)
-                        speed = max(get_boat_speed(true_wind_angle, wind_speed), Config.motoring_speed)
-                        distance = speed * 1852 * hours_of_travel
-                        # Get the new location for traveling at speed for 1 hour. Polars are in nautical miles. fwd takes meters.
-                        lng, lat, back_azimuth = Config.globe.fwd(lons=parent_node.lng, lats=parent_node.lat, az=chosen_node.heading + tack,
-                                                           dist=distance)
-                        azimuth1, azimuth2, dist_finish = Config.globe.inv(lats1=finish_node.lat, lons1=finish_node.lng, lats2=lat,
-                                                                    lons2=lng)
-                        azimuth1, azimuth2, dist_start = Config.globe.inv(lats1=start_node.lat, lons1=start_node.lng, lats2=lat,
-                                                                   lons2=lng)
-                        node = isochrone_Node(lat=lat, lng=lng, time=0, parent=parent_node, heading=chosen_node.heading + tack, dist_start=distance,
-                                              dist_finish=dist_finish, true_wind_angle=true_wind_angle, start_heading=azimuth2, dist_traveled=distance)
-
-                        # Do not head back towards the start!
-                        if node.dist_start > parent_node.dist_start:
-                            if not node.start_heading in next_isochrone:
-                                next_isochrone[node.start_heading] = node
-                            elif next_isochrone[node.start_heading].dist_start < node.dist_start:
-                                next_isochrone[node.start_heading] = node
-
-
-        # Attempt to filter the isochrone by stand deivation
-        #next_isochrone_dist_start = [(node.dist_start) for node in next_isochrone_list]
-        #print(next_isochrone_dist_start)
-        #std = scipy.stats.tstd(next_isochrone_dist_start)
-        #mean = scipy.stats.tmean(next_isochrone_dist_start)
-        #print(mean, std)
-        #cleaned_nodes = [node for node in next_isochrone_list if mean - std < node.dist_start < mean + std]
-
-        next_isochrone_list = list(next_isochrone.values())
-        next_isochrone_list.sort(key=lambda x: x.start_heading)
-        next_isochrone_lat_lng = [(node.lat, node.lng) for node in next_isochrone_list]
-
-        #next_isochrone_list, next_isochrone_lat_lng = create_smoothed_node_isochrones(list(next_isochrone.values()), start_node)
-
-        isochrones_nodes.append(next_isochrone_list)
-        isochrones_lat_lng.append(next_isochrone_lat_lng)
-
-    return isochrones_lat_lng
-
-
-def create_smoothed_node_isochrones(isochrone_list, start):
-    isochrone_list.sort(key=lambda x: x.start_heading)
-
-    lats, lngs = zip(*[(node.lat, node.lng) for node in isochrone_list])
-    lats_smoothed = gaussian_filter(lats, sigma=2)
-    lngs_smoothed = gaussian_filter(lngs, sigma=2)
-    smoothed_lat_lng = list(zip(lats_smoothed, lngs_smoothed))
-    lat_lng = []
-    for i in range(len(isochrone_list)):
-        current_node = isochrone_list[i]
-        lat, lng = smoothed_lat_lng[i][0], smoothed_lat_lng[i][1]
-        current_node.lat, current_node.lng = lat, lng
-        _, current_node.heading, _ = Config.globe.inv(lats1=current_node.lat, lons1=current_node.lng, lats2=start.lat, lons2=start.lng)
-        lat_lng.append((lat, lng))
-    return isochrone_list, lat_lng
+        # Timed Out Exit
+        if time.time() > start_time + timeout:
+            profile.outcome = metrics.TIMEOUT
+            if anytime:
+                return straight_to_finish(isochrones, finish, departure + (len(isochrones) - 1) * hours_of_travel,
+                                          polar, wind_field, land_mask, departure, stats)
+            print('No route found')
+            return [start], 'Error: Not Found'
+
+        hours = departure + step * hours_of_travel
+        stats['nodes_expanded'] += len(lats)
+        profile.count('expansions', len(lats))
+        # Every isochrone is sampled, there are only a few hundred of them
+        profile.sample_frontier(stats['nodes_expanded'], len(lats), interval=1)
+        child_lats, child_lngs, parents = expand_front(lats, lngs, hours, polar, wind_field, headings, hours_of_travel,
+                                                    land_mask, profile)
+        profile.count('children', len(child_lats))
+        with profile.timer('geodesic'):
+            bearings, _, distances = geodesy.inv(lons1=start['lng'], lats1=start['lat'],
+                                                 lons2=child_lngs, lats2=child_lats)
+        # Only keep the sectors that open towards the finish
+        towards_finish = np.cos(np.radians(bearings - finish_bearing)) > np.cos(np.radians(Config.isochrone_cone))
+        candidates = np.flatnonzero(towards_finish)
+        # Sectors are measured from the opposite of the finish bearing so the cone never wraps through 0
+        relative_bearings = bearings[candidates] - finish_bearing + 180
+        keep = candidates[outer_envelope(relative_bearings, distances[candidates], sector_size, envelope)]
+        if len(keep) == 0:
+            break
+        lats, lngs = child_lats[keep], child_lngs[keep]
+        isochrones.append((lats, lngs, parents[keep]))
+        profile.count('pushes', len(keep))
+
+        if progress is not None:
+            _, _, distances_to_finish = geodesy.inv(lons1=lngs, lats1=lats,
+                                                    lons2=finish['lng'], lats2=finish['lat'])
+            if progress({'nodes_expanded': stats['nodes_expanded'],
+                         'best_distance_to_finish': distances_to_finish.min() / 1852}) is False:
+                profile.outcome = metrics.CANCELLED
+                return [start], 'Cancelled'
+
+        # Close the isochrone through the start so it can be tested as a polygon
+        isochrone = [(start['lat'], start['lng'])] + list(zip(lats, lngs))
+        if found_goal(isochrone, finish['lng'], finish['lat']):
+            profile.start_phase('route_time')
+            profile.outcome = metrics.FOUND
+            route = finish_route(isochrones[:-1], finish, departure + step * hours_of_travel, polar, wind_field,
+                                 land_mask)
+            route_time = utils.time_found_route(route, departure, polar, wind_field, stats)
+            if Config.debug:
+                print('Route:', route)
+                print('Optimal Path Time', route_time)
+            return route, route_time
+
+    profile.outcome = metrics.NOT_FOUND
+    if anytime:
+        return straight_to_finish(isochrones, finish, departure + (len(isochrones) - 1) * hours_of_travel, polar,
+                                  wind_field, land_mask, departure, stats)
+    print('No route found')
+    return [start], 'Frontier Empty or Steps exceeded'
+
+
+def finish_route(isochrones, finish, hours, polar, wind_field, land_mask=None):
+    '''
+    Picks the point on the last isochrone before the finish that gets there soonest and rebuilds the route.
+    :param isochrones: Isochrones up to the one before the finish was enclosed
+    :param finish: {'lat', 'lng'} of the finish
+    :param hours: Hours since the start of the forecast at the last isochrone
+    :param land_mask: Optional LandMask, points whose leg to the finish crosses land are only used if there are no others
+    :return: The route as a list of {'lat', 'lng'} points
+    '''
+    lats, lngs, _ = isochrones[-1]
+    bearings, _, distances = geodesy.inv(lons1=lngs, lats1=lats, lons2=finish['lng'], lats2=finish['lat'])
+    wind_speed, wind_degree = wind_field.sample(lats, lngs, hours)
+    speed = np.maximum(polar.speed(calculate_true_wind_angle(bearings, wind_degree), wind_speed), Config.motoring_speed)
+    finish_hours = distances / speed
+    if land_mask is not None and not land_mask.empty:
+        blocked = land_mask.crosses(lats, lngs, finish['lat'], finish['lng'], include_end=False)
+        if not blocked.all():
+            finish_hours[blocked] = np.inf
+    index = int(np.argmin(finish_hours))
+
+    route = [{'lat': finish['lat'], 'lng': finish['lng']}]
+    # Traverse the isochrones backwards following the parents
+    for lats, lngs, parents in isochrones[::-1]:
+        route.append({'lat': float(lats[index]), 'lng': float(lngs[index])})
+        index = parents[index]
+    return route[::-1]
+
+
+def straight_to_finish(isochrones, finish, hours, polar, wind_field, land_mask, departure, stats):
+    '''
+    The route through the point of the last isochrone that reaches the finish soonest, what an anytime search
+    returns when it runs out of time or isochrones.
+    :return: The route and the route time, the stats are flagged approximate
+    '''
+    route = finish_route(isochrones, finish, hours, polar, wind_field, land_mask)
+    _, _, remaining = geodesy.inv(lons1=route[-2]['lng'], lats1=route[-2]['lat'],
+                                  lons2=finish['lng'], lats2=finish['lat'])
+    stats.update(approximate=True, remaining_distance=float(remaining / 1852))
+    return route, utils.time_found_route(route, departure, polar, wind_field, stats)
+
 
 def found_goal(isochrone, finish_lng, finish_lat):
     # https://automating-gis-processes.github.io/CSC18/lessons/L4/point-in-polygon.html
+    if len(isochrone) < 3:
+        return False
+    # Imported here with the rest of shapely, keeps it out of the web workers until the first search
+    from shapely.geometry import Point, Polygon
     # Create Point objects
     p1 = Point(finish_lat, finish_lng)
     # Create a Polygon
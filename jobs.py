@@ -0,0 +1,281 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import glob
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+import metrics
+from config import Config
+from files import atomic_write
+from route_cache import route_cache, snap_route
+from wind import load_forecast
+
+# Job states reported to clients
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+def _alive(pid):
+    '''Whether a process with this id is still running on this machine'''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    '''
+    Job state kept as files in one directory so every web worker sees every job, whichever worker runs it.
+    Each job has a json state, a pickle of its result once it is done and an empty marker once it is cancelled.
+    Files are written to a temporary file and renamed into place so readers never see half of one.
+    '''
+
+    def __init__(self, job_dir=Config.job_dir):
+        self.job_dir = job_dir
+
+    def _path(self, job_id, kind):
+        return os.path.join(self.job_dir, '{}.{}'.format(job_id, kind))
+
+    def _write(self, path, data):
+        os.makedirs(self.job_dir, exist_ok=True)
+        atomic_write(path, lambda outfile: outfile.write(data))
+
+    def state(self, job_id):
+        '''The state of a job, None for unknown jobs'''
+        try:
+            with open(self._path(job_id, 'json'), 'r') as infile:
+                return json.load(infile)
+        except FileNotFoundError:
+            return None
+
+    def set_state(self, job_id, **state):
+        self._write(self._path(job_id, 'json'), json.dumps(state).encode())
+
+    def update(self, job_id, **changes):
+        '''
+        Changes some of the state of a job. Only one process writes the state of a job at a time: the web worker
+        that queued it until its search starts, the pool process while it runs and the web worker once it is done.
+        '''
+        state = self.state(job_id)
+        if state is not None:
+            self.set_state(job_id, **dict(state, **changes))
+
+    def result(self, job_id):
+        '''The route, the route time and the stats of a job that is done'''
+        with open(self._path(job_id, 'pkl'), 'rb') as infile:
+            return pickle.load(infile)
+
+    def set_result(self, job_id, result):
+        self._write(self._path(job_id, 'pkl'), pickle.dumps(result))
+
+    def cancel(self, job_id):
+        self._write(self._path(job_id, 'cancel'), b'')
+
+    def cancelled(self, job_id):
+        return os.path.exists(self._path(job_id, 'cancel'))
+
+    def job_ids(self):
+        '''Every job, the least recently updated first'''
+        paths = []
+        for path in glob.glob(os.path.join(self.job_dir, '*.json')):
+            with contextlib.suppress(FileNotFoundError):
+                paths.append((os.stat(path).st_mtime_ns, path))
+        return [os.path.splitext(os.path.basename(path))[0] for _, path in sorted(paths)]
+
+    def remove(self, job_id, kinds=('json', 'pkl', 'cancel')):
+        for kind in kinds:
+            # Another worker may be forgetting the same job
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(job_id, kind))
+
+
+def run_job(job_id, algorithm, start, finish, forecast, departure, timeout, options=None, job_dir=Config.job_dir):
+    '''
+    Runs one routing search inside a pool process.
+    :param forecast: Key of the WindField to route on, the one the job was submitted and cached against
+    :param departure: Hours after the start of the forecast the boat leaves
+    :param options: Search grid overrides passed on to the router
+    :param job_dir: Directory of the JobStore the search reports its progress into
+    :return: The route, the route time and the search stats, with the search profile under 'profile'
+    '''
+    # Imported in the pool process, the routers are only needed where the search runs
+    from routers import ROUTERS
+    store = JobStore(job_dir)
+
+    def report(update):
+        store.update(job_id, status=RUNNING, progress=update)
+        # Returning False asks the search to stop, a job cancelled by any web worker has a marker
+        return not store.cancelled(job_id)
+
+    report({'nodes_expanded': 0})
+    stats = {}
+    profile = metrics.Profile()
+    route, route_time = ROUTERS[algorithm](start, finish, departure=departure, timeout=timeout, stats=stats,
+                                           wind_field=load_forecast(*forecast),
+                                           progress=report, profile=profile, **(options or {}))
+    # The profile is recorded by the process serving /metrics, see JobQueue._finished
+    stats['profile'] = profile.as_dict()
+    return route, route_time, stats
+
+
+class JobQueue:
+    '''
+    Runs routing searches in a bounded process pool so they never hold a web worker.
+    The jobs live in a JobStore, so a job queued by one web worker can be polled, streamed and cancelled through
+    any of them. Identical requests on the same forecast share one job, and routes already in the cache finish
+    straight away.
+    '''
+
+    def __init__(self, workers=Config.job_workers, history=Config.job_history, cache=route_cache, store=None):
+        self.workers = workers
+        self.history = history
+        self.cache = cache
+        self.store = JobStore() if store is None else store
+        # Futures of the jobs this web worker runs
+        self.futures = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _start(self):
+        # The pool is only started on the first job, not at import
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    @staticmethod
+    def job_id(algorithm, start, finish, forecast, departure=0, options=None):
+        '''Identical searches on the same forecast get the same id'''
+        request = json.dumps([algorithm, start, finish, forecast, departure, options or {}], sort_keys=True,
+                             default=str)
+        return hashlib.sha1(request.encode()).hexdigest()[:16]
+
+    def submit(self, algorithm, start, finish, forecast, departure=0, timeout=Config.job_timeout, options=None):
+        '''
+        Queues a search unless an identical one is already queued, running or done.
+        :param forecast: Key of the WindField to route on
+        :param departure: Hours after the start of the forecast the boat leaves
+        :param options: Search grid overrides passed on to the router
+        :return: The job id
+        '''
+        job_id = self.job_id(algorithm, start, finish, forecast, departure, options)
+        with self._lock:
+            job = self.get(job_id)
+            if job is not None and job['status'] not in (FAILED, CANCELLED):
+                return job_id
+            self.store.remove(job_id, kinds=('pkl', 'cancel'))
+            cache_key = self.cache.key(forecast, algorithm, start, finish, departure=departure, options=options)
+            cached = self.cache.get(forecast, cache_key)
+            state = {'algorithm': algorithm, 'submitted': time.time(), 'owner': os.getpid(), 'progress': {}}
+            if cached is not None:
+                self.store.set_result(job_id, snap_route(cached, start, finish, departure=departure,
+                                                         wind_field=load_forecast(*forecast)))
+                self.store.set_state(job_id, status=DONE, **state)
+            else:
+                self.store.set_state(job_id, status=QUEUED, **state)
+                self._start()
+                future = self.futures[job_id] = self._pool.submit(run_job, job_id, algorithm, start, finish,
+                                                                  forecast, departure, timeout, options,
+                                                                  self.store.job_dir)
+                future.add_done_callback(lambda done: self._finished(job_id, algorithm, forecast, cache_key, done))
+            self._forget_old()
+        return job_id
+
+    def _finished(self, job_id, algorithm, forecast, cache_key, future):
+        self.futures.pop(job_id, None)
+        if future.cancelled():
+            self.store.update(job_id, status=CANCELLED)
+            return
+        if future.exception() is not None:
+            self.store.update(job_id, status=FAILED, error=str(future.exception()))
+            return
+        route, route_time, stats = future.result()
+        # Record the search profile, and only routes that were found are worth keeping
+        profile = stats.pop('profile', None)
+        if profile is not None:
+            metrics.registry.record(algorithm, profile)
+        if self.store.cancelled(job_id):
+            # The search stopped part way, what it returned is not the answer
+            self.store.update(job_id, status=CANCELLED)
+            return
+        # The result is in place before the state says it is done
+        self.store.set_result(job_id, (route, route_time, stats))
+        self.store.update(job_id, status=DONE, profile=profile)
+        if isinstance(route_time, datetime.timedelta):
+            self.cache.put(forecast, cache_key, (route, route_time, stats))
+
+    def _forget_old(self):
+        # Drop the least recently updated finished jobs once there are more than history
+        job_ids = self.store.job_ids()
+        for job_id in job_ids[:max(len(job_ids) - self.history, 0)]:
+            job = self.get(job_id)
+            if job is not None and job['status'] in FINISHED:
+                self.store.remove(job_id)
+
+    def get(self, job_id, debug=False):
+        '''
+        Current state of a job.
+        :param debug: Include the profile of the search once it is done
+        :return: Dict with the status, the latest progress and the result when done, None for unknown jobs
+        '''
+        state = self.store.state(job_id)
+        if state is None:
+            return None
+        status = state['status']
+        if status not in FINISHED:
+            if self.store.cancelled(job_id):
+                status = CANCELLED
+            elif not _alive(state['owner']):
+                # The web worker running the search was restarted, nothing will ever finish it
+                status = FAILED
+                state['error'] = 'The job was lost when its web worker stopped'
+        job = {'job_id': job_id, 'status': status, 'progress': state['progress']}
+        if status == DONE:
+            try:
+                job['route'], job['route_time'], job['stats'] = self.store.result(job_id)
+            except FileNotFoundError:
+                # Forgotten since the state was read
+                return None
+            if debug:
+                job['profile'] = state.get('profile')
+        elif status == FAILED:
+            job['error'] = state.get('error')
+        return job
+
+    def cancel(self, job_id):
+        '''
+        Stops a job, a queued job never starts and a running search stops at its next progress report.
+        :return: False for unknown jobs
+        '''
+        if self.store.state(job_id) is None:
+            return False
+        future = self.futures.get(job_id)
+        # Jobs queued by another web worker, or already running, stop when they see the marker
+        if future is None or not future.cancel():
+            self.store.cancel(job_id)
+        return True
+
+
+job_queue = JobQueue()
@@ -0,0 +1,203 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import contextlib
+from functools import lru_cache
+import glob
+import hashlib
+import json
+import os
+import numpy as np
+from config import Config
+from files import atomic_write
+
+
+class CoastlineMissing(Exception):
+    '''Config.coastline_file is set but not there, a configuration error that waiting never fixes'''
+    pass
+
+
+def _grid(extents, resolution):
+    '''South west corner and the number of rows and columns of a raster covering the extents'''
+    max_extents, min_extents = extents
+    rows = int(np.ceil((max_extents['lat'] - min_extents['lat']) / resolution))
+    cols = int(np.ceil((max_extents['lng'] - min_extents['lng']) / resolution))
+    return min_extents['lat'], min_extents['lng'], rows, cols
+
+
+def rasterize(geometry, extents=Config.extents, resolution=Config.landmask_resolution):
+    '''
+    Marks every raster cell whose centre is inside the geometry, one scanline per row of cells.
+    Each row only needs one intersection of the geometry with a line instead of a test per cell.
+    :param geometry: shapely geometry in (longitude, latitude)
+    :return: (rows, cols) boolean array, row 0 is the southern edge
+    '''
+    from shapely.geometry import LineString
+    from shapely.prepared import prep
+    south, west, rows, cols = _grid(extents, resolution)
+    mask = np.zeros((rows, cols), dtype=bool)
+    if geometry is None or geometry.is_empty:
+        return mask
+    prepared = prep(geometry)
+    east = west + cols * resolution
+    for row in range(rows):
+        lat = south + (row + 0.5) * resolution
+        line = LineString([(west, lat), (east, lat)])
+        if not prepared.intersects(line):
+            continue
+        crossing = geometry.intersection(line)
+        pieces = crossing.geoms if hasattr(crossing, 'geoms') else [crossing]
+        for piece in pieces:
+            if piece.geom_type != 'LineString':
+                continue
+            lngs = [x for x, _ in piece.coords]
+            # Columns whose centres fall between the two ends of the piece
+            first = int(np.ceil((min(lngs) - west) / resolution - 0.5))
+            last = int(np.floor((max(lngs) - west) / resolution - 0.5))
+            mask[row, max(first, 0):min(last, cols - 1) + 1] = True
+    return mask
+
+
+def load_coastline(path):
+    '''Land polygons from a GeoJSON file, None when there is no file'''
+    if path is None or not os.path.exists(path):
+        return None
+    from shapely.geometry import shape
+    from shapely.ops import unary_union
+    with open(path, 'r') as infile:
+        data = json.load(infile)
+    features = data['features'] if data.get('type') == 'FeatureCollection' else [data]
+    return unary_union([shape(feature.get('geometry', feature)) for feature in features])
+
+
+def no_go_polygon(points):
+    '''A no go zone drawn as a list of {'lat', 'lng'} points'''
+    from shapely.geometry import Polygon
+    return Polygon([(point['lng'], point['lat']) for point in points])
+
+
+class LandMask:
+    '''
+    Raster of blocked cells, land and no go zones, kept as a packed bit array.
+    Points and whole segments are checked with index arithmetic, never with shapely.
+    '''
+
+    def __init__(self, packed, south, west, rows, cols, resolution, key):
+        self.packed = packed
+        self.south = south
+        self.west = west
+        self.rows = rows
+        self.cols = cols
+        self.resolution = resolution
+        self.key = key
+        self.empty = not packed.any()
+
+    def _cells(self, lats, lngs):
+        # Row and column of each point, -1 outside the raster
+        row = np.floor((np.asarray(lats) - self.south) / self.resolution).astype(np.int64)
+        col = np.floor((np.asarray(lngs) - self.west) / self.resolution).astype(np.int64)
+        outside = (row < 0) | (row >= self.rows) | (col < 0) | (col >= self.cols)
+        return np.where(outside, -1, row), np.where(outside, -1, col)
+
+    def _lookup(self, row, col):
+        inside = row >= 0
+        bits = (self.packed[np.where(inside, row, 0), np.where(inside, col, 0) >> 3] >> (7 - (col & 7))) & 1
+        return inside & (bits == 1)
+
+    def blocked(self, lats, lngs):
+        '''
+        Whether each point is on land or in a no go zone. Points off the raster are never blocked.
+        '''
+        if self.empty:
+            return np.zeros(np.shape(lats), dtype=bool)
+        return self._lookup(*self._cells(lats, lngs))
+
+    def crosses(self, lats1, lngs1, lats2, lngs2, include_end=True):
+        '''
+        Whether each segment passes through a blocked cell, sampled at least once per cell along a straight
+        line in latitude and longitude. The cell a segment starts in never counts so boats can leave a harbour,
+        nor does the cell it ends in when include_end is False so they can arrive in one.
+        :return: Boolean array, one per segment
+        '''
+        lats1, lngs1, lats2, lngs2 = np.broadcast_arrays(*(np.atleast_1d(np.asarray(a, dtype=float))
+                                                           for a in (lats1, lngs1, lats2, lngs2)))
+        if self.empty or lats1.size == 0:
+            return np.zeros(lats1.shape, dtype=bool)
+        length = np.maximum(np.abs(lats2 - lats1), np.abs(lngs2 - lngs1)).max()
+        samples = int(np.ceil(length / self.resolution)) + 1
+        fractions = np.linspace(0, 1, samples + 1)[1:]
+        lats = lats1[:, np.newaxis] + (lats2 - lats1)[:, np.newaxis] * fractions
+        lngs = lngs1[:, np.newaxis] + (lngs2 - lngs1)[:, np.newaxis] * fractions
+        row, col = self._cells(lats, lngs)
+        start_row, start_col = self._cells(lats1, lngs1)
+        blocked = self._lookup(row, col) & ((row != start_row[:, np.newaxis]) | (col != start_col[:, np.newaxis]))
+        if not include_end:
+            end_row, end_col = self._cells(lats2, lngs2)
+            blocked &= (row != end_row[:, np.newaxis]) | (col != end_col[:, np.newaxis])
+        return blocked.any(axis=1)
+
+
+def _save_cache(cache_path, packed):
+    '''
+    Writes the rasterized coastline atomically, so a worker starting at the same time never loads half a cache.
+    Caches of older coastlines or other grids are removed.
+    '''
+    atomic_write(cache_path, lambda outfile: np.save(outfile, packed))
+    for stale in glob.glob('{}.*.npy'.format(cache_path.rsplit('.', 2)[0])):
+        if stale != cache_path:
+            # Another worker may have removed it first
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(stale)
+
+
+def load_land_mask(coastline_file=Config.coastline_file, no_go_zones=Config.no_go_zones, extents=Config.extents,
+                   resolution=Config.landmask_resolution):
+    '''
+    Rasterizes the coastline once and caches the bits in a .npy next to it, no go zones are added on top.
+    With coastline_file None only the no go zones are blocked. Shapely is only imported when there is something
+    to rasterize, a cached coastline loads without it.
+    :raises CoastlineMissing: When coastline_file is set but missing, rather than routing across land
+    '''
+    south, west, rows, cols = _grid(extents, resolution)
+    land_key = None
+    packed = None
+    if coastline_file is not None:
+        if not os.path.exists(coastline_file):
+            raise CoastlineMissing('No coastline at {}, download the land polygons described in readme.md or set '
+                                   'Config.coastline_file to None to route without one'.format(coastline_file))
+        land_key = hashlib.sha1(json.dumps([os.stat(coastline_file).st_mtime_ns, extents, resolution],
+                                           default=str).encode()).hexdigest()[:16]
+        cache_path = '{}.{}.npy'.format(os.path.splitext(coastline_file)[0], land_key)
+        if os.path.exists(cache_path):
+            packed = np.load(cache_path)
+        else:
+            packed = np.packbits(rasterize(load_coastline(coastline_file), extents, resolution), axis=1)
+            _save_cache(cache_path, packed)
+    if packed is None:
+        packed = np.packbits(np.zeros((rows, cols), dtype=bool), axis=1)
+    if no_go_zones:
+        from shapely.ops import unary_union
+        zones = unary_union([no_go_polygon(points) for points in no_go_zones])
+        packed = packed | np.packbits(rasterize(zones, extents, resolution), axis=1)
+    key = hashlib.sha1(json.dumps([land_key, no_go_zones, resolution]).encode()).hexdigest()[:16]
+    return LandMask(packed, south, west, rows, cols, resolution, key)
+
+
+@lru_cache(maxsize=None)
+def get_land_mask():
+    '''Loads the land mask only once per process'''
+    return load_land_mask()
@@ -0,0 +1,207 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from collections import defaultdict
+import threading
+import time
+from config import Config
+
+# Search outcomes, the routers set one on their profile before returning
+FOUND, NOT_FOUND, TIMEOUT, CANCELLED = 'found', 'not_found', 'timeout', 'cancelled'
+
+
+class _Timer:
+    '''Adds the seconds spent inside a with block to one entry of a dict of totals'''
+    __slots__ = ('totals', 'calls', 'name', 'started')
+
+    def __init__(self, totals, calls, name):
+        self.totals = totals
+        self.calls = calls
+        self.name = name
+        self.started = 0.
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.totals[self.name] += time.perf_counter() - self.started
+        self.calls[self.name] += 1
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class Profile:
+    '''
+    Counters, timers and frontier samples of one search. Cheap enough to leave on for every request,
+    a timer is two perf_counter calls and a counter a dict update, both once per expansion or batch of children.
+    '''
+
+    def __init__(self, enabled=True, frontier_interval=Config.metrics_frontier_interval):
+        self.enabled = enabled
+        self.frontier_interval = frontier_interval
+        self.outcome = None
+        self.counters = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.phases = defaultdict(float)
+        self._phase = None
+        self._phase_started = 0.
+        # (seconds since the search started, nodes expanded, frontier size)
+        self.frontier = []
+        self._timers = {}
+        self._started = time.perf_counter()
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] += amount
+
+    def timer(self, name):
+        '''Time spent in a hot section, such as wind sampling or geodesic calls'''
+        if not self.enabled:
+            return _null_timer
+        timer = self._timers.get(name)
+        if timer is None:
+            timer = self._timers[name] = _Timer(self.seconds, self.calls, name)
+        return timer
+
+    def start_phase(self, name):
+        '''
+        Ends the current phase of the search, such as setup or the search loop, and starts timing the next.
+        The routers return from many places so phases are switched rather than wrapped in with blocks.
+        '''
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self._phase is not None:
+            self.phases[self._phase] += now - self._phase_started
+        self._phase, self._phase_started = name, now
+
+    def sample_frontier(self, expanded, size, interval=None):
+        '''Records the frontier size every interval expansions, frontier_interval when None'''
+        if self.enabled and expanded % (interval or self.frontier_interval) == 0:
+            self.frontier.append((round(time.perf_counter() - self._started, 4), expanded, size))
+
+    def as_dict(self):
+        '''The profile as plain json types, small enough to return with a route'''
+        self.start_phase(None)
+        return {'outcome': self.outcome,
+                'wall_seconds': time.perf_counter() - self._started,
+                'counters': dict(self.counters),
+                'timers': {name: {'seconds': self.seconds[name], 'calls': self.calls[name]} for name in self.seconds},
+                'phases': dict(self.phases),
+                'frontier': self.frontier}
+
+
+# Profile that records nothing, for callers that do not want one
+DISABLED = Profile(enabled=False)
+
+
+class Registry:
+    '''
+    Totals of every search profile recorded in this process, served in the Prometheus text format.
+    Pool processes send their profiles back with the route so they are recorded where /metrics is served.
+    '''
+
+    def __init__(self, buckets=Config.metrics_buckets):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.searches = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.phases = defaultdict(float)
+        self.durations = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self.duration_sums = defaultdict(float)
+
+    def record(self, algorithm, profile):
+        '''
+        Adds one search to the totals.
+        :param profile: A Profile or the dict from its as_dict
+        '''
+        if isinstance(profile, Profile):
+            profile = profile.as_dict()
+        with self._lock:
+            self.searches[(algorithm, profile['outcome'] or NOT_FOUND)] += 1
+            for name, amount in profile['counters'].items():
+                self.counters[(algorithm, name)] += amount
+            for name, timer in profile['timers'].items():
+                self.seconds[(algorithm, name)] += timer['seconds']
+                self.calls[(algorithm, name)] += timer['calls']
+            for name, seconds in profile['phases'].items():
+                self.phases[(algorithm, name)] += seconds
+            duration = profile['wall_seconds']
+            counts = self.durations[algorithm]
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.duration_sums[algorithm] += duration
+
+    def prometheus(self):
+        '''The totals in the Prometheus text exposition format'''
+        lines = []
+
+        def family(name, kind, description, samples):
+            lines.append('# HELP weather_router_{} {}'.format(name, description))
+            lines.append('# TYPE weather_router_{} {}'.format(name, kind))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(label, text) for label, text in labels)
+                lines.append('weather_router_{}{{{}}} {}'.format(name, label_text, value))
+
+        with self._lock:
+            family('searches_total', 'counter', 'Optimal route searches by outcome',
+                   [((('algorithm', a), ('outcome', o)), n) for (a, o), n in sorted(self.searches.items())])
+            family('search_events_total', 'counter', 'Nodes expanded, pushed and re-pushed and other search events',
+                   [((('algorithm', a), ('event', e)), n) for (a, e), n in sorted(self.counters.items())])
+            family('search_section_seconds_total', 'counter', 'Seconds spent in wind, polar, geodesic and land calls',
+                   [((('algorithm', a), ('section', s)), v) for (a, s), v in sorted(self.seconds.items())])
+            family('search_section_calls_total', 'counter', 'Calls timed in each section',
+                   [((('algorithm', a), ('section', s)), n) for (a, s), n in sorted(self.calls.items())])
+            family('search_phase_seconds_total', 'counter', 'Seconds spent in each phase of the searches',
+                   [((('algorithm', a), ('phase', p)), v) for (a, p), v in sorted(self.phases.items())])
+            samples = []
+            for algorithm, counts in sorted(self.durations.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(((('algorithm', algorithm), ('le', bound)), count))
+                samples.append(((('algorithm', algorithm), ('le', '+Inf')), counts[-1]))
+            lines.append('# HELP weather_router_search_duration_seconds Wall time of each search')
+            lines.append('# TYPE weather_router_search_duration_seconds histogram')
+            for labels, value in samples:
+                lines.append('weather_router_search_duration_seconds_bucket{{{}}} {}'.format(
+                    ','.join('{}="{}"'.format(label, text) for label, text in labels), value))
+            for algorithm, counts in sorted(self.durations.items()):
+                lines.append('weather_router_search_duration_seconds_sum{{algorithm="{}"}} {}'.format(
+                    algorithm, self.duration_sums[algorithm]))
+                lines.append('weather_router_search_duration_seconds_count{{algorithm="{}"}} {}'.format(
+                    algorithm, counts[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
@@ -0,0 +1,153 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import contextlib
+from functools import lru_cache
+import glob
+import hashlib
+import json
+import os
+import numpy as np
+from config import Config
+from files import atomic_write
+
+
+class Polar:
+    '''
+    Boat polar diagram resampled onto a dense grid so speeds are looked up by index arithmetic.
+    Rows are true wind angles from 0 to 180 degrees, columns are wind speeds in knots.
+    The resampled arrays are cached in a .npz next to the polar file so a new process skips parsing it.
+    '''
+
+    # Arrays resampled from the polar file, cached together in a binary file next to it
+    ARRAYS = ('angles', 'wind_speeds', 'table', 'upwind_angles', 'upwind_vmg', 'downwind_angles', 'downwind_vmg')
+
+    def __init__(self, path, angle_resolution=1.0, wind_speed_resolution=1.0):
+        self.path = path
+        self.angle_resolution = angle_resolution
+        self.wind_speed_resolution = wind_speed_resolution
+        # Named after the resolutions and then the version of the polar file, so a new version replaces only the
+        # cache of the same resolutions
+        key = hashlib.sha1(json.dumps(os.stat(path).st_mtime_ns).encode()).hexdigest()[:16]
+        cache_path = '{}.{:g}x{:g}.{}.npz'.format(os.path.splitext(path)[0], angle_resolution, wind_speed_resolution,
+                                                  key)
+        try:
+            with np.load(cache_path) as cached:
+                arrays = {name: cached[name] for name in self.ARRAYS}
+        except (OSError, KeyError, ValueError):
+            arrays = self._resample(path)
+            self._save(cache_path, arrays)
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    def _resample(self, path):
+        '''Parses the polar file and resamples it onto the dense grid'''
+        # First row holds the wind speeds, first column holds the true wind angles
+        raw = np.genfromtxt(path, delimiter=';')
+        raw_angles = raw[1:, 0]
+        raw_wind_speeds = raw[0, 1:]
+        # The polar diagrams are not completely filled out, missing speeds are treated as no speed
+        raw_speeds = np.nan_to_num(raw[1:, 1:], nan=0)
+        order = np.argsort(raw_angles)
+        raw_angles, raw_speeds = raw_angles[order], raw_speeds[order]
+
+        angles = np.arange(0, 180 + self.angle_resolution, self.angle_resolution)
+        wind_speeds = np.arange(0, raw_wind_speeds.max() + self.wind_speed_resolution, self.wind_speed_resolution)
+        # Resample along the angles and then along the wind speeds onto the dense grid
+        by_angle = np.array([np.interp(angles, raw_angles, column) for column in raw_speeds.T]).T
+        table = np.array([np.interp(wind_speeds, raw_wind_speeds, row) for row in by_angle])
+
+        # Optimal vmg angles per wind speed column. Upwind maximises vmg, downwind minimises it.
+        vmg = table * np.cos(np.radians(angles))[:, np.newaxis]
+        upwind = angles <= 90
+        downwind = angles >= 90
+        upwind_index = np.argmax(vmg[upwind], axis=0)
+        downwind_index = np.argmin(vmg[downwind], axis=0)
+        columns = np.arange(len(wind_speeds))
+        return {'angles': angles,
+                'wind_speeds': wind_speeds,
+                'table': table,
+                'upwind_angles': angles[upwind][upwind_index],
+                'upwind_vmg': vmg[upwind][upwind_index, columns],
+                'downwind_angles': angles[downwind][downwind_index],
+                'downwind_vmg': -vmg[downwind][downwind_index, columns]}
+
+    @staticmethod
+    def _save(cache_path, arrays):
+        # Written atomically so another worker never loads half a file. The cache is only an optimisation,
+        # a read only polar directory just means parsing the text every time.
+        try:
+            atomic_write(cache_path, lambda outfile: np.savez(outfile, **arrays))
+        except OSError:
+            return
+        # Caches of older versions of the polar file at the same resolutions are no longer needed
+        for stale in glob.glob('{}.*.npz'.format(cache_path.rsplit('.', 2)[0])):
+            if stale != cache_path:
+                # Another worker may have removed it first
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(stale)
+
+    def _index(self, values, resolution, size):
+        '''
+        Converts values to the lower grid index and the fraction towards the next one.
+        Values outside the grid are clamped to its edges.
+        '''
+        position = np.clip(np.asarray(values, dtype=float) / resolution, 0, size - 1)
+        index = np.minimum(position.astype(int), size - 2)
+        return index, position - index
+
+    def speed(self, true_wind_angle, wind_speed):
+        '''
+        Bilinear interpolated boat speed for scalars or arrays.
+        :param true_wind_angle: True wind angle(s) in degrees, 0 to 180
+        :param wind_speed: Wind speed(s) in knots, broadcast against true_wind_angle
+        :return: Boat speed(s) in knots
+        '''
+        true_wind_angle, wind_speed = np.broadcast_arrays(np.abs(true_wind_angle), wind_speed)
+        row, row_fraction = self._index(true_wind_angle, self.angle_resolution, len(self.angles))
+        col, col_fraction = self._index(wind_speed, self.wind_speed_resolution, len(self.wind_speeds))
+        table = self.table
+        low = table[row, col] * (1 - col_fraction) + table[row, col + 1] * col_fraction
+        high = table[row + 1, col] * (1 - col_fraction) + table[row + 1, col + 1] * col_fraction
+        return (low * (1 - row_fraction) + high * row_fraction)[()]
+
+    def max_speed(self, wind_speed=None):
+        '''
+        Fastest boat speed at any angle for wind speeds up to wind_speed, or for any wind speed when None.
+        Never under estimates speed(), so it is safe for bounding sailing times.
+        '''
+        if wind_speed is None:
+            return float(self.table.max())
+        # Include the next column, speed() interpolates towards it
+        columns = min(int(np.floor(wind_speed / self.wind_speed_resolution)) + 2, len(self.wind_speeds))
+        return float(self.table[:, :columns].max())
+
+    def vmg_angles(self, wind_speed):
+        '''
+        Optimal upwind and downwind true wind angles for the nearest tabulated wind speed(s).
+        :param wind_speed: Wind speed(s) in knots
+        :return: Tuple of upwind angle(s) and downwind angle(s) in degrees
+        '''
+        col = np.clip(np.rint(np.asarray(wind_speed, dtype=float) / self.wind_speed_resolution),
+                      0, len(self.wind_speeds) - 1).astype(int)
+        return self.upwind_angles[col][()], self.downwind_angles[col][()]
+
+
+@lru_cache(maxsize=None)
+def get_polar(path=Config.polar_diagram):
+    '''Loads each polar diagram only once per process'''
+    return Polar(path)
@@ -0,0 +1,233 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import os
+import numpy as np
+import astar
+import metrics
+import utils
+from batch import _warm_worker
+from config import Config
+from polar import get_polar
+from wind import get_wind_field, load_forecast, run_time
+
+
+class WarmStart:
+    '''
+    A previous route prepared for seeding a search in a newer forecast, see warm_start.
+    '''
+
+    def __init__(self, route, hours, reuse, upper_bound, corridor, corridor_zoom, corridor_penalty):
+        self.route = route
+        # Hours from the start of the route to each of its points in the new forecast
+        self.hours = hours
+        # Opening legs where the wind has not changed, the search carries on from the end of them
+        self.reuse = reuse
+        # Hours to sail the whole route in the new forecast, no slower route is ever needed
+        self.upper_bound = upper_bound
+        # Sorted cell keys along the route and the zoom of the cells, see astar.cell_keys
+        self.corridor = corridor
+        self.corridor_zoom = corridor_zoom
+        # Hours added to the cost of nodes outside the corridor
+        self.corridor_penalty = corridor_penalty
+
+
+def forecast_name(wind_field):
+    '''Name of the forecast a route is planned on, the file name of its cube'''
+    return os.path.basename(wind_field.path)
+
+
+def previous_wind_field(name, netcdf_dir=Config.netcdf_dir):
+    '''
+    Loads the forecast a route was planned on by its name. The cubes of older runs are left on disk
+    when a new one is built, they are only gone once the netcdf directory has been cleared out.
+    :return: The WindField, None when the forecast is no longer available
+    '''
+    if not name:
+        return None
+    path = os.path.join(netcdf_dir, os.path.basename(name))
+    if not os.path.exists(path):
+        return None
+    return load_forecast(path, os.stat(path).st_mtime_ns)
+
+
+def forecast_offset(previous, current):
+    '''Hours the current forecast starts after the previous one, from the runs their cubes are named after'''
+    starts = [run_time(field.path) for field in (previous, current)]
+    if None in starts:
+        return 0.
+    return (starts[1] - starts[0]).total_seconds() / 3600
+
+
+def wind_change(route, hours, departure, previous, current, offset):
+    '''
+    Knots the wind vector changed between two forecasts at the start and the end of each leg, taken at
+    the times the legs are sailed in the current forecast.
+    :param hours: Hours from the start of the route to each of its points in the current forecast
+    :param offset: Hours the current forecast starts after the previous one
+    :return: The larger of the two changes for each leg
+    '''
+    lats = np.array([point['lat'] for point in route])
+    lngs = np.array([point['lng'] for point in route])
+    times = departure + np.asarray(hours)
+    changes = []
+    for field, shift in ((current, 0), (previous, offset)):
+        speed, degree = field.sample(lats, lngs, times + shift)
+        radians = np.radians(degree)
+        changes.append((-speed * np.sin(radians), -speed * np.cos(radians)))
+    (u, v), (old_u, old_v) = changes
+    change = np.hypot(u - old_u, v - old_v)
+    return np.maximum(change[:-1], change[1:])
+
+
+def corridor_keys(route, zoom, step=Config.replan_corridor_step):
+    '''Sorted keys of the grid cells the route passes through, every step nautical miles along it'''
+    lats = np.array([[point['lat'] for point in route]])
+    lngs = np.array([[point['lng'] for point in route]])
+    lats, lngs, _ = utils.densify_routes(lats, lngs, step, Config.route_max_subsegments)
+    valid = ~np.isnan(lats)
+    return np.unique(astar.cell_keys(lats[valid], lngs[valid], zoom))
+
+
+def warm_start(route, departure=0, previous=None, offset=None, wind_field=None, polar=None,
+               threshold=Config.replan_wind_change, margin=Config.replan_margin_hours,
+               corridor_zoom=Config.replan_corridor_zoom, corridor_penalty=Config.replan_corridor_penalty):
+    '''
+    Times a previous route in the new forecast and finds how much of it can be kept.
+    The legs up to the first one where the wind changed by more than threshold knots are kept, less the last margin
+    hours of them so the new route can turn off the old one before it reaches the change.
+    :param route: The previous route, a list of {'lat', 'lng'} points from the boat to the finish
+    :param departure: Hours after the start of the new forecast the boat leaves
+    :param previous: WindField the route was planned on, None when it is gone and every leg has to be searched again
+    :param offset: Hours the new forecast starts after the previous one, from the names of their cubes when None
+    :param wind_field: The new WindField, defaults to the active forecast
+    :param polar: The Polar to use, defaults to Config.polar_diagram
+    :return: A WarmStart
+    '''
+    if wind_field is None:
+        wind_field = get_wind_field()
+    if polar is None:
+        polar = get_polar()
+    # Timed the way the search times its nodes
+    elapsed, legs = utils.evaluate_routes([route], departure=departure, polar=polar, wind_field=wind_field,
+                                          segments=True)
+    hours = np.concatenate([[0.], legs['elapsed'][0]])
+    reuse = 0
+    if previous is not None:
+        if offset is None:
+            offset = forecast_offset(previous, wind_field)
+        changed = np.nonzero(wind_change(route, hours, departure, previous, wind_field, offset) > threshold)[0]
+        if len(changed) == 0:
+            reuse = len(route) - 1
+        else:
+            # Points reached at least margin hours before the first changed leg starts
+            reuse = max(int(np.searchsorted(hours, hours[changed[0]] - margin, side='right')) - 1, 0)
+    return WarmStart(route=route, hours=hours, reuse=reuse, upper_bound=float(elapsed[0]),
+                     corridor=corridor_keys(route, corridor_zoom), corridor_zoom=corridor_zoom,
+                     corridor_penalty=corridor_penalty)
+
+
+def replan_route(route, forecast=None, departure=0, offset=None, stats=None, profile=None,
+                 polar_path=Config.polar_diagram, timeout=Config.timeout, wind_field=None, **options):
+    '''
+    Re-plans a route after a new forecast has arrived with an A* search warm started from the old route. The
+    opening legs where the wind has not changed are kept as they are, the time of the old route bounds the search
+    and cells in a corridor along it are expanded first. A route whose wind has not changed anywhere is returned
+    without searching.
+    :param route: The previous route, a list of {'lat', 'lng'} points from the boat to the finish
+    :param forecast: Name of the forecast the route was planned on, the 'forecast' in the stats of its search
+    :param departure: Hours after the start of the new forecast the boat leaves
+    :param offset: Hours the new forecast starts after the previous one, see forecast_offset
+    :param stats: Optional dict filled with the search stats and the legs reused
+    :param profile: Optional metrics.Profile of the search
+    :param polar_path: Polar diagram of the boat
+    :param timeout: Seconds before the search gives up
+    :param wind_field: The new WindField, defaults to the active forecast
+    :param options: Passed on to astar_optimal_route, such as the grid settings
+    :return: The route and the route time
+    '''
+    if stats is None:
+        stats = {}
+    polar = get_polar(polar_path)
+    if wind_field is None:
+        wind_field = get_wind_field()
+    previous = previous_wind_field(forecast)
+    seed = warm_start(route, departure=departure, previous=previous, offset=offset, wind_field=wind_field,
+                      polar=polar)
+    stats.update(forecast=forecast_name(wind_field), previous_forecast=forecast if previous is not None else None,
+                 legs=len(route) - 1, reused_legs=seed.reuse, previous_route_hours=seed.upper_bound)
+    if seed.reuse == len(route) - 1:
+        # The wind has not changed along the whole route
+        if profile is not None:
+            profile.outcome = metrics.FOUND
+        stats.update(nodes_expanded=0, route_hours=seed.upper_bound)
+        return route, utils.time_found_route(route, departure, polar, wind_field, stats)
+    return astar.astar_optimal_route(route[0], route[-1], departure=departure, stats=stats, profile=profile,
+                                     polar_path=polar_path, timeout=timeout, seed=seed, wind_field=wind_field,
+                                     **options)
+
+
+def replan_task(route, forecast, departure, polar_path, timeout, current):
+    '''
+    Re-plans one route inside a pool process.
+    :param current: Key of the WindField to re-plan on, the one the parent process checked the request against
+    :return: The route, the route time and the stats, with the search profile under 'profile'
+    '''
+    stats = {}
+    profile = metrics.Profile()
+    route, route_time = replan_route(route, forecast=forecast, departure=departure, stats=stats, profile=profile,
+                                     polar_path=polar_path, timeout=timeout, wind_field=load_forecast(*current))
+    stats['profile'] = profile.as_dict()
+    return route, route_time, stats
+
+
+def replan_routes(boats, workers=Config.batch_workers, timeout=Config.timeout, debug=False, wind_field=None):
+    '''
+    Re-plans the routes of many boats after a forecast update across a process pool.
+    :param boats: List of dicts with the 'route' to re-plan and optionally the 'forecast' it was planned on,
+                  the 'departure' in hours after the start of the new forecast and the 'polar' name
+    :param workers: Pool processes, each re-plans one route at a time
+    :param timeout: Seconds each search may run
+    :param debug: Include the profile of each search
+    :param wind_field: The WindField to re-plan on, defaults to the active forecast
+    :return: One row per boat in the order given
+    '''
+    if wind_field is None:
+        wind_field = get_wind_field()
+    tasks = [(boat['route'], boat.get('forecast'), boat.get('departure', 0),
+              Config.polar_diagrams.get(boat.get('polar'), Config.polar_diagram), timeout, wind_field.key)
+             for boat in boats]
+    if len(tasks) == 1:
+        # Not worth starting a pool for
+        results = [replan_task(*tasks[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_warm_worker, initargs=(wind_field.key,)) as pool:
+            results = list(pool.map(replan_task, *zip(*tasks)))
+    rows = []
+    for route, route_time, stats in results:
+        profile = stats.pop('profile')
+        metrics.registry.record('replan', profile)
+        found = isinstance(route_time, datetime.timedelta)
+        rows.append({'route': route,
+                     'route_time': route_time,
+                     'route_hours': route_time.total_seconds() / 3600 if found else None,
+                     'stats': stats})
+        if debug:
+            rows[-1]['profile'] = profile
+    return rows
@@ -0,0 +1,167 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from collections import OrderedDict
+from functools import lru_cache
+import glob
+import hashlib
+import json
+import os
+import pickle
+import threading
+import utils
+from astar import grid_keys
+from config import Config
+from files import atomic_write
+from landmask import get_land_mask
+from polar import get_polar
+
+
+@lru_cache(maxsize=None)
+def polar_hash(path):
+    '''Hash of a polar file's contents, an edited polar never matches an old route'''
+    with open(path, 'rb') as infile:
+        return hashlib.sha1(infile.read()).hexdigest()
+
+
+def search_parameters(algorithm):
+    '''The settings that change the route an algorithm returns'''
+    if algorithm == 'astar':
+        return {'mode': Config.astar_mode, 'weight': Config.astar_heuristic_weight,
+                'max_hours': Config.astar_max_hours, 'min_hours': Config.astar_min_hours,
+                'approach_steps': Config.astar_approach_steps, 'max_wind_change': Config.astar_max_wind_change,
+                'cell_fraction': Config.astar_cell_fraction, 'min_zoom': Config.astar_min_zoom,
+                'max_zoom': Config.astar_max_zoom}
+    return {'hours_of_travel': Config.isochrone_hours_of_travel, 'sector_size': Config.isochrone_sector_size,
+            'heading_step': Config.isochrone_heading_step, 'cone': Config.isochrone_cone}
+
+
+class RouteCache:
+    '''
+    Bounded least recently used cache of optimal routes, optionally persisted to disk.
+    Starts and finishes are snapped to the router's grid cells so nearby requests share a route.
+    Every entry belongs to one forecast, all of them are dropped as soon as a different forecast is seen.
+    '''
+
+    def __init__(self, max_entries=Config.route_cache_size, cache_dir=Config.route_cache_dir):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.forecast = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(forecast, algorithm, start, finish, departure=0, polar_path=Config.polar_diagram, options=None):
+        '''The cache key of a search, options are the request's overrides of the search parameters'''
+        request = [forecast, polar_hash(polar_path), get_land_mask().key, algorithm,
+                   dict(search_parameters(algorithm), **(options or {})), departure,
+                   grid_keys(start['lat'], start['lng']).item(), grid_keys(finish['lat'], finish['lng']).item()]
+        return hashlib.sha1(json.dumps(request, default=str).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def _check_forecast(self, forecast):
+        # A new forecast makes every cached route stale. A fresh process keeps what is on disk,
+        # entries saved for another forecast are never returned.
+        if self.forecast is not None and forecast != self.forecast:
+            self._clear()
+        self.forecast = forecast
+
+    def get(self, forecast, key):
+        '''
+        :return: The cached value for key, None on a miss
+        '''
+        with self._lock:
+            self._check_forecast(forecast)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            if self.cache_dir is not None and os.path.exists(self._path(key)):
+                with open(self._path(key), 'rb') as infile:
+                    entry_forecast, value = pickle.load(infile)
+                if entry_forecast == forecast:
+                    self._store(key, value)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, forecast, key, value):
+        # Approximate routes from searches that ran out of time are never kept, the next search may finish
+        if value[2].get('approximate', False):
+            return
+        with self._lock:
+            self._check_forecast(forecast)
+            self._store(key, value)
+            if self.cache_dir is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                atomic_write(self._path(key), lambda outfile: pickle.dump((forecast, value), outfile))
+
+    def _store(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.sizes[key] = len(pickle.dumps(value))
+        while len(self.entries) > self.max_entries:
+            oldest, _ = self.entries.popitem(last=False)
+            del self.sizes[oldest]
+
+    def _clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        if self.cache_dir is not None:
+            for path in glob.glob(os.path.join(self.cache_dir, '*.pkl')):
+                os.remove(path)
+
+    def clear(self):
+        '''Drops every cached route, in memory and on disk'''
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        '''Hit rate and memory use of the cache'''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.,
+                    'entries': len(self.entries),
+                    'max_entries': self.max_entries,
+                    'bytes': sum(self.sizes.values()),
+                    'persistent': self.cache_dir is not None}
+
+
+def snap_route(cached, start, finish, departure=0, polar_path=Config.polar_diagram, wind_field=None):
+    '''
+    Cached routes are shared by every start and finish in the same grid cells, end them where this request does.
+    The snapped route is timed again, the cached time is for the endpoints of the search that found it.
+    :param departure: Hours after the start of the forecast the boat leaves
+    :param wind_field: The WindField the route was cached for, defaults to the active forecast
+    :return: The route, the route time and the stats, flagged cached
+    '''
+    route, _, stats = cached
+    route = [start] + route[1:-1] + [finish]
+    route_time = utils.get_route_time(routes=[route], departure=departure, polar=get_polar(polar_path),
+                                      wind_field=wind_field)
+    return route, route_time, dict(stats, cached=True, route_hours=route_time.total_seconds() / 3600)
+
+
+route_cache = RouteCache()
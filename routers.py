@@ -0,0 +1,23 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import astar
+import isochrones
+
+# Routing algorithms by the name requests select them with, shared by the app, its process pools and the benchmark
+ROUTERS = {'astar': astar.astar_optimal_route,
+           'isochrone': isochrones.isochrone_optimal_route}
@@ -87,23 +87,16 @@ L.easyButton('&#x27A2', function() {
     for (i in polydata)
         lines.push(polydata[i].polylinePath._latlngs);
     if (lines.length > 0){
+        // The search runs as a job on the server, poll it until the route is ready
         $.ajax({
-            url: '/calculate_optimal_route',
+            url: '/jobs?algorithm=' + algorithm,
             type: "POST",
             contentType: "application/json",
             beforeSend :function(){
                 return confirm('Calculating the optimal route. This may take up to ' + JSON.stringify(timeout) + ' seconds.');},
             data: JSON.stringify(lines)
         }).then(function (data) {
-            $.ajax({
-                url: '/calculate_optimal_route',
-                type: "GET",
-                data: JSON.stringify(data),
-                dataType: "json",
-                success: plot_astar_route(data['route']) // TODO config this. If debugging use plot_astar_points otherwise use plot_astar_route
-            }).then(
-                show_optimal_route_time(data['route_time'])
-            )
+            poll_optimal_route(data['job_id']);
         });
     } else {
         alert('Create a route to submit');
@@ -128,14 +121,45 @@ polylineMeasure2.addTo(map);
 // This hides the drawing portion of the Polyline measure
 polylineMeasure2._measureControl.remove();
 
-//Takes wind data in the form of a json and plots windbarbs with a speed and direction on the map
+// Wind barbs currently on the map, replaced whenever the view changes
+var windBarbs = L.layerGroup().addTo(map);
+
+// Fetches the wind grid for the area in view, the browser revalidates it with the ETag
+function loadWindBarbs(){
+    var bounds = map.getBounds();
+    $.getJSON('/wind', {
+        bbox: [bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast()].join(','),
+        zoom: map.getZoom()
+    }).then(plotWindBarbs, function(){
+        // No forecast yet, try again once it has been ingested
+        setTimeout(loadWindBarbs, 10000);
+    });
+}
+map.on('moveend', loadWindBarbs);
+
+//Takes the quantized wind grid from /wind and plots windbarbs with a speed and direction on the map
 function plotWindBarbs(winddata){
-    wind.data.forEach(function(p){
-    if (maxBounds.contains([p.latitude, p.longitude])){
-        // need to take - 360 of longitude due to noaa grib generation
-        var icon = L.WindBarb.icon({deg: p.degree, speed: p.speed, pointRadius: 0, forceDir: false, strokeLength: 17, strokeWidth: 1});
-        var marker = L.marker([p.latitude, p.longitude], {icon: icon}).addTo(map);
-    }
+    windBarbs.clearLayers();
+    winddata.lats.forEach(function(lat, row){
+        winddata.lngs.forEach(function(lng, col){
+            var i = row * winddata.lngs.length + col;
+            var icon = L.WindBarb.icon({deg: winddata.degree[i], speed: winddata.speed[i] * winddata.speed_step, pointRadius: 0, forceDir: false, strokeLength: 17, strokeWidth: 1});
+            L.marker([lat, lng], {icon: icon}).addTo(windBarbs);
+        });
+    });
+}
+
+// Checks on a routing job every second and plots the route once it is done
+function poll_optimal_route(job_id){
+    $.getJSON('/jobs/' + job_id).then(function (job) {
+        if (job['status'] == 'done') {
+            plot_astar_route(job['route']); // TODO config this. If debugging use plot_astar_points otherwise use plot_astar_route
+            show_optimal_route_time(job['route_time'], job['stats']['approximate']);
+        } else if (job['status'] == 'queued' || job['status'] == 'running') {
+            setTimeout(function () { poll_optimal_route(job_id); }, 1000);
+        } else {
+            alert('The optimal route was not found: ' + job['status']);
+        }
     });
 }
 
@@ -143,8 +167,13 @@ function show_user_route_time(time){
     alert('Your last created route took ' + JSON.stringify(time));
 }
 
-function show_optimal_route_time(time){
-    alert('The optimal route took ' + JSON.stringify(time));
+function show_optimal_route_time(time, approximate){
+    if (approximate) {
+        // The search ran out of time, the route ends with a straight line to the finish
+        alert('No optimal route was found in time, the best route so far takes about ' + JSON.stringify(time));
+    } else {
+        alert('The optimal route took ' + JSON.stringify(time));
+    }
 }
 
 // This is used for plotting isochrones. Not being used atm.
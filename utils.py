@@ -13,79 +13,85 @@ For detail about GNU see <http://www.gnu.org/licenses/>.
 '''
 
 import numpy as np
-import glob, os, time, requests, xarray
-from datetime import datetime, timezone, timedelta
+import glob, os
+from datetime import timedelta
 from config import Config
+from files import atomic_write
+from polar import get_polar
+from wind import get_wind_field, get_ensemble_field, latest_netcdf, CUBE_SUFFIX, ENSEMBLE_SUFFIX, ENSEMBLE_TAG
 
 
-# Create the boat polar diagram for get_boat_speed_numpy function
-polar_diagram = np.genfromtxt(Config.polar_diagram, delimiter=';')
-# replace the nans with - inf
-polar_diagram = np.nan_to_num(polar_diagram, nan=-np.inf)
-# sort according to the first column, wind angle
-polar_diagram = polar_diagram[np.argsort(polar_diagram[:, 0])]
-
-def create_wind_spd_deg_jsons_from_all_gribs(input_dir=Config.grib_dir, output_dir=Config.json_dir, verbose=False):
-    '''Takes a grib file and converts to a json file'''
-    os.chdir(input_dir)
-    all_gribs = [file for file in glob.glob('*.grib2')]
-    os.chdir(Config.proj_dir)
-    if len(all_gribs) == 0 and verbose:
-        print('There are no gribs in the input directory.')
-    else:
-        for filename in all_gribs:
-            ds = xarray.open_dataset(input_dir + filename, engine='cfgrib')
-            # convert the 0-360 to -180 + 180
-            ds = ds.assign_coords(longitude=(((ds.longitude + 180) % 360) - 180))
-            # Need to do this for the wind speed lookup later
-            ds = ds.sortby('longitude')
-            extents = Config.extents
-            max_extents = extents[0]
-            min_extents = extents[1]
-            ds = ds.where((ds.latitude >= min_extents['lat'])
-                          & (ds.latitude <= max_extents['lat'])
-                          & (ds.longitude >= min_extents['lng'])
-                          & (ds.longitude <= max_extents['lng']), drop=True)
-            ds = ds.assign(speed=np.sqrt(np.square(ds['u10']) + np.square(ds['v10'])))
-            # https://www.eol.ucar.edu/content/wind-direction-quick-reference
-            # https://en.wikipedia.org/wiki/Atan2
-            ds = ds.assign(degree=(270 - np.arctan2(ds['v10'], ds['u10']) * (180 / np.pi)) % 360)
-            # Save the modified data to the netcdf folder so we can refer to it later with netcdf
-            ds.to_netcdf(Config.netcdf_dir + filename.replace('grib2', 'nc'))
-            pandas_result = ds.to_dataframe()[['speed','degree']].to_json(orient='table', indent=4)
-            # Save the modified data for leaflet presentation
-            with open(output_dir + filename.replace('grib2', 'json'), 'w') as outfile:
-                outfile.write(pandas_result)
-
-
-def get_gribs(degrees=1, left_lon=0, right_lon=360, top_lat=90, bottom_lat=-90, YYYYMMDD=''):
-    '''
-    Gets u-10 and v-10 wind grib data from NOAA. https://www.nco.ncep.noaa.gov/pmb/products/gfs/
-    :params: YYYYMMDD is the Year, Month and Day
-    :returns:Nothing
-    '''
-    DEG = {.25:'0p25', .5:'0p50', 1: '1p00'} # TODO only 1 is working atm
-    # CC is the model cycle runtime (i.e. 00, 06, 12, 18) just using the first one as this doesn't really matter for simulation purposes
-    CC = '00' # TODO Take the most recent forecast, currently just using the midnight since it's easy
-    # FFF is the timestamp for the prediction based on the hours from the forecast conception
-    FFF = ['000']
-
-    if len(YYYYMMDD) == 0:
-        current_date = datetime.now(timezone.utc).date()
-        # Hacky way to make sure there is a forecast available
-        previous_day = current_date - timedelta(days=1)
-        YYYYMMDD = str(previous_day).replace('-','')
-    print('Downloading Gribs', end='', flush=True)
-    for i in range(len(FFF)):
-        print('.', end='', flush=True)
-        url = 'https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_{}.pl?file=gfs.t00z.pgrb2.1p00.f{}' \
-              '&lev_10_m_above_ground=on&var_UGRD=on&var_VGRD=on&leftlon={}&rightlon={}&toplat={}&bottomlat={}&dir=%2Fgfs.{}%2F00%2Fatmos'.format(DEG[degrees], FFF[i], left_lon, right_lon, top_lat, bottom_lat, YYYYMMDD)
-        file_name = YYYYMMDD + '.' + DEG[degrees] + '.' + FFF[i] + '.grib2'
-        r = requests.get(url, allow_redirects=True)
-        open(Config.grib_dir + file_name, 'wb').write(r.content)
-        # Do not upset NOAA servers
-        time.sleep(2)
-    print(flush=True)
+def save_netcdf(ds, path, encoding=None):
+    '''
+    Writes a dataset atomically, so the forecast managers watching the directory never map half a netcdf.
+    :return: path
+    '''
+    return atomic_write(path, lambda temp_path: ds.to_netcdf(temp_path, encoding=encoding), mode=None)
+
+
+def create_forecast_cube(netcdf_dir=Config.netcdf_dir):
+    '''
+    Stacks every forecast hour of the most recent run into one (step, latitude, longitude) netcdf.
+    Each variable is chunked by forecast hour so reading one hour never decompresses the others.
+    :return: The path of the cube, None if there are no netcdfs
+    '''
+    hour_files = [file for file in list_files(netcdf_dir, '*.nc')
+                  if not file.endswith(CUBE_SUFFIX) and not file.endswith(ENSEMBLE_SUFFIX) and ENSEMBLE_TAG not in file]
+    if len(hour_files) == 0:
+        return None
+    # Files are named YYYYMMDD.DEG.FFF.nc, the run is everything before the forecast hour
+    runs = sorted(set(file.rsplit('.', 2)[0] for file in hour_files))
+    run = runs[-1]
+    # Imported here so the web workers only pay for xarray when they build a cube
+    import xarray
+    datasets = [xarray.open_dataset(netcdf_dir + file) for file in hour_files if file.rsplit('.', 2)[0] == run]
+    try:
+        cube = xarray.concat([ds[['u10', 'v10', 'speed', 'degree']] for ds in datasets], dim='step').sortby('step')
+        cube = cube.transpose('step', 'latitude', 'longitude')
+        chunks = (1, cube.sizes['latitude'], cube.sizes['longitude'])
+        encoding = {name: {'zlib': True, 'chunksizes': chunks} for name in cube.data_vars}
+        encoding['step'] = {'units': 'hours'}
+        path = save_netcdf(cube, netcdf_dir + run + CUBE_SUFFIX, encoding=encoding)
+    finally:
+        for ds in datasets:
+            ds.close()
+    return path
+
+
+def create_ensemble_cube(netcdf_dir=Config.netcdf_dir):
+    '''
+    Stacks every forecast hour of every member of the most recent ensemble run into one
+    (member, step, latitude, longitude) netcdf. Members missing forecast hours are left out.
+    :return: The path of the cube, None if there are no ensemble netcdfs
+    '''
+    # Files are named YYYYMMDD.gefs.MEMBER.FFF.nc
+    member_files = [file for file in list_files(netcdf_dir, '*.nc') if ENSEMBLE_TAG in file and
+                    not file.endswith(ENSEMBLE_SUFFIX)]
+    if len(member_files) == 0:
+        return None
+    run = sorted(set(file.split(ENSEMBLE_TAG)[0] for file in member_files))[-1]
+    members = {}
+    for file in member_files:
+        date, rest = file.split(ENSEMBLE_TAG)
+        if date == run:
+            members.setdefault(rest.split('.')[0], []).append(file)
+    hours = max(len(files) for files in members.values())
+    names = sorted(name for name, files in members.items() if len(files) == hours)
+    import xarray
+    datasets = {name: [xarray.open_dataset(netcdf_dir + file) for file in members[name]] for name in names}
+    try:
+        cube = xarray.concat([xarray.concat([ds[['u10', 'v10', 'speed', 'degree']] for ds in datasets[name]],
+                                            dim='step').sortby('step') for name in names], dim='member')
+        cube = cube.assign_coords(member=names).transpose('member', 'step', 'latitude', 'longitude')
+        chunks = (1, 1, cube.sizes['latitude'], cube.sizes['longitude'])
+        encoding = {name: {'zlib': True, 'chunksizes': chunks} for name in cube.data_vars}
+        encoding['step'] = {'units': 'hours'}
+        path = save_netcdf(cube, netcdf_dir + run + ENSEMBLE_TAG.rstrip('.') + ENSEMBLE_SUFFIX, encoding=encoding)
+    finally:
+        for member_datasets in datasets.values():
+            for ds in member_datasets:
+                ds.close()
+    return path
 
 
 def slice_lat_lon(ds):
@@ -94,106 +100,282 @@ def slice_lat_lon(ds):
     return ds.isel(latitude=slice(0, 3), longitude=slice(0, 3))
 
 
-def get_jsons():
-    '''
-    Get the jsons update the directories as neededd
-    :return:
-    '''
-    # Get the JSONs to serve up for the wind
-    os.chdir(Config.json_dir)
-    jsons = [file for file in glob.glob('*.json')]
-    jsons.sort()
-    os.chdir(Config.proj_dir)
-
-    # If there are no jsons then check to see if there are any gribs available to convert, if not then get some
-    if len(jsons) == 0:
-        os.chdir(Config.grib_dir)
-        gribs = [file for file in glob.glob('*.grib2')]
-        gribs.sort()
-        os.chdir(Config.proj_dir)
-        if len(gribs) == 0:
-            get_gribs(degrees=1)
-        create_wind_spd_deg_jsons_from_all_gribs()
-        os.chdir(Config.json_dir)
-        jsons = [file for file in glob.glob('*.json')]
-        jsons.sort()
-        os.chdir(Config.proj_dir)
-    return jsons
-
-
-# TODO create a version of that that store the speed in a cache.
-def get_boat_speed(true_wind_angle, wind_speed, polar_diagram=polar_diagram):
-    # get the wind degree column
-    degree = polar_diagram[:, 0]
-    # subract the wind angle so we can sort to the the closest .1 errs on the side of the a wider angle
-    row_index = np.argmin(abs(degree - true_wind_angle - .1))
-    col_index = np.argmin(abs(polar_diagram[0] - wind_speed))
-    return polar_diagram[row_index][col_index]
-
-
-def get_route_time(routes):
-    # This holds the wind degree and speed
-    wind_data = get_most_recent_netcdf()
-    route = routes[-1]
-    route_segments = []
-    start_time = datetime.timedelta(minutes=0, seconds=0)
-
-    for i in range(len(route) - 1):
-        start_lat = route[i]['lat']
-        start_lng = route[i]['lng']
-        finish_lat = route[i + 1]['lat']
-        finish_lng = route[i + 1]['lng']
-
-        # https://pyproj4.github.io/pyproj/stable/api/geod.html
-        azimuth1, azimuth2, distance = Config.globe.inv(start_lng, start_lat, finish_lng, finish_lat)
-        # Convert distance(meters) to nautical miles
-        distance *= 0.000539957
-
-        heading = azimuth2 + 180
-
-        wind_speed = wind_data.sel(latitude=start_lat, longitude=start_lng, method='nearest')['speed'].values.item()
-        wind_degree = wind_data.sel(latitude=start_lat, longitude=start_lng, method='nearest')['degree'].values.item()
-        true_wind_angle = calculate_true_wind_angle(heading, wind_degree)
-        boat_speed = get_boat_speed(true_wind_angle, wind_speed)
-
-        if Config.debug:
-            print('Boat Speed: {}, Heading: {}, TWA: {}, Wind Speed: {} Wind Degrees: {}'.format(boat_speed, heading, true_wind_angle, wind_speed, wind_degree))
-
-        # This gives us a minimum boat speed of 1 knot, the polar diagrams are not completely filled out.
-        time = start_time + datetime.timedelta(hours=distance/max(boat_speed, Config.motoring_speed))
-        route_segment = {'id': i,
-                         'start_lat_lon': (start_lat, start_lng),
-                         'finish_lat_lon': (finish_lat, finish_lng),
-                         'distance': distance,
-                         'wind_speed': wind_speed,
-                         'wind_degree': wind_degree,
-                         'heading':heading,
-                         'boat_speed':boat_speed,
-                         'time':time}
-        route_segments.append(route_segment)
-        start_time = time
-    return route_segments[-1]['time']
+def list_files(directory, pattern):
+    '''
+    Sorted file names in a directory matching a glob pattern.
+    Does not change the working directory, so it is safe to call from concurrent requests.
+    '''
+    return sorted(os.path.basename(file) for file in glob.glob(os.path.join(directory, pattern)))
+
+
+def get_boat_speed(true_wind_angle, wind_speed, polar=None):
+    '''
+    Looks up the boat speed for scalars or for arrays of true wind angles and wind speeds.
+    :param true_wind_angle: True wind angle(s) in degrees
+    :param wind_speed: Wind speed(s) in knots, broadcast against true_wind_angle
+    :param polar: The Polar to use, defaults to Config.polar_diagram
+    :return: The interpolated boat speed(s) in knots with the broadcast shape of the inputs
+    '''
+    if polar is None:
+        polar = get_polar()
+    return polar.speed(true_wind_angle, wind_speed)
+
+
+def densify_routes(lats, lngs, step, max_subsegments):
+    '''
+    Splits every leg into equal sub-segments along its geodesic, no longer than step nautical miles
+    and no more than max_subsegments per leg. All the new points come from one batched Geod.fwd.
+    :param lats: (N, M + 1) latitudes, NaN past the end of shorter routes
+    :param lngs: (N, M + 1) longitudes
+    :return: Densified latitudes and longitudes, and the (N, P) index of the leg each sub-segment belongs to, -1 for padding
+    '''
+    rows, legs = np.nonzero(~np.isnan(lats[:, 1:]))
+    azimuth, _, meters = Config.globe.inv(lngs[rows, legs], lats[rows, legs], lngs[rows, legs + 1], lats[rows, legs + 1])
+    pieces = np.clip(np.ceil(meters / 1852 / step), 1, max_subsegments).astype(int)
+
+    # One entry per sub-segment start, legs are in route order so the points come out in order too
+    leg_of = np.repeat(np.arange(len(legs)), pieces)
+    piece = np.arange(len(leg_of)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    sub_lngs, sub_lats, _ = Config.globe.fwd(lngs[rows, legs][leg_of], lats[rows, legs][leg_of], azimuth[leg_of],
+                                             meters[leg_of] * piece / pieces[leg_of])
+    sub_rows = rows[leg_of]
+    columns = np.arange(len(leg_of)) - np.searchsorted(sub_rows, sub_rows)
+
+    # Each route ends with its original last point
+    ends = np.bincount(rows, weights=pieces, minlength=len(lats)).astype(int)
+    dense_lats = np.full((len(lats), ends.max() + 1), np.nan)
+    dense_lngs = np.full(dense_lats.shape, np.nan)
+    dense_legs = np.full((len(lats), ends.max()), -1)
+    dense_lats[sub_rows, columns], dense_lngs[sub_rows, columns] = sub_lats, sub_lngs
+    dense_legs[sub_rows, columns] = legs[leg_of]
+    last = (~np.isnan(lats)).sum(axis=1) - 1
+    dense_lats[np.arange(len(lats)), ends] = lats[np.arange(len(lats)), last]
+    dense_lngs[np.arange(len(lats)), ends] = lngs[np.arange(len(lats)), last]
+    return dense_lats, dense_lngs, dense_legs
+
+
+def route_geometry(routes, lat_step, resolution=Config.route_resolution, max_subsegments=Config.route_max_subsegments):
+    '''
+    Pads routes into arrays, splits long legs and measures every sub-segment. This only depends on the routes
+    so it is shared by every forecast or ensemble member they are timed in.
+    :param routes: List of N routes, each a list of {'lat', 'lng'} points, lengths may differ
+    :param lat_step: Degrees between the rows of the wind grid, see evaluate_routes for resolution
+    :return: (N, P + 1) latitudes and longitudes, and (N, P) leg index, distance in nautical miles and heading of
+             each sub-segment, the leg index is -1 and the rest NaN past the end of shorter routes
+    '''
+    points = max(len(route) for route in routes)
+    # (N, M + 1) coordinates, shorter routes padded with NaN
+    lats = np.full((len(routes), points), np.nan)
+    lngs = np.full((len(routes), points), np.nan)
+    for i, route in enumerate(routes):
+        lats[i, :len(route)] = [point['lat'] for point in route]
+        lngs[i, :len(route)] = [point['lng'] for point in route]
+    return split_legs(lats, lngs, lat_step, resolution, max_subsegments)
+
+
+def split_legs(lats, lngs, lat_step, resolution=Config.route_resolution, max_subsegments=Config.route_max_subsegments):
+    '''
+    Splits long legs of padded routes and measures every sub-segment, see route_geometry.
+    :param lats: (N, M + 1) latitudes, NaN past the end of shorter routes
+    :param lngs: (N, M + 1) longitudes
+    '''
+    points = lats.shape[1]
+    legs = np.where(~np.isnan(lats[:, 1:]), np.arange(points - 1), -1)
+    if resolution and points > 1:
+        # A degree of latitude is 60 nautical miles
+        step = resolution * lat_step * 60
+        lats, lngs, legs = densify_routes(lats, lngs, step, max_subsegments)
+    valid = legs >= 0
+
+    # https://pyproj4.github.io/pyproj/stable/api/geod.html
+    distance = np.full(valid.shape, np.nan)
+    heading = np.full(valid.shape, np.nan)
+    azimuth, _, meters = Config.globe.inv(lngs[:, :-1][valid], lats[:, :-1][valid], lngs[:, 1:][valid], lats[:, 1:][valid])
+    # Convert distance(meters) to nautical miles
+    distance[valid] = meters * 0.000539957
+    # The heading steered from the start of each sub-segment, as a compass bearing
+    heading[valid] = azimuth % 360
+    return lats, lngs, legs, distance, heading
+
+
+def time_subsegments(lats, lngs, distance, heading, departure, polar, wind_field, tolerance=Config.route_time_tolerance,
+                     member=None):
+    '''
+    Times the sub-segments from route_geometry, sampling the wind where and when each one is started.
+    :param departure: Array of hours after the start of the forecast each route begins
+    :param member: Array of the ensemble member index each route is timed in, when wind_field is an EnsembleField
+    :return: (N, P) wind speed, wind degree, boat speed and hours of each sub-segment
+    '''
+    valid = ~np.isnan(distance)
+    # Every sub-segment is timed at once from a guess of when it starts, then the start times are refined
+    # until they settle. Each pass fixes at least one more sub-segment of every route, so this ends on the
+    # same times as walking the sub-segments in order. Routes drop out of the passes as soon as they settle.
+    wind_speed, wind_degree, boat_speed, hours = [np.full(valid.shape, np.nan) for _ in range(4)]
+    rows, columns = np.nonzero(valid)
+    starts = np.zeros(len(rows))
+    todo = np.ones(len(rows), dtype=bool)
+    for _ in range(valid.shape[1]):
+        row, column = rows[todo], columns[todo]
+        wind_speed[row, column], wind_degree[row, column] = wind_field.sample(
+            lats[row, column], lngs[row, column], departure[row] + starts[todo],
+            member=None if member is None else member[row])
+        true_wind_angle = calculate_true_wind_angle(heading[row, column], wind_degree[row, column])
+        # The polar diagrams are not completely filled out, never slower than the motoring speed
+        boat_speed[row, column] = np.maximum(polar.speed(true_wind_angle, wind_speed[row, column]),
+                                             Config.motoring_speed)
+        hours[row, column] = distance[row, column] / boat_speed[row, column]
+        previous, starts = starts, (np.nancumsum(hours, axis=1) - np.nan_to_num(hours))[valid]
+        unsettled = np.zeros(len(distance), dtype=bool)
+        unsettled[rows[np.abs(starts - previous) >= tolerance]] = True
+        todo = unsettled[rows]
+        if not todo.any():
+            break
+    return wind_speed, wind_degree, boat_speed, hours
+
+
+def time_legs(lat, lng, lats, lngs, departure, polar, wind_field, resolution=Config.route_resolution,
+              max_subsegments=Config.route_max_subsegments, tolerance=Config.route_time_tolerance):
+    '''
+    Times legs from one point straight to many others the same way evaluate_routes times each leg of a route.
+    :param lat: Latitude the legs start from
+    :param lng: Longitude the legs start from
+    :param lats: Array of latitudes the legs end at
+    :param lngs: Array of longitudes the legs end at
+    :param departure: Hours after the start of the forecast the legs begin
+    :return: Array of hours to sail each leg
+    '''
+    if len(lats) == 0:
+        return np.empty(0)
+    lats, lngs, _, distance, heading = split_legs(np.column_stack([np.full(len(lats), lat), lats]),
+                                                  np.column_stack([np.full(len(lngs), lng), lngs]),
+                                                  abs(wind_field.lat_step), resolution, max_subsegments)
+    _, _, _, hours = time_subsegments(lats, lngs, distance, heading, np.full(len(lats), float(departure)), polar,
+                                      wind_field, tolerance)
+    return np.nansum(hours, axis=1)
+
+
+def evaluate_routes(routes, departure=0, polar=None, wind_field=None, segments=False,
+                    resolution=Config.route_resolution, max_subsegments=Config.route_max_subsegments,
+                    tolerance=Config.route_time_tolerance):
+    '''
+    Times many routes at once. Long legs are split into sub-segments about resolution wind grid cells long,
+    and the wind is sampled where and when each sub-segment is started.
+    :param routes: List of N routes, each a list of {'lat', 'lng'} points, lengths may differ
+    :param departure: Hours after the start of the forecast the routes begin, a scalar or one per route
+    :param polar: The Polar to use, defaults to Config.polar_diagram
+    :param wind_field: The WindField to sample, defaults to the active forecast
+    :param segments: Also return a dict of (N, M) arrays describing each of the M legs, NaN past the end of shorter routes
+    :param resolution: Sub-segment length in wind grid cells, smaller is more accurate and slower. None samples once per leg.
+    :param max_subsegments: Most sub-segments a single leg is split into
+    :param tolerance: Hours the sub-segment start times may still be changing by when they are accepted
+    :return: Array of N route times in hours, and the leg arrays when segments is True
+    '''
+    if polar is None:
+        polar = get_polar()
+    if wind_field is None:
+        wind_field = get_wind_field()
+    points = max(len(route) for route in routes)
+    lats, lngs, legs, distance, heading = route_geometry(routes, abs(wind_field.lat_step), resolution,
+                                                         max_subsegments)
+    valid = legs >= 0
+    departure = np.broadcast_to(np.asarray(departure, dtype=float), (len(routes),))
+    wind_speed, wind_degree, boat_speed, hours = time_subsegments(lats, lngs, distance, heading, departure, polar,
+                                                                  wind_field, tolerance)
+    elapsed = np.nansum(hours, axis=1)
+
+    if not segments:
+        return elapsed
+    # Add the sub-segments back up into the legs they were split from. Wind and heading are where each leg starts.
+    shape = (len(routes), max(points - 1, 0))
+    rows = np.nonzero(valid)[0]
+    leg_distance, leg_hours = np.zeros(shape), np.zeros(shape)
+    np.add.at(leg_distance, (rows, legs[valid]), distance[valid])
+    np.add.at(leg_hours, (rows, legs[valid]), hours[valid])
+    first = valid & (np.pad(legs, ((0, 0), (1, 0)), constant_values=-1)[:, :-1] != legs)
+    leg_valid = np.zeros(shape, dtype=bool)
+    leg_valid[np.nonzero(first)[0], legs[first]] = True
+    leg_arrays = {}
+    for name, array in (('heading', heading), ('wind_speed', wind_speed), ('wind_degree', wind_degree)):
+        leg_arrays[name] = np.full(shape, np.nan)
+        leg_arrays[name][leg_valid] = array[first]
+    leg_arrays['elapsed'] = np.cumsum(leg_hours, axis=1)
+    for name, array in (('distance', leg_distance), ('hours', leg_hours)):
+        leg_arrays[name] = np.where(leg_valid, array, np.nan)
+    # Average speed over the leg
+    leg_arrays['boat_speed'] = leg_arrays['distance'] / leg_arrays['hours']
+    return elapsed, leg_arrays
+
+
+def evaluate_ensemble(routes, departure=0, polar=None, ensemble=None, resolution=Config.route_resolution,
+                      max_subsegments=Config.route_max_subsegments, tolerance=Config.route_time_tolerance):
+    '''
+    Times many routes in every member of an ensemble at once. The legs are split and measured once and
+    every member is timed in the same passes, see evaluate_routes.
+    :param ensemble: The EnsembleField, defaults to the latest ensemble
+    :return: (members, N) array of route times in hours
+    '''
+    if polar is None:
+        polar = get_polar()
+    if ensemble is None:
+        ensemble = get_ensemble_field()
+    lats, lngs, _, distance, heading = route_geometry(routes, abs(ensemble.lat_step), resolution, max_subsegments)
+    members = len(ensemble)
+    departure = np.broadcast_to(np.asarray(departure, dtype=float), (len(routes),))
+    # Rows are every route in the first member, then every route in the second and so on
+    rows = [np.tile(array, (members, 1)) for array in (lats, lngs, distance, heading)]
+    _, _, _, hours = time_subsegments(*rows, np.tile(departure, members), polar, ensemble, tolerance,
+                                      member=np.repeat(np.arange(members), len(routes)))
+    return np.nansum(hours, axis=1).reshape(members, len(routes))
+
+
+def get_route_time(routes, departure=0, polar=None, resolution=Config.route_resolution, wind_field=None):
+    '''
+    Time to sail the last route, sampling the wind at the time each segment is started.
+    :param routes: List of routes, each a list of {'lat', 'lng'} points
+    :param departure: Hours after the start of the forecast the route begins
+    :param polar: The Polar to use, defaults to Config.polar_diagram
+    :param resolution: Sub-segment length in wind grid cells, see evaluate_routes
+    :param wind_field: The WindField to sample, defaults to the active forecast
+    :return: The route time as a timedelta
+    '''
+    elapsed, route_segments = evaluate_routes(routes[-1:], departure=departure, polar=polar, segments=True,
+                                              resolution=resolution, wind_field=wind_field)
+    if Config.debug:
+        for i in range(route_segments['hours'].shape[1]):
+            print('Boat Speed: {}, Heading: {}, Wind Speed: {} Wind Degrees: {}'.format(
+                *(route_segments[name][0, i] for name in ('boat_speed', 'heading', 'wind_speed', 'wind_degree'))))
+    return timedelta(hours=float(elapsed[0]))
+
+
+def time_found_route(route, departure, polar, wind_field, stats):
+    '''
+    Times a route a router returns the same way /process_user_route times a drawn one, along densified legs, so
+    a route shows the same ETA wherever it is timed. The searches sample the wind once per leg, the hours they
+    found the route with are kept in the stats as searched_hours and route_hours is the time returned.
+    :param route: List of {'lat', 'lng'} points
+    :param departure: Hours after the start of the forecast the route begins
+    :return: The route time as a timedelta
+    '''
+    route_time = get_route_time(routes=[route], departure=departure, polar=polar, wind_field=wind_field)
+    if 'route_hours' in stats:
+        stats['searched_hours'] = stats['route_hours']
+    stats['route_hours'] = route_time.total_seconds() / 3600
+    return route_time
 
 
 def calculate_true_wind_angle(heading, wind_degree):
     '''
     This returns the true
-    :param heading: This is the course the route is define by
+    :param heading: This is the course the route is define by, a scalar or an array of headings
     :param wind_degree: This is the compass heading in degrees of the wind
     :return: The shortest true wind angle
     '''
-    result = (heading - wind_degree)
-    if result > 180:
-        result -= 360
-    elif result < -180:
-        result += 360
+    # Wrap the difference into [-180, 180) so this works the same for scalars and arrays
+    result = (np.asarray(heading) - wind_degree + 180) % 360 - 180
     return abs(result)
 
 
 def get_most_recent_netcdf():
-    # TODO actually get the most recent netcdt currently returning the first
-    os.chdir(Config.netcdf_dir)
-    all_netcdfs = [file for file in glob.glob('*.nc')]
-    os.chdir(Config.proj_dir)
-    dataset = xarray.open_dataset(Config.netcdf_dir + all_netcdfs[0])
-    return dataset
+    '''Opens the most recent netcdf as an xarray dataset. Routing should use get_wind_field instead.'''
+    import xarray
+    return xarray.open_dataset(latest_netcdf())
@@ -0,0 +1,96 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import threading
+import time
+from config import Config
+from landmask import CoastlineMissing, get_land_mask
+from polar import get_polar
+from wind import get_wind_field
+
+
+class Warmup:
+    '''
+    Gets a freshly started web worker ready to route on a background thread, so the first request never waits for
+    a cold load. Loads the polars and the land mask, then maps the forecast, checking every Config.warmup_retry
+    seconds until the first one has been ingested. Workers never start ingestion themselves here.
+    '''
+
+    def __init__(self):
+        # Seconds each step took, in the order they ran
+        self.steps = {}
+        self.error = None
+        # A configuration error, such as a missing coastline, that no retry fixes
+        self.misconfigured = False
+        self._ready = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ready(self):
+        return self._ready.is_set()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        '''
+        Starts warming up unless it is already running or done. A warm-up that failed is tried again, unless it
+        failed on the configuration.
+        :return: True if a run was started
+        '''
+        with self._lock:
+            if self.ready() or self.running() or self.misconfigured:
+                return False
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            return True
+
+    def status(self):
+        return {'ready': self.ready(), 'running': self.running(), 'steps': dict(self.steps), 'error': self.error,
+                'misconfigured': self.misconfigured}
+
+    def _step(self, name, function):
+        started = time.perf_counter()
+        function()
+        self.steps[name] = time.perf_counter() - started
+
+    def _wait_for_forecast(self):
+        # Ingestion runs once for the whole dyno, see gunicorn.conf.py and the index page, each worker only
+        # waits for the forecast it converts
+        while True:
+            try:
+                return get_wind_field()
+            except FileNotFoundError:
+                time.sleep(Config.warmup_retry)
+
+    def _run(self):
+        try:
+            for name, path in Config.polar_diagrams.items():
+                self._step('polar_' + name, lambda path=path: get_polar(path))
+            self._step('land_mask', get_land_mask)
+            self._step('forecast', self._wait_for_forecast)
+            self.error = None
+            self._ready.set()
+        except CoastlineMissing as e:
+            self.error = str(e)
+            self.misconfigured = True
+            print('Warm-up failed:', e)
+        except Exception as e:
+            self.error = str(e)
+            print('Warm-up failed:', e)
+
+warmup = Warmup()
@@ -0,0 +1,367 @@
+'''
+Copyright (C) 2021 Richard Mackie
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+ any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import contextlib
+import datetime
+from functools import lru_cache
+import glob
+import os
+import threading
+import numpy as np
+from config import Config
+from files import atomic_write
+
+# Arrays kept for every forecast, each is saved as a .npy sidecar next to the netcdf
+FIELDS = ('hours', 'latitude', 'longitude', 'speed', 'degree', 'u', 'v')
+
+# Suffix of the netcdf holding every forecast hour of a run stacked together
+CUBE_SUFFIX = '.cube.nc'
+
+# Ensemble gribs and netcdfs are named YYYYMMDD.gefs.MEMBER.FFF, their cube stacks every member of a run
+ENSEMBLE_TAG = '.gefs.'
+ENSEMBLE_SUFFIX = '.ensemble.nc'
+# Names of the ensemble members, saved with the other ensemble sidecars
+ENSEMBLE_FIELDS = FIELDS + ('members',)
+
+
+def run_time(path):
+    '''
+    UTC start of the run a forecast file is named after. Only the 00 cycle is downloaded, so a run starts at midnight
+    of the YYYYMMDD its name begins with.
+    :return: A timezone aware datetime, None when the name carries no date
+    '''
+    try:
+        date = datetime.datetime.strptime(os.path.basename(path)[:8], '%Y%m%d')
+    except ValueError:
+        return None
+    return date.replace(tzinfo=datetime.timezone.utc)
+
+
+def _grid_step(coordinates):
+    '''Spacing of a regular coordinate axis, the GFS grids are always regular'''
+    if len(coordinates) < 2:
+        return 1.0
+    steps = np.diff(coordinates)
+    if not np.allclose(steps, steps[0]):
+        raise ValueError('Wind grid coordinates must be regularly spaced')
+    return float(steps[0])
+
+
+def _grid_position(values, origin, step, size):
+    '''Fractional array index of each coordinate, clamped to the grid'''
+    return np.clip((np.asarray(values, dtype=float) - origin) / step, 0, size - 1)
+
+
+def wind_degree(u, v):
+    '''Compass direction the wind is coming from for u and v components'''
+    # https://www.eol.ucar.edu/content/wind-direction-quick-reference
+    return (270 - np.degrees(np.arctan2(v, u))) % 360
+
+
+class WindField:
+    '''
+    Read only snapshot of a forecast held as contiguous numpy arrays.
+    The wind arrays are shaped (time, latitude, longitude), each time slice is contiguous so a
+    memory mapped search only pages in the forecast hours it actually reaches.
+    The snapshot never changes once built, a newer forecast replaces the whole object.
+    '''
+
+    def __init__(self, path, mtime, hours, latitude, longitude, speed, degree, u, v, member=None):
+        self.path = path
+        self.mtime = mtime
+        # Name of the ensemble member this forecast is, None for the deterministic run
+        self.member = member
+        # Hours since the start of the forecast for each time slice
+        self.hours = hours
+        self.latitude = latitude
+        self.longitude = longitude
+        self.speed = speed
+        self.degree = degree
+        # Wind components, direction is interpolated on these rather than on degrees
+        self.u = u
+        self.v = v
+        self.lat_step = _grid_step(latitude)
+        self.lng_step = _grid_step(longitude)
+
+    @property
+    def key(self):
+        '''Identifies the forecast file this snapshot was loaded from, and the member of an ensemble'''
+        if self.member is None:
+            return self.path, self.mtime
+        return self.path, self.mtime, self.member
+
+    def _time_position(self, hours):
+        '''
+        Bracketing time slices and the fraction between them. Times outside the forecast are
+        clamped to its first or last hour. The forecast hours do not have to be evenly spaced.
+        '''
+        hours = np.clip(hours, self.hours[0], self.hours[-1])
+        time0 = np.clip(np.searchsorted(self.hours, hours, side='right') - 1, 0, len(self.hours) - 1)
+        time1 = np.minimum(time0 + 1, len(self.hours) - 1)
+        span = self.hours[time1] - self.hours[time0]
+        fraction = np.divide(hours - self.hours[time0], span, out=np.zeros(np.shape(hours)), where=span > 0)
+        return time0, time1, fraction
+
+    def sample(self, lat, lng, hours=0, method=Config.wind_sampling, member=None):
+        '''
+        Wind at one or many locations and times. Grid indices are calculated directly from the regular grid
+        and the wind is linearly interpolated between the two forecast hours around each time.
+        :param lat: Latitude(s)
+        :param lng: Longitude(s), broadcast against lat
+        :param hours: Hours since the start of the forecast, broadcast against lat
+        :param method: 'nearest' for the closest grid point or 'bilinear' to interpolate the four surrounding points
+        :param member: Index of the ensemble member for each location, only for an EnsembleField
+        :return: Wind speed(s) and wind degree(s)
+        '''
+        if member is None:
+            lat, lng, hours = np.broadcast_arrays(lat, lng, hours)
+            prefix = ()
+        else:
+            lat, lng, hours, member = np.broadcast_arrays(lat, lng, hours, member)
+            prefix = (member,)
+        row = _grid_position(lat, self.latitude[0], self.lat_step, len(self.latitude))
+        col = _grid_position(lng, self.longitude[0], self.lng_step, len(self.longitude))
+        time0, time1, time_fraction = self._time_position(hours)
+
+        if method == 'nearest':
+            row, col = np.rint(row).astype(int), np.rint(col).astype(int)
+
+            def interpolate_space(grid, time):
+                return grid[prefix + (time, row, col)]
+        elif method == 'bilinear':
+            row0, col0 = row.astype(int), col.astype(int)
+            row1 = np.minimum(row0 + 1, len(self.latitude) - 1)
+            col1 = np.minimum(col0 + 1, len(self.longitude) - 1)
+            row_fraction, col_fraction = row - row0, col - col0
+
+            def interpolate_space(grid, time):
+                low = grid[prefix + (time, row0, col0)] * (1 - col_fraction) + \
+                    grid[prefix + (time, row0, col1)] * col_fraction
+                high = grid[prefix + (time, row1, col0)] * (1 - col_fraction) + \
+                    grid[prefix + (time, row1, col1)] * col_fraction
+                return low * (1 - row_fraction) + high * row_fraction
+        else:
+            raise ValueError('Unknown wind sampling method {}'.format(method))
+
+        def interpolate(grid):
+            return interpolate_space(grid, time0) * (1 - time_fraction) + interpolate_space(grid, time1) * time_fraction
+
+        return interpolate(self.speed)[()], wind_degree(interpolate(self.u), interpolate(self.v))[()]
+
+    def departure_hours(self, when=None):
+        '''
+        Hours after the start of the forecast of a departure at when, now by default. Departures before the start
+        of the forecast, or from a forecast whose start is unknown, leave at its start.
+        '''
+        start = run_time(self.path)
+        if start is None:
+            return 0.
+        if when is None:
+            when = datetime.datetime.now(datetime.timezone.utc)
+        return max((when - start).total_seconds() / 3600, 0.)
+
+    def grid(self, south, west, north, east, stride=1, hours=0):
+        '''
+        The forecast grid points inside a bounding box, keeping every stride-th row and column.
+        :return: Latitudes, longitudes and (latitude, longitude) arrays of wind speed and wind degree
+        '''
+        rows = np.flatnonzero((self.latitude >= south) & (self.latitude <= north))[::stride]
+        cols = np.flatnonzero((self.longitude >= west) & (self.longitude <= east))[::stride]
+        lats, lngs = self.latitude[rows], self.longitude[cols]
+        speed, degree = self.sample(lats[:, np.newaxis], lngs[np.newaxis, :], hours)
+        return lats, lngs, np.asarray(speed), np.asarray(degree)
+
+
+class EnsembleField(WindField):
+    '''
+    Every member of an ensemble forecast, the wind arrays are shaped (member, time, latitude, longitude).
+    Members share the grid and the forecast hours, so one sample call serves all of them.
+    '''
+
+    def __init__(self, path, mtime, hours, latitude, longitude, speed, degree, u, v, members):
+        super().__init__(path, mtime, hours, latitude, longitude, speed, degree, u, v)
+        self.members = [str(name) for name in members]
+
+    def __len__(self):
+        return len(self.members)
+
+    def member_field(self, index):
+        '''One member as a WindField, a view onto the same memory mapped arrays'''
+        return WindField(self.path, self.mtime, self.hours, self.latitude, self.longitude, self.speed[index],
+                         self.degree[index], self.u[index], self.v[index], member=self.members[index])
+
+
+def latest_netcdf(netcdf_dir=Config.netcdf_dir):
+    '''
+    Returns the path of the most recently modified forecast cube, falling back to the most recent
+    single hour netcdf. None if there are no netcdfs.
+    '''
+    all_netcdfs = glob.glob(os.path.join(netcdf_dir, '*' + CUBE_SUFFIX)) or \
+        [path for path in glob.glob(os.path.join(netcdf_dir, '*.nc'))
+         if ENSEMBLE_TAG not in os.path.basename(path) and not path.endswith(ENSEMBLE_SUFFIX)]
+    if len(all_netcdfs) == 0:
+        return None
+    return max(all_netcdfs, key=os.path.getmtime)
+
+
+def _sidecar_path(path, mtime, field):
+    # The mtime is part of the name so a replaced netcdf never reuses stale arrays
+    return '{}.{}.{}.npy'.format(os.path.splitext(path)[0], mtime, field)
+
+
+def latest_ensemble(netcdf_dir=Config.netcdf_dir):
+    '''Returns the path of the most recently modified ensemble cube, None if there is none'''
+    all_ensembles = glob.glob(os.path.join(netcdf_dir, '*' + ENSEMBLE_SUFFIX))
+    if len(all_ensembles) == 0:
+        return None
+    return max(all_ensembles, key=os.path.getmtime)
+
+
+def _forecast_arrays(ds):
+    '''
+    Reads a dataset into (time, latitude, longitude) arrays. Single hour netcdfs get a time axis of one.
+    Ensemble cubes keep their member axis in front and also return the member names.
+    '''
+    variables = ds[['speed', 'degree']]
+    if 'step' in variables.dims:
+        dims = ('member', 'step', 'latitude', 'longitude') if 'member' in variables.dims else \
+            ('step', 'latitude', 'longitude')
+        variables = variables.transpose(*dims)
+        hours = ds['step'].values / np.timedelta64(1, 'h')
+    else:
+        variables = variables.squeeze(drop=True).expand_dims('step')
+        hours = [ds['step'].values / np.timedelta64(1, 'h')] if 'step' in ds.coords else [0.]
+    arrays = {'hours': np.asarray(hours, dtype=float).reshape(-1),
+              'latitude': ds['latitude'].values,
+              'longitude': ds['longitude'].values,
+              'speed': variables['speed'].values,
+              'degree': variables['degree'].values}
+    if 'member' in variables.dims:
+        arrays['members'] = ds['member'].values.astype(str)
+    return arrays
+
+
+def load_wind_field(path, mtime=None):
+    '''
+    Loads a forecast, reusing the memory mapped .npy sidecars when they exist so that every
+    gunicorn worker shares the same pages instead of holding its own copy.
+    Ensemble cubes load as an EnsembleField.
+    :param mtime: Version of the netcdf to load as its st_mtime_ns, defaults to the current one. A version that has
+                  since been replaced only loads while its sidecars are still on disk.
+    :raises FileNotFoundError: When the netcdf, or the version asked for, is gone
+    '''
+    if mtime is None:
+        mtime = os.stat(path).st_mtime_ns
+    ensemble = path.endswith(ENSEMBLE_SUFFIX)
+    sidecars = {field: _sidecar_path(path, mtime, field) for field in (ENSEMBLE_FIELDS if ensemble else FIELDS)}
+    if not all(os.path.exists(sidecar) for sidecar in sidecars.values()):
+        if os.stat(path).st_mtime_ns != mtime:
+            raise FileNotFoundError('{} has been replaced since version {}'.format(path, mtime))
+        # Imported here, xarray and pandas take longer to import than the sidecars take to map
+        import xarray
+        with xarray.open_dataset(path) as ds:
+            arrays = _forecast_arrays(ds)
+        # Components pointing where the wind blows to, the inverse of wind_degree
+        radians = np.radians(arrays['degree'])
+        arrays['u'] = -arrays['speed'] * np.sin(radians)
+        arrays['v'] = -arrays['speed'] * np.cos(radians)
+        for field, array in arrays.items():
+            if field != 'members':
+                array = np.ascontiguousarray(array, dtype=np.float64)
+            # Other workers never memory map a partially written array
+            atomic_write(sidecars[field], lambda outfile: np.save(outfile, array))
+        # Sidecars of older versions of this netcdf are no longer needed
+        for sidecar in glob.glob('{}.*.npy'.format(os.path.splitext(path)[0])):
+            if sidecar not in sidecars.values():
+                # Every worker loading the new forecast cleans up, another may have got there first
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(sidecar)
+    # Plain arrays over the mapped pages, indexing a np.memmap goes through its Python __getitem__ on every sample
+    arrays = {field: np.asarray(np.load(sidecar, mmap_mode='r')) for field, sidecar in sidecars.items()}
+    if ensemble:
+        return EnsembleField(path=path, mtime=mtime, **arrays)
+    return WindField(path=path, mtime=mtime, **arrays)
+
+
+@lru_cache(maxsize=4)
+def load_forecast(path, mtime):
+    '''
+    Loads one version of a forecast once per process, by the key of its WindField. Pool processes route on the
+    forecast their parent checked and cached the request against, even when a newer one lands while they run.
+    '''
+    return load_wind_field(path, mtime)
+
+
+class WindFieldManager:
+    '''
+    Holds the active forecast for the whole process and swaps in a newer one when it lands.
+    '''
+
+    def __init__(self, netcdf_dir=Config.netcdf_dir, latest=latest_netcdf):
+        self.netcdf_dir = netcdf_dir
+        # Finds the newest forecast file in the directory
+        self.latest = latest
+        self._field = None
+        self._lock = threading.Lock()
+
+    def _is_current(self, field, path):
+        if field is None:
+            return False
+        try:
+            return field.key == (path, os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            # Removed since it was listed, the next get finds what replaced it
+            return False
+
+    def get(self):
+        '''Returns the WindField for the most recent netcdf, loading it only when it has changed'''
+        path = self.latest(self.netcdf_dir)
+        if path is None:
+            raise FileNotFoundError('There are no netcdfs in {}'.format(self.netcdf_dir))
+        field = self._field
+        if self._is_current(field, path):
+            return field
+        with self._lock:
+            # Another thread may have loaded it while we waited
+            field = self._field
+            if not self._is_current(field, path):
+                try:
+                    loaded = load_wind_field(path)
+                except FileNotFoundError:
+                    # Removed while it loaded, keep routing on the forecast we have until the next one lands
+                    if field is None:
+                        raise
+                    return field
+                # Swapping the reference is atomic, requests holding the old snapshot keep using it
+                self._field = field = loaded
+        return field
+
+
+wind_fields = WindFieldManager()
+
+
+def get_wind_field():
+    '''Returns the process wide WindField for the active forecast'''
+    return wind_fields.get()
+
+
+ensemble_fields = WindFieldManager(latest=latest_ensemble)
+
+
+def get_ensemble_field():
+    '''Returns the process wide EnsembleField for the latest ensemble, raises FileNotFoundError when there is none'''
+    return ensemble_fields.get()